@@ -1,8 +1,17 @@
 # This is a reference, will not be present in the final project.
 # This code is my own.
 
-import pygame
+import argparse
+import json
+import math
+import operator
+import os
 import random as rand
+import sys
+import time
+from collections import deque, namedtuple
+from fractions import Fraction
+from functools import lru_cache
 
 # Stores TETROMINO_COLORS used for each of the 7 Tetrominoes
 TETROMINO_COLORS = [
@@ -22,13 +31,99 @@ GRID_GREY = (170, 170, 170)
 DEAD_SQUARE_GREY = (120, 120, 120)
 YELLOW = (200, 200, 0)
 
-PIECE_LOCK = pygame.USEREVENT + 1
-DAS_LEFT = pygame.USEREVENT + 2
-DAS_RIGHT = pygame.USEREVENT + 3
+# Simulation ticks per second. The pygame front end runs them off a monotonic clock with TickScheduler.
+FPS = 60
+
+# Input bit flags used by Tetris.step(). Each flag is a key of the pygame front end.
+INPUT_MOVE_LEFT = 1 << 0   # A
+INPUT_MOVE_RIGHT = 1 << 1  # D
+INPUT_ROTATE_CCW = 1 << 2  # J
+INPUT_ROTATE_180 = 1 << 3  # K
+INPUT_ROTATE_CW = 1 << 4   # L
+INPUT_HARD_DROP = 1 << 5   # S
+INPUT_SOFT_DROP = 1 << 6   # Left Shift
+INPUT_HOLD = 1 << 7        # Slash
+
+debug = False
+
+class SevenBagRandomizer:
+    '''A seeded 7-bag piece stream. Every bag is worked out from the seed and the bag's index alone, so any
+    point in the stream can be reached without dealing the pieces before it.'''
+
+    __slots__ = ("seed", "seed_key", "window", "position", "bags_dealt")
+
+    MASK_64 = (1 << 64) - 1
+
+    def __init__(self, seed = None):
+        '''Creates a piece stream from "seed", an integer. A random seed is picked if it's None.'''
+
+        if seed == None:
+            seed = rand.getrandbits(64)
+
+        self.seed = seed
+        self.seed_key = SevenBagRandomizer.splitmix64(seed & SevenBagRandomizer.MASK_64)
+
+        # The upcoming pieces, starting with piece number self.position.
+        self.window = deque()
+        self.position = 0
+        self.bags_dealt = 0
+
+    @staticmethod
+    def splitmix64(value):
+        '''Mixes a 64-bit integer into another one. Used as a stateless random number generator.'''
+
+        value = (value + 0x9E3779B97F4A7C15) & SevenBagRandomizer.MASK_64
+        value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & SevenBagRandomizer.MASK_64
+        value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & SevenBagRandomizer.MASK_64
+        return(value ^ (value >> 31))
+
+    def bag(self, bag_index):
+        '''Returns bag number "bag_index" of the stream, a shuffled list of the 7 piece types.'''
+
+        value = SevenBagRandomizer.splitmix64(self.seed_key ^ bag_index)
+        bag = [0, 1, 2, 3, 4, 5, 6]
+
+        # Fisher-Yates shuffle, taking each swap from the next digit of the value in the factorial number system.
+        for i in range(6, 0, -1):
+            value, j = divmod(value, i + 1)
+            bag[i], bag[j] = bag[j], bag[i]
+
+        return(bag)
+
+    def fill(self, count):
+        '''Deals whole bags into the window until it holds at least "count" pieces.'''
+
+        while len(self.window) < count:
+            self.window.extend(self.bag(self.bags_dealt))
+            self.bags_dealt += 1
+
+    def peek(self, count = 5):
+        '''Returns the next "count" pieces without removing them.'''
+
+        self.fill(count)
+        return([self.window[i] for i in range(count)])
+
+    def next_piece(self):
+        '''Removes the next piece from the stream and returns it. Keeps at least 5 pieces in the window for the preview.'''
+
+        self.fill(6)
+        self.position += 1
+        return(self.window.popleft())
+
+    def seek(self, position):
+        '''Jumps to piece number "position" of the stream, so it becomes the next piece dealt.'''
+
+        bag_index, offset = divmod(position, 7)
+        self.window.clear()
+        self.window.extend(self.bag(bag_index)[offset:])
+        self.bags_dealt = bag_index + 1
+        self.position = position
 
 class Tetromino:
     '''A Tetris piece.'''
-    
+
+    __slots__ = ("game", "type", "x", "y", "rotation", "move_reset_counter")
+
     # Each row is a different piece, each column is a different rotation.
     # The numbers represent the spaces each figure occupies on a 5x5 grid (I piece)
     # or a 3x3 grid (every other piece)
@@ -41,7 +136,7 @@ class Tetromino:
             [[1, 3, 4, 5], [1, 4, 5, 7], [3, 4, 5, 7], [1, 3, 4, 7]], # T
             [[0, 1, 4, 5], [2, 4, 5, 7], [3, 4, 7, 8], [1, 3, 4, 6]]  # Z
     ]
-    
+
     # SRS Offset Data table
     JLSTZ_OFFSET_DATA = [
             [[0, 0], [0, 0], [0, 0], [0, 0], [0, 0]],
@@ -49,7 +144,7 @@ class Tetromino:
             [[0, 0], [0, 0], [0, 0], [0, 0], [0, 0]],
             [[0, 0], [-1, 0], [-1, -1], [0, 2], [-1, 2]]
     ]
-    
+
     # SRS Offset Data table
     I_OFFSET_DATA = [
             [[0, 0], [-1, 0], [2, 0], [-1, 0], [2, 0]],
@@ -57,107 +152,238 @@ class Tetromino:
             [[-1, 1], [1, 1], [-2, 1], [1, 0], [-2, 0]],
             [[0, 1], [0, 1], [0, 1], [0, -1], [0, 2]]
     ]
-    
+
     # SRS Offset Data table
     O_OFFSET_DATA = [
             [0, 0],
             [0, -1],
-            [-1, -1], 
+            [-1, -1],
             [-1, 0],
     ]
-    
-    def __init__(self, source):
-        '''Spawns a Tetromino. "source" is either "Hold" or "Queue", which represent where the Tetromino is coming from.'''
-            
+
+    def __init__(self, game, source):
+        '''Spawns a Tetromino into "game". "source" is either "Hold" or "Queue", which represent where the Tetromino is coming from.'''
+
+        self.game = game
+
         if source == "Queue":
             self.type = game.advance_piece_queue()
-            
+
         elif source == "Hold":
             if game.piece_held == None:
                 self.type = game.advance_piece_queue()
             else:
                 self.type = game.piece_held
-                
-        self.x = 3
-        self.y = 1
+
+        self.x, self.y = Tetromino.spawn_position(self.type, game.matrix_width)
         self.rotation = 0
-        
-        if self.type == 0:
-            self.x -= 1
-            self.y -= 1
-            
-        pygame.time.set_timer(PIECE_LOCK, 0)
+
         self.move_reset_counter = 0
         game.lock_delay = False
-        
+        game.lock_timer = 0
+
         if debug:
             print("initialized new Tetromino")
-        
+
+    @staticmethod
+    def spawn_position(piece_type, matrix_width = 10):
+        '''Returns the X and Y position a piece of the given type spawns at, centered in a matrix "matrix_width" columns wide.'''
+
+        x = (matrix_width - 3) // 2
+        y = 1
+
+        if piece_type == 0:
+            x -= 1
+            y -= 1
+
+        return(x, y)
+
     def image(self, rotation_difference = 0):
         '''Returns the piece's shape and orientation. Allows for images to be made with non-true rotations for SRS.'''
-        
+
         return Tetromino.FIGURES[self.type][(self.rotation + rotation_difference) % 4]
-    
+
     def rotate(self, rotation_distance):
         '''Rotates the current active piece using the Super Rotation System.'''
 
+        game = self.game
+        new_rotation = (self.rotation + rotation_distance) % 4
+
+        # The offsets of each kick test, in both the current and the new rotation. The O piece has a single test.
         if self.type == 0:
-            self.new_rotation = (self.rotation + rotation_distance) % 4
-            
-            for i in range(5):
-                (self.previous_offset_x, self.previous_offset_y) = Tetromino.I_OFFSET_DATA[self.rotation][i]
-                self.new_offset_x, self.new_offset_y = Tetromino.I_OFFSET_DATA[self.new_rotation][i]
-                self.x_difference = self.previous_offset_x - self.new_offset_x
-                self.y_difference = self.previous_offset_y - self.new_offset_y
-                
-                if not game.intersects(self.x_difference, self.y_difference, rotation_distance):
-                    self.rotation = self.new_rotation
-                    self.x += self.x_difference
-                    self.y -= self.y_difference
-                    break
-                
+            previous_offsets, new_offsets = Tetromino.I_OFFSET_DATA[self.rotation], Tetromino.I_OFFSET_DATA[new_rotation]
+
         elif self.type == 3:
-            
-            (self.previous_offset_x, self.previous_offset_y) = Tetromino.O_OFFSET_DATA[self.rotation]
-            self.new_rotation = (self.rotation + rotation_distance) % 4
-            (self.new_offset_x, self.new_offset_y) = Tetromino.O_OFFSET_DATA[self.new_rotation]
-            self.x_difference = self.previous_offset_x - self.new_offset_x
-            self.y_difference = self.previous_offset_y - self.new_offset_y
-            
-            if not game.intersects(self.x_difference, self.y_difference, rotation_distance):
-                self.rotation = self.new_rotation
-                self.x += self.x_difference
-                self.y -= self.y_difference
-                
+            previous_offsets, new_offsets = [Tetromino.O_OFFSET_DATA[self.rotation]], [Tetromino.O_OFFSET_DATA[new_rotation]]
+
         else:
-            
-            self.new_rotation = (self.rotation + rotation_distance) % 4
-            
-            for i in range(5):
-                (self.previous_offset_x, self.previous_offset_y) = Tetromino.JLSTZ_OFFSET_DATA[self.rotation][i]
-                self.new_offset_x, self.new_offset_y = Tetromino.JLSTZ_OFFSET_DATA[self.new_rotation][i]
-                self.x_difference = self.previous_offset_x - self.new_offset_x
-                self.y_difference = self.previous_offset_y - self.new_offset_y
-                
-                if not game.intersects(self.x_difference, self.y_difference, rotation_distance):
-                    self.rotation = self.new_rotation
-                    self.x += self.x_difference
-                    self.y -= self.y_difference
-                    break
-                
+            previous_offsets, new_offsets = Tetromino.JLSTZ_OFFSET_DATA[self.rotation], Tetromino.JLSTZ_OFFSET_DATA[new_rotation]
+
+        for (previous_offset_x, previous_offset_y), (new_offset_x, new_offset_y) in zip(previous_offsets, new_offsets):
+            x_difference = previous_offset_x - new_offset_x
+            y_difference = previous_offset_y - new_offset_y
+
+            if not game.intersects(x_difference, y_difference, rotation_distance):
+                self.rotation = new_rotation
+                self.x += x_difference
+                self.y -= y_difference
+                break
+
         if game.lock_delay == True:
             self.move_reset_counter += 1
-            pygame.time.set_timer(PIECE_LOCK, 500)
+            game.lock_timer = Tetris.LOCK_DELAY_TICKS
+
+def build_figure_cells(figures = None):
+    '''Precomputes the cells of every figure of "figures" (Tetromino.FIGURES if None) as offsets within its grid.
+
+    Returns cells[type][rotation], a tuple of the (row, column) of each cell, in the order the figure lists them.'''
+
+    return(tuple(tuple(tuple(divmod(cell, 5 if piece_type == 0 else 3) for cell in figure) for figure in figure_rotations)
+                 for piece_type, figure_rotations in enumerate(figures or Tetromino.FIGURES)))
+
+def build_piece_row_masks(matrix_width, margin = 4, figure_cells = None):
+    '''Precomputes the collision masks used by the bitboard field backend, for the figures in "figure_cells" (from
+    build_figure_cells(), the built-in figures if None).
+
+    Returns masks[type][rotation][x + margin], a tuple of (row, bitmask) pairs giving the cells the
+    figure covers in each of its rows when its grid sits at column x. Bit j of a mask is column j of the matrix.
+    The entry is None when part of the figure would be outside the matrix at that x.'''
+
+    masks = []
+    for figure_rotations in figure_cells or build_figure_cells():
+        type_masks = []
+        for figure in figure_rotations:
+            rotation_masks = []
+            for x in range(-margin, matrix_width):
+                rows = {}
+                inside = True
+                for row, column in figure:
+                    if not 0 <= x + column < matrix_width:
+                        inside = False
+                        break
+                    rows[row] = rows.get(row, 0) | 1 << (x + column)
+
+                rotation_masks.append(tuple(sorted(rows.items())) if inside else None)
+            type_masks.append(rotation_masks)
+        masks.append(type_masks)
+
+    return(masks)
+
+def build_piece_bottoms(figure_cells = None):
+    '''Precomputes the bottom profile of every figure in "figure_cells" (from build_figure_cells(), the built-in
+    figures if None), used to find drop distances from the column height map.
+
+    Returns bottoms[type][rotation], a tuple of (column, row) pairs giving the lowest cell of the figure in each column of its grid.'''
+
+    bottoms = []
+    for figure_rotations in figure_cells or build_figure_cells():
+        type_bottoms = []
+        for figure in figure_rotations:
+            columns = {}
+            for row, column in figure:
+                columns[column] = max(columns.get(column, row), row)
+
+            type_bottoms.append(tuple(sorted(columns.items())))
+        bottoms.append(type_bottoms)
+
+    return(bottoms)
+
+# Collision masks of the bitboard field backend by matrix width, built the first time a game of that width is made.
+PIECE_ROW_MASKS = {}
+
+# Functions that rebuild tables other modules work out from the engine's, called by tetris_rules.apply_ruleset() once
+# it has replaced the engine's tables. See register_table_rebuilder().
+TABLE_REBUILDERS = []
+
+def register_table_rebuilder(rebuild):
+    '''Registers "rebuild" to be called with no arguments whenever a ruleset replaces the engine's tables. Returns it,
+    so it can be used as a decorator.'''
+
+    TABLE_REBUILDERS.append(rebuild)
+    return(rebuild)
+
+def ms_to_ticks(milliseconds):
+    '''Converts a length of time in milliseconds to the nearest whole number of ticks.'''
+
+    return(round(milliseconds * FPS / 1000))
+
+def build_gravity_steps(gravities):
+    '''Converts a gravity table of [ticks per fall, rows per fall] rows into exact rows per tick, over one common denominator.
+
+    Returns the denominator and a list of each row's rows per tick multiplied by it, so gravity can be added up in integers.'''
+
+    rates = [Fraction(distance) / Fraction(period) for period, distance in gravities]
+    denominator = math.lcm(*[rate.denominator for rate in rates])
+
+    return(denominator, [int(rate * denominator) for rate in rates])
+
+@lru_cache(maxsize=None)
+def build_zobrist_keys(matrix_width, matrix_height, seed = 0x5A0B):
+    '''Picks random 64-bit keys for hashing a matrix, from a fixed seed so hashes are the same in every process.
+
+    Returns a key for every column and one for every row. A row's contents are hashed by XORing the keys of its
+    filled columns, and mixed with its row's key to place it (see Tetris.row_key()). Moving a row then only takes
+    mixing its hash with the keys of the rows it moves between, however wide the matrix is.'''
+
+    column_keys = [SevenBagRandomizer.splitmix64(seed * 0x100000 + j) for j in range(matrix_width)]
+    row_keys = [SevenBagRandomizer.splitmix64(~(seed * 0x100000 + i) & SevenBagRandomizer.MASK_64) for i in range(matrix_height)]
+
+    return(column_keys, row_keys)
+
+def count_row_transitions(bits, matrix_width):
+    '''Returns the number of filled/empty transitions along a row from its row bits.
+
+    The walls count as filled cells. Empty rows count as having none, so only the stack's rows add to the total.'''
+
+    if bits == 0:
+        return(0)
+
+    padded = bits << 1 | 1 | 1 << (matrix_width + 1)
+    return(((padded ^ padded >> 1) & ((1 << (matrix_width + 1)) - 1)).bit_count())
+
+@lru_cache(maxsize=None)
+def build_near_complete_rows(matrix_width, empty_cells):
+    '''Returns 1 for every number of filled cells that leaves a row at most "empty_cells" short of full, and 0 otherwise.'''
+
+    return([1 if 0 < matrix_width - fill <= empty_cells else 0 for fill in range(matrix_width + 1)])
+
+# Everything Tetris.snapshot() captures. "values" holds the attributes in Tetris.SNAPSHOT_ATTRIBUTES, "field" the
+# matrix rows (shared with the game until it writes to them), and "piece" and "randomizer" the active piece and piece stream.
+TetrisSnapshot = namedtuple("TetrisSnapshot", ["values", "field", "row_fill", "row_bits", "column_tops", "row_hashes", "features", "piece", "randomizer"])
+
+# What Tetris.features() returns. "column_heights" and "well_depths" have one entry per column, left to right.
+BoardFeatures = namedtuple("BoardFeatures", ["column_heights", "holes", "covered_cells", "bumpiness", "row_transitions",
+                                             "column_transitions", "well_depths", "near_complete_rows"])
 
 class Tetris:
-    '''A game of Tetris.'''
-    
+    '''A game of Tetris. Runs headless; advance it with step() or tick().'''
+
+    __slots__ = ("matrix_width", "matrix_height", "piece_row_masks", "near_complete_fills", "zobrist_column_keys", "zobrist_row_keys",
+                 "score", "level", "total_lines_cleared", "active_piece", "piece_held", "hold_used", "lock_delay", "lock_timer",
+                 "current_frame", "gravity_progress", "held_inputs", "hard_dropping", "soft_dropping", "do_das_left", "do_das_right",
+                 "das_left_timer", "das_right_timer", "arr_timer", "das_ticks", "arr_ticks", "field", "row_fill", "last_line_clear",
+                 "last_placement", "column_tops", "row_hashes", "field_hash", "column_bits", "column_holes", "column_covered", "row_transitions",
+                 "vertical_transitions", "near_complete_rows", "ghost_key", "ghost_y", "row_bits", "randomizer", "queue", "game_active")
+
+    # Attributes holding plain values, which snapshot() and restore() copy as they are.
+    SNAPSHOT_ATTRIBUTES = ("score", "level", "total_lines_cleared", "piece_held", "hold_used", "lock_delay", "lock_timer",
+                           "current_frame", "gravity_progress", "held_inputs", "hard_dropping", "soft_dropping", "do_das_left",
+                           "do_das_right", "das_left_timer", "das_right_timer", "arr_timer", "das_ticks", "arr_ticks",
+                           "last_line_clear", "last_placement", "field_hash", "near_complete_rows", "ghost_key", "ghost_y", "game_active")
+    get_snapshot_values = operator.attrgetter(*SNAPSHOT_ATTRIBUTES)
+
     MATRIX_WIDTH = 10
     MATRIX_HEIGHT = 20
     MATRIX_X_OFFSET = 5
     MATRIX_Y_OFFSET = 1.5
     GAME_ZOOM = 20
-    
+
+    # Timings, counted in simulation ticks (FPS ticks per second).
+    LOCK_DELAY_TICKS = 30 # 500ms
+    MOVE_RESET_LIMIT = 15
+    DAS_TICKS = 8 # 133ms
+    ARR_TICKS = 2 # 33ms, 0 moves the piece to the wall at once
+
     # The gravity values used. Left column is the amount of frames it takes a piece to fall,
     # right column is the distance it falls. Each row represents a different level.
     GRAVITIES = [
@@ -176,82 +402,526 @@ class Tetris:
         [1, 1],
         [0.5, 2],
                 ]
-    
-    def __init__(self):
-        '''Initializes the game.'''
-        
+
+    # Gravity in rows per tick for each level, as multiples of 1 / GRAVITY_DENOMINATOR. Levels past the end of the table use its last row.
+    GRAVITY_DENOMINATOR, GRAVITY_STEPS = build_gravity_steps(GRAVITIES)
+
+    # How far outside the matrix the collision masks of the bitboard field backend reach. See build_piece_row_masks().
+    PIECE_MASK_MARGIN = 4
+
+    # The (row, column) of each cell of every figure within its grid, indexed [type][rotation].
+    FIGURE_CELLS = build_figure_cells()
+
+    # Key of the ruleset applied with tetris_rules.apply_ruleset(), or None while the built-in tables are in use.
+    RULESET_KEY = None
+
+    # Lowest cell of each figure per column, indexed [type][rotation].
+    PIECE_BOTTOMS = build_piece_bottoms(FIGURE_CELLS)
+
+    # Zobrist keys for hashing positions. The matrix's keys depend on its size (see build_zobrist_keys()).
+    # The piece and hold keys are indexed by type, with index 7 standing for no piece.
+    ZOBRIST_PIECE_KEYS = [SevenBagRandomizer.splitmix64(0xA11CE + i) for i in range(8)]
+    ZOBRIST_HOLD_KEYS = [SevenBagRandomizer.splitmix64(0xB0B + i) for i in range(8)]
+    ZOBRIST_HOLD_USED_KEY = SevenBagRandomizer.splitmix64(0xC0DE)
+
+    # A row is near complete when it's missing at most this many cells.
+    NEAR_COMPLETE_EMPTY_CELLS = 2
+
+    # Cell value of garbage rows added by insert_garbage(), drawn grey. 1-7 are the pieces' types + 1.
+    GARBAGE_CELL = 8
+
+
+    def __init__(self, field_backend = "list", seed = None, matrix_width = MATRIX_WIDTH, matrix_height = MATRIX_HEIGHT):
+        '''Initializes the game. "field_backend" is either "list" or "bitboard", which picks how collisions are checked.
+
+        Both backends keep self.field as the cell-value view used for rendering. The bitboard backend also
+        stores every row as an integer in self.row_bits, where bit j is set if column j is filled.
+        "seed" seeds the game's SevenBagRandomizer. A random seed is picked if it's None.
+
+        "matrix_width" and "matrix_height" set the size of the matrix. Moves, drops and line clears cost about the same
+        on any size, since they only look at the rows and columns the piece covers or moves.'''
+
+        if matrix_width < 4 or matrix_height < 4:
+            raise ValueError(f"matrix too small: {matrix_width}x{matrix_height}")
+
+        self.matrix_width = matrix_width
+        self.matrix_height = matrix_height
+
+        # Tables that depend on the matrix size, shared by every game of that size.
+        self.piece_row_masks = PIECE_ROW_MASKS.get(matrix_width)
+        if self.piece_row_masks == None:
+            self.piece_row_masks = PIECE_ROW_MASKS[matrix_width] = build_piece_row_masks(matrix_width, Tetris.PIECE_MASK_MARGIN, Tetris.FIGURE_CELLS)
+        self.near_complete_fills = build_near_complete_rows(matrix_width, Tetris.NEAR_COMPLETE_EMPTY_CELLS)
+        self.zobrist_column_keys, self.zobrist_row_keys = build_zobrist_keys(matrix_width, matrix_height)
+
         # Game info - Stats
         self.score = 0
         self.level = 1
         self.total_lines_cleared = 0
-        
+
         # Game info - Other
         self.active_piece = None
         self.piece_held = None
         self.hold_used = False
         self.lock_delay = False
-        
+        self.lock_timer = 0
+        self.current_frame = 0
+
+        # Fraction of a row gravity has moved the piece since it last fell, in units of 1 / GRAVITY_DENOMINATOR.
+        self.gravity_progress = 0
+
         # User input info
+        self.held_inputs = 0
         self.hard_dropping = False
         self.soft_dropping = False
         self.do_das_left = False
         self.do_das_right = False
-        
+        self.das_left_timer = 0
+        self.das_right_timer = 0
+
+        # Ticks until the next auto-repeat move once DAS has charged. The DAS and ARR lengths can be changed per game.
+        self.arr_timer = 0
+        self.das_ticks = Tetris.DAS_TICKS
+        self.arr_ticks = Tetris.ARR_TICKS
+
         # Create matrix and set game state to active
-        self.field = [[0 for j in range(Tetris.MATRIX_WIDTH)] for i in range(Tetris.MATRIX_HEIGHT)]
-        self.queue = []
+        self.field = [[0 for j in range(self.matrix_width)] for i in range(self.matrix_height)]
+        self.row_fill = [0 for i in range(self.matrix_height)]
+        self.last_line_clear = None
+
+        # (type, x, y, rotation, hold used) of the last piece place_piece() locked, or None before the first one.
+        self.last_placement = None
+
+        # Row of the highest filled cell in each column, or MATRIX_HEIGHT if the column is empty.
+        self.column_tops = [self.matrix_height for j in range(self.matrix_width)]
+
+        # Zobrist hash of the filled cells, kept up to date by place_piece() and clear_lines(). See position_hash().
+        # row_hashes holds the hash of each row's contents, wherever the row is.
+        self.row_hashes = [0 for i in range(self.matrix_height)]
+        self.field_hash = 0
+
+        # Board features for evaluators, kept up to date by place_piece() and clear_lines(). See features().
+        # Bit i of each column's bits is set if row i is filled. vertical_transitions[i] counts the transitions between
+        # row i and the row below it, with the floor counting as a filled row.
+        self.column_bits = [0 for j in range(self.matrix_width)]
+        self.column_holes = [0 for j in range(self.matrix_width)]
+        self.column_covered = [0 for j in range(self.matrix_width)]
+        self.row_transitions = [0 for i in range(self.matrix_height)]
+        self.vertical_transitions = [0 for i in range(self.matrix_height - 1)] + [self.matrix_width]
+        self.near_complete_rows = 0
+
+        # The ghost piece's Y position, and the piece position it was found for.
+        self.ghost_key = None
+        self.ghost_y = 0
+        if field_backend == "bitboard":
+            self.row_bits = [0 for i in range(self.matrix_height)]
+        elif field_backend == "list":
+            self.row_bits = None
+        else:
+            raise ValueError(f"unknown field backend: {field_backend}")
+        self.randomizer = SevenBagRandomizer(seed)
+        self.queue = self.randomizer.window
         self.game_active = True
-    
+
     def call_rotation(self, rotation_distance):
         '''Ensures there is an active piece to rotate before calling the self.active_piece.rotate() function.'''
-        
-        try:
+
+        if self.active_piece != None:
             self.active_piece.rotate(rotation_distance)
-        except:
-            pass
-        
+
+    def load_field(self, field):
+        '''Replaces the matrix with a copy of "field", a list of rows of cell values, and rebuilds the row counters,
+        bitboard and column heights from it. Used to set up boards for testing and benchmarking.'''
+
+        self.field = [list(row) for row in field]
+        self.row_fill = [sum(1 for cell in row if cell != 0) for row in self.field]
+        if self.row_bits != None:
+            self.row_bits = [sum(1 << j for j in range(self.matrix_width) if row[j] != 0) for row in self.field]
+        self.column_tops = [next((i for i in range(self.matrix_height) if self.field[i][j] != 0), self.matrix_height)
+                            for j in range(self.matrix_width)]
+        self.row_hashes = [self.hash_row(self.row_mask(i)) for i in range(self.matrix_height)]
+        self.field_hash = self.compute_field_hash()
+        self.rebuild_features()
+        self.ghost_key = None
+
+    def row_mask(self, row):
+        '''Returns row "row" of the matrix as an integer, where bit j is set if column j is filled.'''
+
+        if self.row_bits != None:
+            return(self.row_bits[row])
+
+        return(sum(1 << j for j in range(self.matrix_width) if self.field[row][j] != 0))
+
+    def hash_row(self, bits):
+        '''Returns the hash of a row's contents from its row bits.'''
+
+        row_hash = 0
+        while bits:
+            row_hash ^= self.zobrist_column_keys[(bits & -bits).bit_length() - 1]
+            bits &= bits - 1
+
+        return(row_hash)
+
+    def row_key(self, row_hash, row):
+        '''Returns what a row with contents hashing to "row_hash" adds to the field hash at row "row". Empty rows add nothing.'''
+
+        if row_hash == 0:
+            return(0)
+
+        return(SevenBagRandomizer.splitmix64(row_hash ^ self.zobrist_row_keys[row]))
+
+    def compute_field_hash(self):
+        '''Hashes the matrix from scratch. Gives the same value self.field_hash is kept at.'''
+
+        field_hash = 0
+        for i in range(self.matrix_height):
+            field_hash ^= self.row_key(self.hash_row(self.row_mask(i)), i)
+
+        return(field_hash)
+
+    def hash_with_cells(self, cells):
+        '''Returns what self.field_hash would be with the empty (row, column) cells in "cells" filled, without filling them.'''
+
+        row_hashes = {}
+        for row, column in cells:
+            row_hashes[row] = row_hashes.get(row, self.row_hashes[row]) ^ self.zobrist_column_keys[column]
+
+        field_hash = self.field_hash
+        for row, row_hash in row_hashes.items():
+            field_hash ^= self.row_key(self.row_hashes[row], row) ^ self.row_key(row_hash, row)
+
+        return(field_hash)
+
+    def rebuild_features(self):
+        '''Recounts every board feature from the matrix.'''
+
+        self.column_bits = [sum(1 << i for i in range(self.matrix_height) if self.field[i][j] != 0) for j in range(self.matrix_width)]
+        self.column_holes = [0 for j in range(self.matrix_width)]
+        self.column_covered = [0 for j in range(self.matrix_width)]
+        self.row_transitions = [0 for i in range(self.matrix_height)]
+        self.vertical_transitions = [0 for i in range(self.matrix_height)]
+        self.near_complete_rows = sum(self.near_complete_fills[fill] for fill in self.row_fill)
+        self.update_features(range(self.matrix_height), range(self.matrix_width))
+
+    def update_features(self, rows, columns):
+        '''Recounts the transitions of the given rows and the holes and covered cells of the given columns, after they've changed.'''
+
+        full_row = (1 << self.matrix_width) - 1
+        for i in rows:
+            row_mask = self.row_mask(i)
+            self.row_transitions[i] = count_row_transitions(row_mask, self.matrix_width)
+            self.vertical_transitions[i] = (row_mask ^ (full_row if i == self.matrix_height - 1 else self.row_mask(i + 1))).bit_count()
+            if i > 0:
+                self.vertical_transitions[i - 1] = (self.row_mask(i - 1) ^ row_mask).bit_count()
+
+        # A hole is an empty cell below the column's top, and a covered cell is a filled cell above the column's lowest hole.
+        for j in columns:
+            bits = self.column_bits[j]
+            holes = ~bits & ((1 << self.matrix_height) - (1 << self.column_tops[j]))
+            self.column_holes[j] = holes.bit_count()
+            self.column_covered[j] = (bits & ((1 << (holes.bit_length() - 1)) - 1)).bit_count() if holes else 0
+
+    def features(self):
+        '''Returns the board's features as a BoardFeatures: column heights, holes, covered cells, bumpiness, row and column
+        transitions, well depths and near-complete rows.
+
+        Only adds up per-row and per-column counts kept by place_piece() and clear_lines(), so the matrix is never scanned.
+        tetris_features.placement_features() works out the same features for many candidate placements at once.'''
+
+        heights = [self.matrix_height - top for top in self.column_tops]
+
+        # The walls count as full-height columns for wells.
+        walled_heights = [self.matrix_height] + heights + [self.matrix_height]
+        wells = [max(0, min(walled_heights[j], walled_heights[j + 2]) - walled_heights[j + 1]) for j in range(self.matrix_width)]
+
+        return(BoardFeatures(
+            tuple(heights),
+            sum(self.column_holes),
+            sum(self.column_covered),
+            sum(abs(heights[j] - heights[j + 1]) for j in range(self.matrix_width - 1)),
+            sum(self.row_transitions),
+            sum(self.vertical_transitions),
+            tuple(wells),
+            self.near_complete_rows,
+        ))
+
+    def position_hash(self):
+        '''Returns a 64-bit hash of the matrix, the active piece's type, the held piece and whether hold has been used.
+
+        Costs a few XORs, since the matrix's part is kept up to date as pieces are placed and lines are cleared.'''
+
+        return(self.field_hash
+               ^ Tetris.ZOBRIST_PIECE_KEYS[7 if self.active_piece == None else self.active_piece.type]
+               ^ Tetris.ZOBRIST_HOLD_KEYS[7 if self.piece_held == None else self.piece_held]
+               ^ (Tetris.ZOBRIST_HOLD_USED_KEY if self.hold_used else 0))
+
+    def snapshot(self):
+        '''Returns the game's state as an immutable TetrisSnapshot, to go back to later with restore().
+
+        Costs about the same whatever the board looks like. The matrix rows are shared with the snapshot instead of copied,
+        and place_piece() copies a row before changing it.'''
+
+        piece = self.active_piece
+        randomizer = self.randomizer
+
+        return(TetrisSnapshot(
+            Tetris.get_snapshot_values(self),
+            tuple(self.field),
+            tuple(self.row_fill),
+            None if self.row_bits == None else tuple(self.row_bits),
+            tuple(self.column_tops),
+            tuple(self.row_hashes),
+            (tuple(self.column_bits), tuple(self.column_holes), tuple(self.column_covered), tuple(self.row_transitions),
+             tuple(self.vertical_transitions)),
+            None if piece == None else (piece.type, piece.x, piece.y, piece.rotation, piece.move_reset_counter),
+            (randomizer.seed, randomizer.seed_key, randomizer.position, randomizer.bags_dealt, tuple(randomizer.window)),
+        ))
+
+    def restore(self, snapshot):
+        '''Puts the game back to the state in "snapshot", which can come from this game or any other of the same size.'''
+
+        for name, value in zip(Tetris.SNAPSHOT_ATTRIBUTES, snapshot.values):
+            setattr(self, name, value)
+
+        self.field = list(snapshot.field)
+        self.row_fill = list(snapshot.row_fill)
+        self.row_bits = None if snapshot.row_bits == None else list(snapshot.row_bits)
+        self.column_tops = list(snapshot.column_tops)
+        self.row_hashes = list(snapshot.row_hashes)
+        self.column_bits, self.column_holes, self.column_covered, self.row_transitions, self.vertical_transitions = [
+            list(values) for values in snapshot.features]
+
+        if snapshot.piece == None:
+            self.active_piece = None
+        else:
+            piece = Tetromino.__new__(Tetromino)
+            piece.game = self
+            piece.type, piece.x, piece.y, piece.rotation, piece.move_reset_counter = snapshot.piece
+            self.active_piece = piece
+
+        # The queue is the randomizer's window, so the same deque is refilled rather than replaced.
+        randomizer = self.randomizer
+        randomizer.seed, randomizer.seed_key, randomizer.position, randomizer.bags_dealt, window = snapshot.randomizer
+        randomizer.window.clear()
+        randomizer.window.extend(window)
+
     def __str__(self):
         '''Returns the matrix as a string for testing purposes.'''
 
         stringed_field = ''
-        for i in range(Tetris.MATRIX_HEIGHT):
-            for j in range(Tetris.MATRIX_WIDTH):
+        for i in range(self.matrix_height):
+            for j in range(self.matrix_width):
                 stringed_field += str(self.field[i][j])
             stringed_field += "\n"
-                           
+
         return(f"{stringed_field}")
-            
+
+    def step(self, inputs = 0):
+        '''Advances the game by one tick. "inputs" is the bitmask of INPUT_* keys held down during this tick.
+
+        Returns the line clear from clear_lines() if a piece locked during this tick, otherwise None.'''
+
+        self.last_line_clear = None
+        if not self.game_active:
+            return(None)
+
+        # Stores the current frame and level.
+        self.current_frame = (self.current_frame + 1) % FPS
+        self.level = 1 + self.total_lines_cleared // 10
+
+        if self.active_piece == None:
+            self.active_piece = Tetromino(self, "Queue")
+
+        self.apply_gravity()
+        self.handle_inputs(inputs)
+        self.update_timers()
+        self.apply_auto_repeat()
+        self.check_game_over()
+
+        return(self.last_line_clear)
+
+    def apply_gravity(self):
+        '''Adds the current level's gravity for one tick and moves the active piece down by every whole row it has built up.
+
+        Gravity adds up exactly in fractions of a row, so every level falls at the rate in GRAVITIES, including
+        periods that don't divide FPS and the 0.5 tick period.'''
+
+        gravity_row = min(self.level, len(Tetris.GRAVITY_STEPS)) - 1
+        rows, self.gravity_progress = divmod(self.gravity_progress + Tetris.GRAVITY_STEPS[gravity_row], Tetris.GRAVITY_DENOMINATOR)
+        for i in range(rows):
+            self.move_piece_down()
+
+    def apply_auto_repeat(self):
+        '''Moves the active piece for held keys: down while soft dropping, and sideways once DAS has charged.'''
+
+        if self.soft_dropping == True:
+            self.move_piece_down()
+
+        # The first repeat comes on the tick DAS charges, then one every arr_ticks ticks.
+        if self.do_das_right or self.do_das_left:
+            if self.arr_timer > 0:
+                self.arr_timer -= 1
+
+            if self.arr_timer == 0:
+                self.arr_timer = self.arr_ticks
+                dx = 1 if self.do_das_right else -1
+                if self.arr_ticks > 0:
+                    self.move_piece_h(dx)
+                else:
+                    self.shift_piece_to_wall(dx)
+
+    def check_game_over(self):
+        '''Ends the game if the active piece overlaps the stack. Runs after everything else in a tick.'''
+
+        if self.intersects():
+            if debug:
+                print("game over")
+            self.game_active = False
+
+    def tick(self):
+        '''Advances the game by one tick without changing which keys are held.'''
+
+        return(self.step(self.held_inputs))
+
+    def handle_inputs(self, inputs):
+        '''Applies the keys pressed and released since the previous tick.'''
+
+        pressed = inputs & ~self.held_inputs
+        released = self.held_inputs & ~inputs
+        self.held_inputs = inputs
+
+        if pressed & INPUT_SOFT_DROP:
+            self.soft_dropping = True
+
+        # Left and right movement
+        if pressed & INPUT_MOVE_LEFT:
+            self.move_piece_h(-1)
+            self.das_left_timer = self.das_ticks
+            self.do_das_right = False
+        if pressed & INPUT_MOVE_RIGHT:
+            self.move_piece_h(1)
+            self.das_right_timer = self.das_ticks
+            self.do_das_left = False
+
+        # Inputs for piece rotation
+        if pressed & INPUT_ROTATE_CCW:
+            self.call_rotation(-1)
+        if pressed & INPUT_ROTATE_180:
+            self.call_rotation(2)
+        if pressed & INPUT_ROTATE_CW:
+            self.call_rotation(1)
+
+        if pressed & INPUT_HOLD:
+            self.hold_piece()
+        if pressed & INPUT_HARD_DROP:
+            self.hard_drop()
+
+        # Checks for a key non-input so the game knows when to stop soft-dropping / DASing.
+        if released & INPUT_SOFT_DROP:
+            self.soft_dropping = False
+        if released & INPUT_MOVE_LEFT:
+            self.das_left_timer = 0
+            self.do_das_left = False
+        if released & INPUT_MOVE_RIGHT:
+            self.das_right_timer = 0
+            self.do_das_right = False
+
+    def update_timers(self):
+        '''Counts down the piece lock and DAS timers by one tick, acting on any that run out.'''
+
+        # Places a piece if the Piece Lock timer runs out. Keeps the timer running if the piece can't be placed yet.
+        if self.lock_delay:
+            self.lock_timer -= 1
+            if self.lock_timer <= 0:
+                if debug:
+                    print("piece lock timer ran out")
+                self.lock_timer = Tetris.LOCK_DELAY_TICKS
+                self.place_piece()
+
+        # If left or right movement keys have been held without interruption for long enough, enable repeated left/right movement
+        if self.das_left_timer > 0:
+            self.das_left_timer -= 1
+            if self.das_left_timer == 0:
+                self.do_das_left = True
+                self.das_right_timer = 0
+                self.arr_timer = 0
+
+        if self.das_right_timer > 0:
+            self.das_right_timer -= 1
+            if self.das_right_timer == 0:
+                self.do_das_right = True
+                self.das_left_timer = 0
+                self.arr_timer = 0
+
     def advance_piece_queue(self):
         '''Refills queue if needed, then removes the first item in the queue and returns it.'''
-        
-        if len(self.queue) < 6:
-            bag = [0, 1, 2, 3, 4, 5, 6]
-            rand.shuffle(bag)
-            self.queue += bag
-    
-        new_piece = self.queue[0]
-        self.queue.pop(0)
-        return(new_piece)
-    
-    def clear_lines(self):
-        '''Clears any row where all spaces are non-empty. Shifts contents of all rows above cleared line down one row.'''
-        
+
+        return(self.randomizer.next_piece())
+
+    def clear_lines(self, rows = None):
+        '''Clears any full row out of "rows" (every row if None). Moves the rows above the cleared lines down in one pass.
+
+        Returns the line clear as a tuple of the cleared row indices, top to bottom, and the number of lines cleared.'''
+
         if debug:
             print("Tetris.clear_lines() called")
-            
-        lines = 0
-        for i in range(Tetris.MATRIX_HEIGHT):
-            if 0 not in self.field[i]:
-                lines += 1
-                self.total_lines_cleared += 1
-                for i1 in range(i, 1, -1):
-                    for j in range(Tetris.MATRIX_WIDTH):
-                        self.field[i1][j] = self.field[i1 - 1][j]
-
-                self.field[0] = [0 for i in range(Tetris.MATRIX_WIDTH)]
-        
+
+        if rows == None:
+            rows = range(self.matrix_height)
+
+        # Only the per-row filled-cell counters are checked, so the rows themselves are never scanned.
+        cleared_rows = sorted(i for i in set(rows) if self.row_fill[i] == self.matrix_width)
+        lines = len(cleared_rows)
+
+        if lines > 0:
+            self.total_lines_cleared += lines
+
+            # The cleared rows are taken out of the hash, and each row that moves is rehashed at its new row below.
+            for i in cleared_rows:
+                self.field_hash ^= self.row_key(self.row_hashes[i], i)
+
+            # Compacts the matrix from the lowest cleared row upwards, moving row references instead of cells.
+            # Every row above an empty row is empty too, so compaction stops at the first empty row it reaches.
+            write = cleared_rows[-1]
+            read = write - 1
+            while read >= 0 and self.row_fill[read] > 0:
+                if read not in cleared_rows:
+                    self.field_hash ^= self.row_key(self.row_hashes[read], read) ^ self.row_key(self.row_hashes[read], write)
+                    self.row_hashes[write] = self.row_hashes[read]
+                    self.field[write] = self.field[read]
+                    self.row_fill[write] = self.row_fill[read]
+                    if self.row_bits != None:
+                        self.row_bits[write] = self.row_bits[read]
+                    write -= 1
+                read -= 1
+
+            # The rows left behind between the stack and the first empty row become empty.
+            for i in range(read + 1, write + 1):
+                self.field[i] = [0 for j in range(self.matrix_width)]
+                self.row_fill[i] = 0
+                self.row_hashes[i] = 0
+                if self.row_bits != None:
+                    self.row_bits[i] = 0
+
+            # Rows only ever move down, so each column's new top is found by scanning down from its old one.
+            for j in range(self.matrix_width):
+                top = self.column_tops[j]
+                while top < self.matrix_height and self.field[top][j] == 0:
+                    top += 1
+                self.column_tops[j] = top
+
+            # Takes the cleared rows out of each column's bits, top to bottom, moving the rows above each one down by one.
+            for i in cleared_rows:
+                above = (1 << i) - 1
+                for j in range(self.matrix_width):
+                    bits = self.column_bits[j]
+                    self.column_bits[j] = (bits & above) << 1 | bits >> (i + 1) << (i + 1)
+
+            # Only the rows from the first empty row down to the lowest cleared row have new neighbours below them.
+            self.update_features(range(max(read, 0), cleared_rows[-1] + 1), range(self.matrix_width))
+
         # Adds to the score based on how many lines were cleared.
-        match lines:                
+        match lines:
             case 1:
                 self.score += 100 * self.level
             case 2:
@@ -262,347 +932,440 @@ class Tetris:
                 self.score += 800 * self.level
             case _:
                 pass
-    
+
+        self.last_line_clear = (cleared_rows, lines)
+        return(self.last_line_clear)
+
+    def insert_garbage(self, hole_columns):
+        '''Pushes the matrix up by one row for each entry of "hole_columns", and fills the rows left at the bottom with
+        garbage: every cell but the one in that entry's column, top to bottom.
+
+        Rows are moved as references, like clear_lines(), rather than copied cell by cell. The game tops out if any
+        row pushed off the top wasn't empty. The active piece is pushed up if the garbage overlaps it, and the game tops
+        out if it can't be.'''
+
+        lines = min(len(hole_columns), self.matrix_height)
+        if lines == 0:
+            return
+
+        hole_columns = hole_columns[-lines:]
+        width = self.matrix_width
+        height = self.matrix_height
+        full_row = (1 << width) - 1
+
+        if any(self.row_fill[i] > 0 for i in range(lines)):
+            self.game_active = False
+
+        # Every filled row moves up, so it's rehashed at its new row. The rows pushed off the top are taken out.
+        top = min(self.column_tops)
+        for i in range(top, height):
+            row_hash = self.row_hashes[i]
+            self.field_hash ^= self.row_key(row_hash, i)
+            if i >= lines:
+                self.field_hash ^= self.row_key(row_hash, i - lines)
+        for i in range(lines):
+            self.near_complete_rows -= self.near_complete_fills[self.row_fill[i]]
+
+        garbage_bits = [full_row & ~(1 << hole_column) for hole_column in hole_columns]
+        garbage_hashes = [self.hash_row(bits) for bits in garbage_bits]
+        for k, row_hash in enumerate(garbage_hashes):
+            self.field_hash ^= self.row_key(row_hash, height - lines + k)
+
+        # Rows are never written to in place, so a garbage row can be shared by every row with the same hole.
+        garbage_rows = {}
+        for hole_column in hole_columns:
+            if hole_column not in garbage_rows:
+                garbage_rows[hole_column] = [Tetris.GARBAGE_CELL if j != hole_column else 0 for j in range(width)]
+
+        del self.field[:lines]
+        self.field.extend(garbage_rows[hole_column] for hole_column in hole_columns)
+        del self.row_fill[:lines]
+        self.row_fill.extend([width - 1] * lines)
+        del self.row_hashes[:lines]
+        self.row_hashes.extend(garbage_hashes)
+        if self.row_bits != None:
+            del self.row_bits[:lines]
+            self.row_bits.extend(garbage_bits)
+        del self.row_transitions[:lines]
+        self.row_transitions.extend([0] * lines)
+        del self.vertical_transitions[:lines]
+        self.vertical_transitions.extend([0] * lines)
+        self.near_complete_rows += self.near_complete_fills[width - 1] * lines
+
+        # Each column moves up by "lines" rows, with the garbage's cells added at the bottom.
+        for j in range(width):
+            garbage_column = sum(1 << (height - lines + k) for k, hole_column in enumerate(hole_columns) if hole_column != j)
+            bits = self.column_bits[j] >> lines | garbage_column
+            self.column_bits[j] = bits
+            self.column_tops[j] = (bits & -bits).bit_length() - 1 if bits else height
+
+        self.update_features(range(max(height - lines - 1, 0), height), range(width))
+        self.ghost_key = None
+
+        if self.active_piece != None:
+            for i in range(lines):
+                if not self.intersects():
+                    break
+                self.active_piece.y -= 1
+
+            if self.intersects():
+                self.game_active = False
+
     def hold_piece(self):
         '''Swaps the active piece with the piece in the hold space.'''
-        
+
         if self.active_piece != None and not self.hold_used:
             if debug:
                 print("Tetris.hold_piece() called")
-            
-            self.active_piece, self.piece_held = Tetromino("Hold"), self.active_piece.type
+
+            self.active_piece, self.piece_held = Tetromino(self, "Hold"), self.active_piece.type
             self.hold_used = True
             self.lock_delay = False
-            pygame.time.set_timer(PIECE_LOCK, 0)
-            
+            self.lock_timer = 0
+
     def place_piece(self):
-        '''Locks a Tetromino into place.'''
-        
+        '''Locks a Tetromino into place. Returns the resulting line clear from clear_lines(), or None if the piece wasn't placed.'''
+
         if debug:
                 print("Tetris.place_piece() called")
-        
+
         # Check to make sure the piece should be placed
-        if self.intersects(0, -1, 0) and self.game_active:
-            
+        if self.active_piece != None and self.intersects(0, -1, 0) and self.game_active:
+
             # Places each cell of the piece
-            self.piece_placement_scan_dimension = self.get_scan_dimension()
-            for i in range(self.piece_placement_scan_dimension):
-                for j in range(self.piece_placement_scan_dimension):
-                    if i * self.piece_placement_scan_dimension + j in self.active_piece.image():
-                        self.field[i + self.active_piece.y][j + self.active_piece.x] = self.active_piece.type + 1
-                                        
-            self.clear_lines()
-            
-            pygame.time.set_timer(PIECE_LOCK, 0)
+            touched_rows = []
+            touched_columns = []
+            previous_row_hashes = {}
+            for i, j in Tetris.FIGURE_CELLS[self.active_piece.type][self.active_piece.rotation]:
+
+                # Rows can be shared with snapshots, so a row is copied before it's written to.
+                if i + self.active_piece.y not in touched_rows:
+                    self.field[i + self.active_piece.y] = list(self.field[i + self.active_piece.y])
+
+                if self.field[i + self.active_piece.y][j + self.active_piece.x] == 0:
+                    fill = self.row_fill[i + self.active_piece.y]
+                    self.near_complete_rows += self.near_complete_fills[fill + 1] - self.near_complete_fills[fill]
+                    self.row_fill[i + self.active_piece.y] += 1
+                    self.column_bits[j + self.active_piece.x] |= 1 << (i + self.active_piece.y)
+                    previous_row_hashes.setdefault(i + self.active_piece.y, self.row_hashes[i + self.active_piece.y])
+                    self.row_hashes[i + self.active_piece.y] ^= self.zobrist_column_keys[j + self.active_piece.x]
+                self.field[i + self.active_piece.y][j + self.active_piece.x] = self.active_piece.type + 1
+                touched_rows.append(i + self.active_piece.y)
+                touched_columns.append(j + self.active_piece.x)
+                self.column_tops[j + self.active_piece.x] = min(self.column_tops[j + self.active_piece.x], i + self.active_piece.y)
+
+            if self.row_bits != None:
+                for row, mask in self.piece_row_masks[self.active_piece.type][self.active_piece.rotation][self.active_piece.x + Tetris.PIECE_MASK_MARGIN]:
+                    self.row_bits[row + self.active_piece.y] |= mask
+
+            # Each changed row is rehashed at its row once all of its new cells are in.
+            for row, row_hash in previous_row_hashes.items():
+                self.field_hash ^= self.row_key(row_hash, row) ^ self.row_key(self.row_hashes[row], row)
+
+            self.update_features(set(touched_rows), set(touched_columns))
+            line_clear = self.clear_lines(touched_rows)
+            self.ghost_key = None
+
             self.lock_delay = False
-            
+            self.lock_timer = 0
+
+            piece = self.active_piece
+            self.last_placement = (piece.type, piece.x, piece.y, piece.rotation, self.hold_used)
             self.hold_used = False
             self.active_piece = None
-        
+
+            return(line_clear)
+
     def get_scan_dimension(self, piece_state = None, piece_type = None):
         '''Checks if the piece's figure sits inside a 3x3 or a 5x5. Returns the resulting side length.'''
-        
+
         if piece_state == "Active" or piece_state == None:
             if self.active_piece == None:
                 return(0)
-            
+
             elif self.active_piece.type == 0:
                 return(5)
-            
+
             else:
                 return(3)
-            
+
         if piece_state == "Queue" or piece_state == "Hold":
             if piece_type == 0:
                 return(5)
-            
+
             if piece_type in [1, 2, 3, 4, 5, 6]:
                 return(3)
-        
+
     def move_piece_h(self, dx):
         '''Moves active piece along the X axis.'''
-        
+
         if self.active_piece != None:
             self.active_piece.x += dx
             if self.intersects():
                 self.active_piece.x -= dx
-                
+
             if self.lock_delay == True:
                 self.active_piece.move_reset_counter += 1
-                pygame.time.set_timer(PIECE_LOCK, 500)
-            
+                self.lock_timer = Tetris.LOCK_DELAY_TICKS
+
+    def shift_piece_to_wall(self, dx):
+        '''Moves the active piece along the X axis until it's blocked. Used for an ARR of 0.'''
+
+        if self.active_piece != None:
+            for i in range(self.matrix_width):
+                x = self.active_piece.x
+                self.move_piece_h(dx)
+                if self.active_piece.x == x:
+                    break
+
+    def set_handling(self, das_ticks, arr_ticks):
+        '''Sets how many ticks a sideways key has to be held before it repeats (DAS), and the ticks between repeats (ARR).'''
+
+        self.das_ticks = max(1, das_ticks)
+        self.arr_ticks = max(0, arr_ticks)
+
     def move_piece_down(self):
         '''Moves active piece down 1 space on the Y axis.'''
-        
+
         if self.active_piece != None:
             self.active_piece.y += 1
-            
+
             if self.intersects():
                 self.active_piece.y -= 1
-                
+
                 # If the player has evaded piece lock 15 times, places the piece.
-                if self.active_piece.move_reset_counter >= 15:
+                if self.active_piece.move_reset_counter >= Tetris.MOVE_RESET_LIMIT:
                     self.place_piece()
-                
-                elif game.hard_dropping:
+
+                elif self.hard_dropping:
                     self.place_piece()
                     self.hard_dropping = False
-                
+
                 # Starts a timer for the piece to lock in place (piece lock) on its own.
                 else:
                     if not self.lock_delay:
                         self.lock_delay = True
                         self.active_piece.move_reset_counter = 0
-                        pygame.time.set_timer(PIECE_LOCK, 500)
-            
+                        self.lock_timer = Tetris.LOCK_DELAY_TICKS
+
             # Deactivates the piece lock timer if the piece moves down successfully before the player maxes out their move reset.
-            elif self.active_piece.move_reset_counter < 15:
-                pygame.time.set_timer(PIECE_LOCK, 0)
+            elif self.active_piece.move_reset_counter < Tetris.MOVE_RESET_LIMIT:
                 self.lock_delay = False
-                    
+                self.lock_timer = 0
+
     def hard_drop(self):
         '''Drops active piece down as far as it can go.'''
-        
+
         if debug:
                 print("Tetris.hard_drop() called")
-                
+
         self.hard_dropping = True
         self.soft_dropping = False
-        
-        while self.hard_dropping:
-            self.move_piece_down()
-            
+
+        # Falling the whole way and then locking is the same as looping move_piece_down() until it places the piece.
+        if self.active_piece != None:
+            self.active_piece.y += self.drop_distance()
+            self.place_piece()
+
+        self.hard_dropping = False
+
+    def drop_distance(self):
+        '''Returns how many rows the active piece can fall before landing.
+
+        Uses the column height map and the piece's bottom profile. Falls back to stepping down with intersects()
+        when the piece is tucked under an overhang, where the height map doesn't apply.'''
+
+        if self.active_piece == None:
+            return(0)
+
+        distance = self.matrix_height
+        for column, bottom in Tetris.PIECE_BOTTOMS[self.active_piece.type][self.active_piece.rotation]:
+            gap = self.column_tops[self.active_piece.x + column] - 1 - (self.active_piece.y + bottom)
+            if gap < 0:
+                distance = 0
+                while not self.intersects(0, -(distance + 1), 0):
+                    distance += 1
+                return(distance)
+
+            distance = min(distance, gap)
+
+        return(distance)
+
+    def ghost_piece_y(self):
+        '''Returns the Y position of the ghost piece. Only recomputed when the active piece or the matrix has changed.'''
+
+        if self.active_piece == None:
+            return(0)
+
+        ghost_key = (self.active_piece, self.active_piece.x, self.active_piece.y, self.active_piece.rotation)
+        if ghost_key != self.ghost_key:
+            self.ghost_key = ghost_key
+            self.ghost_y = self.active_piece.y + self.drop_distance()
+
+        return(self.ghost_y)
+
     def intersects(self, x_difference = 0, y_difference = 0, rotation_difference = 0):
         '''Checks if a piece is outside of the matrix and returns the result. Allows for checks using altered coordinates and rotations.'''
-                
-        self.intersection_scan_dimension = self.get_scan_dimension()
-        
-        intersection = False      
-        for i in range(self.intersection_scan_dimension):
-            for j in range(self.intersection_scan_dimension):
-                if i * self.intersection_scan_dimension + j in self.active_piece.image(rotation_difference):
-                    if i + self.active_piece.y - y_difference > Tetris.MATRIX_HEIGHT - 1 or \
-                                 i + self.active_piece.y - y_difference < 0 or \
-                                 j + self.active_piece.x + x_difference < 0 or \
-                                 j + self.active_piece.x + x_difference > Tetris.MATRIX_WIDTH - 1 or \
-                                 self.field[i + self.active_piece.y - y_difference][j + self.active_piece.x + x_difference] != 0:
-                        intersection = True
-                    
+
+        if self.row_bits != None:
+            return(self.intersects_bitboard(x_difference, y_difference, rotation_difference))
+
+        if self.active_piece == None:
+            return(False)
+
+        intersection = False
+        for i, j in Tetris.FIGURE_CELLS[self.active_piece.type][(self.active_piece.rotation + rotation_difference) % 4]:
+            if i + self.active_piece.y - y_difference > self.matrix_height - 1 or \
+                         i + self.active_piece.y - y_difference < 0 or \
+                         j + self.active_piece.x + x_difference < 0 or \
+                         j + self.active_piece.x + x_difference > self.matrix_width - 1 or \
+                         self.field[i + self.active_piece.y - y_difference][j + self.active_piece.x + x_difference] != 0:
+                intersection = True
+
         return(intersection)
-    
-# Initialize game engine
-pygame.init()
 
-# Create fonts for in-game text    
-VARIABLE_DISPLAY_FONT = pygame.font.SysFont("verdana", 12)
-GAME_OVER_FONT = pygame.font.SysFont("consolas", 24)
+    def intersects_bitboard(self, x_difference = 0, y_difference = 0, rotation_difference = 0):
+        '''Bitboard version of intersects(). ANDs each row of the piece's precomputed mask with the matching matrix row.'''
 
-# Create window
-SCREEN_SIZE = (20 * Tetris.GAME_ZOOM, 25 * Tetris.GAME_ZOOM)
-screen = pygame.display.set_mode(SCREEN_SIZE)
-pygame.display.set_caption("Tetris but Awesome")
+        if self.active_piece == None:
+            return(False)
 
-# Initialize game
-clock = pygame.time.Clock()
-FPS = 60
-current_frame = 0
-game = Tetris()
-running = True
-debug = False
+        mask_x = self.active_piece.x + x_difference + Tetris.PIECE_MASK_MARGIN
+        rotation_masks = self.piece_row_masks[self.active_piece.type][(self.active_piece.rotation + rotation_difference) % 4]
+        if mask_x < 0 or mask_x >= len(rotation_masks) or rotation_masks[mask_x] == None:
+            return(True)
+
+        y = self.active_piece.y - y_difference
+        for row, mask in rotation_masks[mask_x]:
+            if not 0 <= y + row < self.matrix_height or self.row_bits[y + row] & mask:
+                return(True)
+
+        return(False)
+
+# pygame is imported by init_fonts(), which every front end calls before drawing anything. The engine doesn't need it,
+# and headless processes start several times faster without it.
+pygame = None
+
+# Maps the front end's keys to the input flags passed to Tetris.step(). Filled in by init_display().
+KEY_BINDINGS = {}
+
+# Fonts for in-game text, created by init_fonts()
+VARIABLE_DISPLAY_FONT = None
+GAME_OVER_FONT = None
+
+# Largest window size in pixels. Matrices too big to fit at Tetris.GAME_ZOOM are drawn with smaller cells.
+MAX_WINDOW_SIZE = (1600, 1000)
+
+def matrix_zoom(matrix_width, matrix_height):
+    '''Returns the size in pixels the cells of a matrix of the given size are drawn at: Tetris.GAME_ZOOM, or less if the
+    window would be bigger than MAX_WINDOW_SIZE at that size.'''
+
+    return(max(1, min(Tetris.GAME_ZOOM, MAX_WINDOW_SIZE[0] // (matrix_width + 10), MAX_WINDOW_SIZE[1] // (max(matrix_height, 20) + 5))))
+
+def window_size(matrix_width, matrix_height):
+    '''Returns the window size in pixels for a matrix of the given size: the matrix with room for the hold and queue beside it.'''
+
+    zoom = matrix_zoom(matrix_width, matrix_height)
+    return((zoom * (matrix_width + 10), zoom * (max(matrix_height, 20) + 5)))
+
+def draw_game(screen, game):
+    '''Draws the matrix, ghost piece, active piece, queue, held piece and game info of "game" onto "screen".'''
 
-while running:
-    # Stores the current frame and level.
-    current_frame = (current_frame + 1) % FPS
-    game.level = 1 + game.total_lines_cleared // 10
-    
-    if game.active_piece == None:
-        game.active_piece = Tetromino("Queue")
-    
-    try:
-        if current_frame % Tetris.GRAVITIES[game.level - 1][0] == 0:
-            for i in range(Tetris.GRAVITIES[game.level][1]):
-                game.move_piece_down()
-                
-    except IndexError:
-        if current_frame % Tetris.GRAVITIES[13][0] == 0:
-            for i in range(Tetris.GRAVITIES[13][1]):
-                game.move_piece_down()
-    
-    for event in pygame.event.get():
-        if event.type == pygame.QUIT:
-            running = False
-            pygame.quit()
-        
-        # Checks for key inputs that only matter when the game of Tetris hasn't been lost yet
-        if event.type == pygame.KEYDOWN and game.game_active == True:
-            if event.key == pygame.K_LSHIFT:
-                game.soft_dropping = True
-            
-            # Left and right movement
-            if event.key == pygame.K_a:
-                game.move_piece_h(-1)
-                pygame.time.set_timer(DAS_LEFT, 133)
-                game.do_das_right = False
-            if event.key == pygame.K_d:
-                game.move_piece_h(1)
-                pygame.time.set_timer(DAS_RIGHT, 133)
-                game.do_das_left = False
-                
-            # Inputs for piece rotation
-            if event.key == pygame.K_j:
-                game.call_rotation(-1)
-            if event.key == pygame.K_k:
-                game.call_rotation(2)
-            if event.key == pygame.K_l:
-                game.call_rotation(1)
-            
-            if event.key == pygame.K_SLASH:
-                game.hold_piece()
-            if event.key == pygame.K_s:
-                game.hard_drop()
-            
-            if event.key == pygame.K_F1:
-                debug = not debug
-        
-        # Checks for key inputs that matter regardless of game state. Currently, this is only the reset key.
-        if event.type == pygame.KEYDOWN:
-                
-            if event.key == pygame.K_c:
-                game = Tetris()
-        
-        # Checks for a key non-input so the game knows when to stop soft-dropping / DASing.
-        if event.type == pygame.KEYUP:
-                if event.key == pygame.K_LSHIFT:
-                    game.soft_dropping = False
-                    
-                if event.key == pygame.K_a:
-                    pygame.time.set_timer(DAS_LEFT, 0)
-                    game.do_das_left = False
-                if event.key == pygame.K_d:
-                    pygame.time.set_timer(DAS_RIGHT, 0)
-                    game.do_das_right = False
-        
-        # Places a piece if the Piece Lock timer runs out.
-        if event.type == PIECE_LOCK and game.game_active:
-            if debug:
-                print("PIECE_LOCK pushed")
-                
-            game.place_piece()
-        
-        # If left or right movement keys have been held without interruption for long enough, enable repeated left/right movement
-        if event.type == DAS_LEFT:
-            game.do_das_left = True
-            pygame.time.set_timer(DAS_RIGHT, 0)
-            
-        if event.type == DAS_RIGHT:
-            game.do_das_right = True
-            pygame.time.set_timer(DAS_LEFT, 0)
-            
-    if game.soft_dropping == True:
-        game.move_piece_down()
-        
-    if game.do_das_right and current_frame % 2 == 0:
-        game.move_piece_h(1)
-    
-    if game.do_das_left and current_frame % 2 == 0:
-        game.move_piece_h(-1)
-    
-    # Checks for intersection after everything else. Attempts to rotate as a failsave, then 
-    if game.intersects():
-        if debug:
-            print("game over")
-        game.game_active = False
-    
     screen.fill(BLACK)
-    
+
+    # Garbage cells (Tetris.GARBAGE_CELL) come after the pieces' colors.
     if game.game_active:
-        square_colors = TETROMINO_COLORS
-        
+        square_colors = TETROMINO_COLORS + [DEAD_SQUARE_GREY]
+
     else:
-        square_colors = [DEAD_SQUARE_GREY for i in range(len(TETROMINO_COLORS))]
+        square_colors = [DEAD_SQUARE_GREY for i in range(len(TETROMINO_COLORS) + 1)]
+
+    # Top left corner of the matrix, in pixels
+    zoom = matrix_zoom(game.matrix_width, game.matrix_height)
+    matrix_x = zoom * Tetris.MATRIX_X_OFFSET
+    matrix_y = int(zoom * Tetris.MATRIX_Y_OFFSET)
 
     # For each square in the matrix,
-    for i in range(Tetris.MATRIX_HEIGHT):
-        for j in range(Tetris.MATRIX_WIDTH):
-            
+    for i in range(game.matrix_height):
+        for j in range(game.matrix_width):
+
             # If square in matrix is empty...
             if game.field[i][j] == 0:
-                
+
                 # ...Draw the grid for the matrix.
-                pygame.draw.rect(screen, GRID_GREY, [Tetris.GAME_ZOOM * (Tetris.MATRIX_X_OFFSET + j), Tetris.GAME_ZOOM * (Tetris.MATRIX_Y_OFFSET + i), Tetris.GAME_ZOOM, Tetris.GAME_ZOOM], 1)
-            
+                pygame.draw.rect(screen, GRID_GREY, [matrix_x + zoom * j, matrix_y + zoom * i, zoom, zoom], 1)
+
             # If the game is active, draw all placed Tetrominoes in color.
             elif game.game_active:
-                pygame.draw.rect(screen, square_colors[game.field[i][j] - 1], [Tetris.GAME_ZOOM * (Tetris.MATRIX_X_OFFSET + j), Tetris.GAME_ZOOM * (Tetris.MATRIX_Y_OFFSET + i), Tetris.GAME_ZOOM - 0, Tetris.GAME_ZOOM - 0])
-            
+                pygame.draw.rect(screen, square_colors[game.field[i][j] - 1], [matrix_x + zoom * j, matrix_y + zoom * i, zoom, zoom])
+
             # Otherwise, grey them out.
             else:
-                pygame.draw.rect(screen, DEAD_SQUARE_GREY, [Tetris.GAME_ZOOM * (Tetris.MATRIX_X_OFFSET + j), Tetris.GAME_ZOOM * (Tetris.MATRIX_Y_OFFSET + i), Tetris.GAME_ZOOM - 0, Tetris.GAME_ZOOM - 0])
-    
-    # Find the position of the ghost piece
-    for i in range(Tetris.MATRIX_HEIGHT):
-        if game.intersects(0, -i, 0):
-            ghost_piece_y_difference = i - 1
-            break
-    
-    # Draw the ghost piece
-    rendering_scan_dimension = game.get_scan_dimension()
-    for i in range(rendering_scan_dimension):
-        for j in range(rendering_scan_dimension):
-            if i * rendering_scan_dimension + j in game.active_piece.image():
-                pygame.draw.rect(screen, DEAD_SQUARE_GREY,
-                                 [
-                                     Tetris.GAME_ZOOM * (Tetris.MATRIX_X_OFFSET + game.active_piece.x + j),
-                                     Tetris.GAME_ZOOM * (Tetris.MATRIX_Y_OFFSET + game.active_piece.y + i + ghost_piece_y_difference),
-                                     Tetris.GAME_ZOOM,
-                                     Tetris.GAME_ZOOM
-                                     ]
-                                 )
-    # Draw the active piece
-    rendering_scan_dimension = game.get_scan_dimension()
-    for i in range(rendering_scan_dimension):
-        for j in range(rendering_scan_dimension):
-            if i * rendering_scan_dimension + j in game.active_piece.image():
-                pygame.draw.rect(screen, square_colors[game.active_piece.type],
-                                 [
-                                     Tetris.GAME_ZOOM * (Tetris.MATRIX_X_OFFSET + game.active_piece.x + j),
-                                     Tetris.GAME_ZOOM * (Tetris.MATRIX_Y_OFFSET + game.active_piece.y + i),
-                                     Tetris.GAME_ZOOM,
-                                     Tetris.GAME_ZOOM
-                                     ]
-                                 )
-                
-    # Draw the earliest 5 items in the queue.            
+                pygame.draw.rect(screen, DEAD_SQUARE_GREY, [matrix_x + zoom * j, matrix_y + zoom * i, zoom, zoom])
+
+    if game.active_piece != None:
+
+        # Find the position of the ghost piece
+        ghost_piece_y_difference = game.ghost_piece_y() - game.active_piece.y
+
+        # Draw the ghost piece
+        rendering_scan_dimension = game.get_scan_dimension()
+        for i in range(rendering_scan_dimension):
+            for j in range(rendering_scan_dimension):
+                if i * rendering_scan_dimension + j in game.active_piece.image():
+                    pygame.draw.rect(screen, DEAD_SQUARE_GREY,
+                                     [
+                                         matrix_x + zoom * (game.active_piece.x + j),
+                                         matrix_y + zoom * (game.active_piece.y + i + ghost_piece_y_difference),
+                                         zoom,
+                                         zoom
+                                         ]
+                                     )
+        # Draw the active piece
+        rendering_scan_dimension = game.get_scan_dimension()
+        for i in range(rendering_scan_dimension):
+            for j in range(rendering_scan_dimension):
+                if i * rendering_scan_dimension + j in game.active_piece.image():
+                    pygame.draw.rect(screen, square_colors[game.active_piece.type],
+                                     [
+                                         matrix_x + zoom * (game.active_piece.x + j),
+                                         matrix_y + zoom * (game.active_piece.y + i),
+                                         zoom,
+                                         zoom
+                                         ]
+                                     )
+
+    # Draw the earliest 5 items in the queue.
     for i in range(5):
         try:
             queue_rendering_scan_dimension = game.get_scan_dimension("Queue", game.queue[i])
-            
+
         except IndexError:
             break
-        
+
         for i1 in range(queue_rendering_scan_dimension):
             for j in range(queue_rendering_scan_dimension):
                 if i1 * queue_rendering_scan_dimension + j in Tetromino.FIGURES[game.queue[i]][0]:
                     if game.queue[i] == 0:
                         figure_render_offset_x = -1
                         figure_render_offset_y = -2
-                    
+
                     else:
                         figure_render_offset_x = 0
                         figure_render_offset_y = 0
-                        
+
                     pygame.draw.rect(screen, TETROMINO_COLORS[game.queue[i]],
                                 [
-                                    Tetris.GAME_ZOOM * (Tetris.MATRIX_X_OFFSET + Tetris.MATRIX_WIDTH + 0.5 + j + figure_render_offset_x),
-                                    Tetris.GAME_ZOOM * (Tetris.MATRIX_Y_OFFSET + 1 + i1 + figure_render_offset_y + i * 3),
-                                    Tetris.GAME_ZOOM,
-                                    Tetris.GAME_ZOOM
+                                    int(zoom * (Tetris.MATRIX_X_OFFSET + game.matrix_width + 0.5 + j + figure_render_offset_x)),
+                                    int(zoom * (Tetris.MATRIX_Y_OFFSET + 1 + i1 + figure_render_offset_y + i * 3)),
+                                    zoom,
+                                    zoom
                                     ]
                                 )
-                    
-    # Draw the held piece, if there is one.                
+
+    # Draw the held piece, if there is one.
     if game.piece_held != None:
-        
+
         hold_rendering_scan_dimension = game.get_scan_dimension("Hold", game.piece_held)
         for i in range(hold_rendering_scan_dimension):
             for j in range(hold_rendering_scan_dimension):
@@ -610,29 +1373,29 @@ while running:
                     if game.piece_held == 0:
                         figure_render_offset_x = -1
                         figure_render_offset_y = -2
-                    
+
                     else:
                         figure_render_offset_x = 0
                         figure_render_offset_y = 0
-                        
+
                     pygame.draw.rect(screen, TETROMINO_COLORS[game.piece_held],
                                 [
-                                    Tetris.GAME_ZOOM * (Tetris.MATRIX_X_OFFSET - 4.5 + j + figure_render_offset_x),
-                                    Tetris.GAME_ZOOM * (Tetris.MATRIX_Y_OFFSET + 1 + i + figure_render_offset_y),
-                                    Tetris.GAME_ZOOM,
-                                    Tetris.GAME_ZOOM
+                                    int(zoom * (Tetris.MATRIX_X_OFFSET - 4.5 + j + figure_render_offset_x)),
+                                    int(zoom * (Tetris.MATRIX_Y_OFFSET + 1 + i + figure_render_offset_y)),
+                                    zoom,
+                                    zoom
                                     ]
                                 )
-    
+
     # Create game info display text
     score_display_text = VARIABLE_DISPLAY_FONT.render(f"Score: {game.score}", True, WHITE)
     level_display_text = VARIABLE_DISPLAY_FONT.render(f"Level: {game.level}", True, WHITE)
     lines_display_text = VARIABLE_DISPLAY_FONT.render(f"Lines: {game.total_lines_cleared}", True, WHITE)
-    
+
     # Create game over text
     game_over_text_1 = GAME_OVER_FONT.render("Game Over!", True, BLACK)
     game_over_text_2 = GAME_OVER_FONT.render("Press C.", True, BLACK)
-    
+
     # Blit display text to screen
     display_text_x = 15
     display_text_y = 100
@@ -642,9 +1405,615 @@ while running:
 
     # Blits game over text to screen if game has been lost.
     if game.game_active == False:
-        pygame.draw.rect(screen, YELLOW, [Tetris.GAME_ZOOM * Tetris.MATRIX_X_OFFSET, Tetris.GAME_ZOOM * 7 + Tetris.GAME_ZOOM * Tetris.MATRIX_Y_OFFSET, Tetris.GAME_ZOOM * Tetris.MATRIX_WIDTH, Tetris.GAME_ZOOM * 3])
-        screen.blit(game_over_text_1, (Tetris.GAME_ZOOM * (Tetris.MATRIX_X_OFFSET + Tetris.MATRIX_WIDTH) // 2, Tetris.GAME_ZOOM * 7.5 + Tetris.GAME_ZOOM * Tetris.MATRIX_Y_OFFSET))
-        screen.blit(game_over_text_2, (Tetris.GAME_ZOOM * (Tetris.MATRIX_X_OFFSET + Tetris.MATRIX_WIDTH) // 2, Tetris.GAME_ZOOM * 8.5 + Tetris.GAME_ZOOM * Tetris.MATRIX_Y_OFFSET))
-        
-    pygame.display.flip()
-    clock.tick(FPS)
\ No newline at end of file
+        pygame.draw.rect(screen, YELLOW, [matrix_x, zoom * 7 + matrix_y, zoom * game.matrix_width, zoom * 3])
+        screen.blit(game_over_text_1, (zoom * (Tetris.MATRIX_X_OFFSET + game.matrix_width) // 2, int(zoom * 7.5) + matrix_y))
+        screen.blit(game_over_text_2, (zoom * (Tetris.MATRIX_X_OFFSET + game.matrix_width) // 2, int(zoom * 8.5) + matrix_y))
+
+class FrameRenderer:
+    '''Draws the same picture as draw_game(), but only redraws the parts of the screen that changed since the last frame.
+
+    Every cell is blitted from a prebuilt tile and text is only rendered again when its value changes. draw() returns
+    the changed areas, to pass to pygame.display.update() instead of flipping the whole window.
+
+    Only the rows of the matrix that changed since the last frame are looked at, along with the cells under the ghost and
+    active piece, so drawing a frame takes time in proportion to what changed rather than to the size of the matrix.'''
+
+    # Tile index of the grey used for the ghost piece and for everything once the game is lost. Tiles 0-6 are TETROMINO_COLORS.
+    GREY_TILE = len(TETROMINO_COLORS)
+
+    # Marks a cell of the matrix that has to be drawn again whatever it shows
+    STALE = -1
+
+    # Left edge and top of the score, level and lines text
+    TEXT_X = 15
+    TEXT_Y = 100
+    TEXT_SPACING = 30
+
+    def __init__(self, screen):
+        '''Creates a renderer for "screen", which can be the window or any other surface. The fonts must have been
+        created by init_fonts() first.'''
+
+        self.screen = screen
+        self.game_over_texts = [GAME_OVER_FONT.render("Game Over!", True, BLACK), GAME_OVER_FONT.render("Press C.", True, BLACK)]
+
+        # The rendered score, level and lines text, and the value each was rendered for
+        self.texts = [(None, None), (None, None), (None, None)]
+        self.drawn_texts = None
+        self.text_rect = None
+        self.text_cells = set()
+
+        self.game = None
+        self.matrix_size = None
+        self.set_matrix_size(Tetris.MATRIX_WIDTH, Tetris.MATRIX_HEIGHT)
+        self.invalidate()
+
+    def set_matrix_size(self, matrix_width, matrix_height):
+        '''Lays the screen out for a matrix of the given size, building the cell tiles at the zoom it's drawn at.'''
+
+        self.matrix_size = (matrix_width, matrix_height)
+        zoom = self.zoom = matrix_zoom(matrix_width, matrix_height)
+
+        # Top left corner of the matrix, in pixels
+        self.matrix_x = zoom * Tetris.MATRIX_X_OFFSET
+        self.matrix_y = int(zoom * Tetris.MATRIX_Y_OFFSET)
+
+        # Tiles take the pixel format of the screen, which doesn't have to be a window, so blitting them doesn't convert them.
+        self.cell_tiles = []
+        for color in TETROMINO_COLORS + [DEAD_SQUARE_GREY]:
+            tile = pygame.Surface((zoom, zoom), 0, self.screen)
+            tile.fill(color)
+            self.cell_tiles.append(tile)
+
+        self.grid_tile = pygame.Surface((zoom, zoom), 0, self.screen)
+        self.grid_tile.fill(BLACK)
+        pygame.draw.rect(self.grid_tile, GRID_GREY, [0, 0, zoom, zoom], 1)
+
+        # Areas the queue and held piece are drawn in
+        self.queue_rect = pygame.Rect(zoom * (Tetris.MATRIX_X_OFFSET + matrix_width), self.matrix_y, zoom * 5, zoom * 15)
+        self.hold_rect = pygame.Rect(0, self.matrix_y, self.matrix_x, zoom * 3)
+
+        self.game_over_rect = pygame.Rect(self.matrix_x, zoom * 7 + self.matrix_y, zoom * matrix_width, zoom * 3)
+
+        if self.text_rect != None:
+            self.text_cells = set(self.rect_cells(self.text_rect))
+
+    def cell_rect(self, i, j):
+        '''Returns the screen area of cell (i, j) of the matrix.'''
+
+        return(pygame.Rect(self.matrix_x + self.zoom * j, self.matrix_y + self.zoom * i, self.zoom, self.zoom))
+
+    def rect_cells(self, rect):
+        '''Returns the (i, j) of every cell of the matrix that overlaps "rect".'''
+
+        matrix_width, matrix_height = self.matrix_size
+        first_row = max(0, (rect.top - self.matrix_y) // self.zoom)
+        last_row = min(matrix_height, -((self.matrix_y - rect.bottom) // self.zoom))
+        first_column = max(0, (rect.left - self.matrix_x) // self.zoom)
+        last_column = min(matrix_width, -((self.matrix_x - rect.right) // self.zoom))
+
+        return([(i, j) for i in range(first_row, last_row) for j in range(first_column, last_column)])
+
+    def invalidate(self, rect = None):
+        '''Marks "rect" (the whole screen if None) to be cleared and redrawn on the next frame, e.g. after something
+        else has been drawn over it.'''
+
+        if rect == None:
+            matrix_width, matrix_height = self.matrix_size
+            rect = self.screen.get_rect()
+            self.cells = [[FrameRenderer.STALE] * matrix_width for i in range(matrix_height)]
+            self.stale_rows = set(range(matrix_height))
+            self.stale_rects = [rect]
+            self.queue_key = None
+            self.hold_key = None
+            self.text_drawn = False
+            self.game_over_drawn = False
+            return
+
+        rect = pygame.Rect(rect)
+        self.stale_rects.append(rect)
+
+        for i, j in self.rect_cells(rect):
+            self.cells[i][j] = FrameRenderer.STALE
+            self.stale_rows.add(i)
+
+        if self.queue_rect.colliderect(rect):
+            self.queue_key = None
+        if self.hold_rect.colliderect(rect):
+            self.hold_key = None
+        # Text is blended onto what's under it, so it can only be drawn again over a cleared background.
+        if self.text_rect != None and self.text_rect.colliderect(rect):
+            self.text_drawn = False
+            if not rect.contains(self.text_rect):
+                self.invalidate(self.text_rect)
+        if self.game_over_rect.colliderect(rect):
+            self.game_over_drawn = False
+
+    def render_text(self, slot, value):
+        '''Returns the surface for text slot "slot", rendering it again only if "value" has changed.'''
+
+        if self.texts[slot][0] != value:
+            self.texts[slot] = (value, VARIABLE_DISPLAY_FONT.render(value, True, WHITE))
+
+        return(self.texts[slot][1])
+
+    def changed_rows(self, game):
+        '''Returns the set of rows of the matrix that may have changed since the last frame.
+
+        Rows are copied before they're written to and moved as a whole when lines are cleared, so a row that's still
+        the same object as last frame still holds the same cells.'''
+
+        if game.game_active != self.drawn_active:
+            changed_rows = set(range(game.matrix_height))
+
+        elif game.field is self.drawn_field and game.field_hash == self.drawn_hash:
+            changed_rows = set()
+
+        else:
+            changed_rows = {i for i, row in enumerate(game.field) if row is not self.drawn_rows[i]}
+
+        self.drawn_field = game.field
+        self.drawn_rows = list(game.field)
+        self.drawn_hash = game.field_hash
+        self.drawn_active = game.game_active
+
+        return(changed_rows)
+
+    def overlay_tiles(self, game):
+        '''Returns a dict of the tile index of each cell covered by the ghost or active piece, by (i, j).'''
+
+        overlay = {}
+        if game.active_piece != None:
+            piece = game.active_piece
+            ghost_y = game.ghost_piece_y()
+            piece_tile = piece.type if game.game_active else FrameRenderer.GREY_TILE
+            for y, tile in [(ghost_y, FrameRenderer.GREY_TILE), (piece.y, piece_tile)]:
+                for row, column in Tetris.FIGURE_CELLS[piece.type][piece.rotation]:
+                    if 0 <= y + row < game.matrix_height and 0 <= piece.x + column < game.matrix_width:
+                        overlay[(y + row, piece.x + column)] = tile
+
+        return(overlay)
+
+    def cell_changes(self, game, rows, overlay):
+        '''Returns a dict of the tile index of every cell of "rows" and of the ghost and active piece, old and new,
+        that doesn't show what it should, by (i, j). None is an empty cell.'''
+
+        grey = not game.game_active
+        changes = {}
+
+        for i in rows:
+            field_row = game.field[i]
+            drawn_row = self.cells[i]
+            for j in range(game.matrix_width):
+                tile = overlay.get((i, j))
+                if tile == None and field_row[j] != 0:
+                    tile = FrameRenderer.GREY_TILE if grey else field_row[j] - 1
+                if tile != drawn_row[j]:
+                    changes[(i, j)] = tile
+
+        for i, j in list(self.overlay) + list(overlay):
+            tile = overlay.get((i, j))
+            if tile == None and game.field[i][j] != 0:
+                tile = FrameRenderer.GREY_TILE if grey else game.field[i][j] - 1
+            if tile != self.cells[i][j]:
+                changes[(i, j)] = tile
+
+        return(changes)
+
+    def draw_preview(self, piece_type, x, y):
+        '''Draws a piece in spawn orientation for the queue or hold, with the top left of its grid at (x, y) in cells.'''
+
+        figure_render_offset = -1 if piece_type == 0 else 0
+        for row, column in Tetris.FIGURE_CELLS[piece_type][0]:
+            self.screen.blit(self.cell_tiles[piece_type], (int(self.zoom * (x + column + figure_render_offset)),
+                                                           int(self.zoom * (y + row + 2 * figure_render_offset))))
+
+    def draw(self, game):
+        '''Brings the screen up to date with "game". Returns the list of changed rects for pygame.display.update().'''
+
+        if game is not self.game:
+            self.game = game
+            if self.matrix_size != (game.matrix_width, game.matrix_height):
+                self.set_matrix_size(game.matrix_width, game.matrix_height)
+            self.invalidate()
+            self.drawn_field = None
+            self.drawn_active = None
+            self.overlay = {}
+
+        # Score, level and lines. When any of them changes, the area they covered is cleared and drawn again.
+        texts = [
+            self.render_text(0, f"Score: {game.score}"),
+            self.render_text(1, f"Level: {game.level}"),
+            self.render_text(2, f"Lines: {game.total_lines_cleared}"),
+        ]
+        if texts != self.drawn_texts:
+            text_rect = pygame.Rect(FrameRenderer.TEXT_X, FrameRenderer.TEXT_Y, max(text.get_width() for text in texts),
+                                    FrameRenderer.TEXT_SPACING * 2 + texts[2].get_height())
+            self.invalidate(text_rect if self.text_rect == None else text_rect.union(self.text_rect))
+            self.text_rect = text_rect
+            self.text_cells = set(self.rect_cells(text_rect))
+            self.drawn_texts = texts
+            self.text_drawn = False
+
+        changed_rows = self.changed_rows(game)
+        overlay = self.overlay_tiles(game)
+        changes = self.cell_changes(game, changed_rows | self.stale_rows, overlay)
+
+        # Long text can run into the matrix, and has to be drawn again if any cell under it changes.
+        if not self.text_cells.isdisjoint(changes):
+            self.invalidate(self.text_rect)
+            changes = self.cell_changes(game, changed_rows | self.stale_rows, overlay)
+        self.stale_rows = set()
+        self.overlay = overlay
+
+        dirty_rects = []
+        for rect in self.stale_rects:
+            self.screen.fill(BLACK, rect)
+            dirty_rects.append(rect)
+        self.stale_rects = []
+
+        # Matrix cells, with the ghost and active piece
+        for (i, j), tile in changes.items():
+            rect = self.cell_rect(i, j)
+            self.screen.blit(self.grid_tile if tile == None else self.cell_tiles[tile], rect)
+            dirty_rects.append(rect)
+            self.cells[i][j] = tile
+            if self.game_over_rect.colliderect(rect):
+                self.game_over_drawn = False
+
+        # Earliest 5 pieces in the queue
+        queue_key = tuple(game.queue[i] for i in range(min(5, len(game.queue))))
+        if queue_key != self.queue_key:
+            self.screen.fill(BLACK, self.queue_rect)
+            for i, piece_type in enumerate(queue_key):
+                self.draw_preview(piece_type, Tetris.MATRIX_X_OFFSET + game.matrix_width + 0.5, Tetris.MATRIX_Y_OFFSET + 1 + i * 3)
+            dirty_rects.append(self.queue_rect)
+            self.queue_key = queue_key
+
+        # Held piece
+        if game.piece_held != self.hold_key:
+            self.screen.fill(BLACK, self.hold_rect)
+            if game.piece_held != None:
+                self.draw_preview(game.piece_held, Tetris.MATRIX_X_OFFSET - 4.5, Tetris.MATRIX_Y_OFFSET + 1)
+            dirty_rects.append(self.hold_rect)
+            self.hold_key = game.piece_held
+
+        if not self.text_drawn:
+            display_text_y = FrameRenderer.TEXT_Y
+            for text in texts:
+                self.screen.blit(text, [FrameRenderer.TEXT_X, display_text_y])
+                display_text_y += FrameRenderer.TEXT_SPACING
+            dirty_rects.append(self.text_rect)
+            self.text_drawn = True
+            if self.game_over_rect.colliderect(self.text_rect):
+                self.game_over_drawn = False
+
+        if game.game_active == False and not self.game_over_drawn:
+            pygame.draw.rect(self.screen, YELLOW, self.game_over_rect)
+            text_x = self.zoom * (Tetris.MATRIX_X_OFFSET + game.matrix_width) // 2
+            self.screen.blit(self.game_over_texts[0], (text_x, int(self.zoom * 7.5) + self.matrix_y))
+            self.screen.blit(self.game_over_texts[1], (text_x, int(self.zoom * 8.5) + self.matrix_y))
+            dirty_rects.append(self.game_over_rect)
+            self.game_over_drawn = True
+
+        return(dirty_rects)
+
+class TickScheduler:
+    '''Runs the simulation at FPS ticks per second off a monotonic clock, however often frames are drawn.
+
+    Ticks missed while a frame ran long are caught up on the next frame, up to MAX_CATCH_UP_TICKS at once. Any more
+    than that (the window being dragged, the machine sleeping) are dropped instead of fast-forwarded through.'''
+
+    MAX_CATCH_UP_TICKS = FPS // 4
+
+    def __init__(self, tick_rate = FPS, clock = time.perf_counter):
+        '''Starts the tick clock. "clock" returns the current time in seconds.'''
+
+        self.tick_length = 1 / tick_rate
+        self.clock = clock
+
+        # Tick i is due at start_time + i * tick_length. Counting ticks instead of adding up tick lengths keeps the rate from drifting.
+        self.start_time = clock()
+        self.ticks_run = 0
+        self.dropped_ticks = 0
+
+    def next_tick_time(self):
+        '''Returns the time the next tick is due.'''
+
+        return(self.start_time + (self.ticks_run + 1) * self.tick_length)
+
+    def due_ticks(self):
+        '''Returns the times the ticks to run now were due at, oldest first, and counts them as run.'''
+
+        elapsed_ticks = int((self.clock() - self.start_time) / self.tick_length)
+        due = elapsed_ticks - self.ticks_run
+        if due > TickScheduler.MAX_CATCH_UP_TICKS:
+            self.dropped_ticks += due - TickScheduler.MAX_CATCH_UP_TICKS
+            self.start_time += (due - TickScheduler.MAX_CATCH_UP_TICKS) * self.tick_length
+            due = TickScheduler.MAX_CATCH_UP_TICKS
+
+        tick_times = [self.start_time + (self.ticks_run + i + 1) * self.tick_length for i in range(max(0, due))]
+        self.ticks_run += len(tick_times)
+        return(tick_times)
+
+    def wait(self, poll = None, poll_interval = 0.001):
+        '''Sleeps until the next tick is due. Nothing on screen can change before then.
+
+        If "poll" is given, it's called about every "poll_interval" seconds while waiting, so input can be read as it arrives.'''
+
+        while True:
+            delay = self.next_tick_time() - self.clock()
+            if delay <= 0:
+                return
+            if poll != None:
+                poll()
+                delay = min(delay, poll_interval)
+            time.sleep(delay)
+
+class InputTimeline:
+    '''Timestamps key presses and releases as they're read, and gives each tick the keys as they were at its time.
+
+    When several ticks are caught up at once, a key pressed between two of them takes effect on the second one instead
+    of on the first tick of the batch.'''
+
+    def __init__(self):
+        self.held_inputs = 0
+
+        # (time, input flag, True for a press) for every key event not yet given to a tick
+        self.events = deque()
+
+    def add_event(self, timestamp, flag, pressed):
+        '''Records a press or release of the key for INPUT_* "flag" at "timestamp".'''
+
+        self.events.append((timestamp, flag, pressed))
+
+    def inputs_for_tick(self, tick_time = None):
+        '''Applies the key events up to "tick_time" (all of them if None). Returns the inputs bitmask to pass to Tetris.step()
+        and the timestamps of the presses applied.
+
+        Keys pressed since the previous tick count as held for this one, even if they were released before it.'''
+
+        pressed_inputs = 0
+        press_times = []
+        while self.events and (tick_time == None or self.events[0][0] <= tick_time):
+            timestamp, flag, pressed = self.events.popleft()
+            if pressed:
+                self.held_inputs |= flag
+                pressed_inputs |= flag
+                press_times.append(timestamp)
+            else:
+                self.held_inputs &= ~flag
+
+        return(self.held_inputs | pressed_inputs, press_times)
+
+def init_fonts():
+    '''Imports pygame and creates the fonts for in-game text. Needs no window, so games can be drawn onto offscreen surfaces.'''
+
+    global pygame, VARIABLE_DISPLAY_FONT, GAME_OVER_FONT
+
+    import pygame
+    pygame.font.init()
+    VARIABLE_DISPLAY_FONT = pygame.font.SysFont("verdana", 12)
+    GAME_OVER_FONT = pygame.font.SysFont("consolas", 24)
+
+def init_display(matrix_width = Tetris.MATRIX_WIDTH, matrix_height = Tetris.MATRIX_HEIGHT):
+    '''Initializes pygame, the fonts for in-game text and a game window sized for a matrix of the given size. Returns
+    the window's surface.'''
+
+    # Initialize game engine
+    init_fonts()
+    pygame.init()
+
+    KEY_BINDINGS.update({
+        pygame.K_a: INPUT_MOVE_LEFT,
+        pygame.K_d: INPUT_MOVE_RIGHT,
+        pygame.K_j: INPUT_ROTATE_CCW,
+        pygame.K_k: INPUT_ROTATE_180,
+        pygame.K_l: INPUT_ROTATE_CW,
+        pygame.K_s: INPUT_HARD_DROP,
+        pygame.K_LSHIFT: INPUT_SOFT_DROP,
+        pygame.K_SLASH: INPUT_HOLD,
+    })
+
+    # Create window
+    SCREEN_SIZE = window_size(matrix_width, matrix_height)
+    screen = pygame.display.set_mode(SCREEN_SIZE)
+    pygame.display.set_caption("Tetris but Awesome")
+
+    return(screen)
+
+def load_handling(path):
+    '''Reads DAS and ARR lengths in milliseconds from a JSON settings file like user-settings/handling.json.
+    Returns them as ticks, or the defaults if the file doesn't exist.'''
+
+    if not os.path.exists(path):
+        return(Tetris.DAS_TICKS, Tetris.ARR_TICKS)
+
+    with open(path) as settings_file:
+        settings = json.load(settings_file)
+
+    return(ms_to_ticks(settings["autoStartDelayMs"]), ms_to_ticks(settings["autoRepeatRateMs"]))
+
+def main(record_directory = None, handling = None, measure_latency = False, matrix_size = (Tetris.MATRIX_WIDTH, Tetris.MATRIX_HEIGHT),
+         autoplayer = None):
+    '''Runs the interactive pygame front end. If "record_directory" is given, every game is saved there as a replay.
+
+    "handling" is the (DAS, ARR) lengths in ticks. If "measure_latency" is True, the time from each key press to the
+    display update showing its effect is measured, and the distribution is printed on exit. "matrix_size" is the
+    (width, height) of the matrix in cells. If "autoplayer" (a tetris_bot.Autoplayer) is given, it plays instead of
+    the keyboard, and a new game starts a few seconds after each game over.'''
+
+    global debug
+
+    screen = init_display(*matrix_size)
+
+    if handling == None:
+        handling = (Tetris.DAS_TICKS, Tetris.ARR_TICKS)
+
+    if record_directory != None:
+        from tetris_replay import ReplayRecorder
+        os.makedirs(record_directory, exist_ok=True)
+
+    def start_game():
+        game = Tetris(matrix_width=matrix_size[0], matrix_height=matrix_size[1])
+        game.set_handling(*handling)
+        recorder = ReplayRecorder(game.randomizer.seed, game.das_ticks, game.arr_ticks, matrix_size) if record_directory != None else None
+        return(game, recorder)
+
+    def save_recording(recorder):
+        if recorder != None and recorder.ticks > 0:
+            recorder.save(os.path.join(record_directory, f"{recorder.seed:016x}.replay"))
+
+    # Frame profiler, on with F1 or from the start if TETRIS_PROFILE is set.
+    from tetris_profiler import FrameProfiler, percentile
+    profiler = FrameProfiler({"Tetris": Tetris, "Tetromino": Tetromino}, FPS, os.environ.get("TETRIS_PROFILE") or "profiles")
+    if os.environ.get("TETRIS_PROFILE"):
+        debug = True
+        profiler.enable()
+
+    # Initialize game
+    renderer = FrameRenderer(screen)
+    scheduler = TickScheduler()
+    timeline = InputTimeline()
+    game, recorder = start_game()
+    running = True
+    game_over_ticks = 0
+
+    # Times of key presses that have been applied to a tick but not shown yet, and the measured latencies in seconds
+    unshown_press_times = []
+    latencies = []
+
+    def handle_events():
+        '''Reads pygame's events, timestamping key presses and releases for the input timeline.'''
+
+        nonlocal game, recorder, running
+        global debug
+
+        timestamp = scheduler.clock()
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                running = False
+
+            if event.type == pygame.KEYDOWN:
+                if event.key in KEY_BINDINGS:
+                    timeline.add_event(timestamp, KEY_BINDINGS[event.key], True)
+
+                if event.key == pygame.K_F1:
+                    debug = not debug
+                    if debug:
+                        profiler.enable()
+                    else:
+                        profiler.disable()
+
+                # Reset key
+                if event.key == pygame.K_c:
+                    save_recording(recorder)
+                    game, recorder = start_game()
+
+            if event.type == pygame.KEYUP and event.key in KEY_BINDINGS:
+                timeline.add_event(timestamp, KEY_BINDINGS[event.key], False)
+
+    while running:
+        profiler.begin_frame()
+
+        handle_events()
+        if not running:
+            break
+        profiler.lap("events")
+
+        # Runs every tick that's come due since the last frame. Several run at once if the last frame was slow, each with
+        # the keys as they were at its time. The last one also takes any key read since, rather than leaving it for the next frame.
+        tick_times = scheduler.due_ticks()
+        for i, tick_time in enumerate(tick_times):
+            tick_inputs, press_times = timeline.inputs_for_tick(tick_time if i < len(tick_times) - 1 else None)
+            unshown_press_times += press_times
+            if autoplayer != None:
+                tick_inputs = autoplayer.inputs(game)
+            if recorder != None and game.game_active:
+                recorder.step(game, tick_inputs)
+            else:
+                game.step(tick_inputs)
+
+        if autoplayer != None and not game.game_active:
+            game_over_ticks += len(tick_times)
+            if game_over_ticks >= 3 * FPS:
+                save_recording(recorder)
+                game, recorder = start_game()
+                game_over_ticks = 0
+        profiler.lap("step")
+
+        dirty_rects = renderer.draw(game)
+        profiler.lap("draw")
+
+        # The overlay is drawn over the game, so the renderer has to clear it away on the next frame.
+        overlay_rect = profiler.draw_overlay(screen, VARIABLE_DISPLAY_FONT, WHITE)
+        if overlay_rect != None:
+            renderer.invalidate(overlay_rect)
+            dirty_rects.append(overlay_rect)
+        profiler.lap("overlay")
+
+        pygame.display.update(dirty_rects)
+        if measure_latency and unshown_press_times:
+            shown_time = scheduler.clock()
+            latencies += [shown_time - press_time for press_time in unshown_press_times]
+        unshown_press_times = []
+        profiler.lap("display")
+
+        # Keeps reading input while waiting, so each key is timestamped close to when it was pressed.
+        scheduler.wait(handle_events)
+        profiler.lap("wait")
+
+    profiler.disable()
+    save_recording(recorder)
+    pygame.quit()
+
+    if measure_latency:
+        latencies_ms = sorted(latency * 1000 for latency in latencies)
+        print(json.dumps({
+            "presses": len(latencies_ms),
+            "mean_ms": sum(latencies_ms) / len(latencies_ms) if latencies_ms else 0.0,
+            "p50_ms": percentile(latencies_ms, 50),
+            "p95_ms": percentile(latencies_ms, 95),
+            "p99_ms": percentile(latencies_ms, 99),
+            "max_ms": latencies_ms[-1] if latencies_ms else 0.0,
+        }, indent=2))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tetris but Awesome")
+    parser.add_argument("--record", metavar="DIRECTORY", default=None, help="save every game as a replay in this directory")
+    parser.add_argument("--handling", metavar="FILE", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "user-settings", "handling.json"),
+                        help="JSON file with the DAS and ARR lengths in milliseconds (default: user-settings/handling.json)")
+    parser.add_argument("--das", metavar="MS", type=float, default=None, help="DAS length in milliseconds, overriding the handling file")
+    parser.add_argument("--arr", metavar="MS", type=float, default=None, help="ARR length in milliseconds, overriding the handling file")
+    parser.add_argument("--measure-latency", action="store_true", help="print the key press to display update latency distribution on exit")
+    parser.add_argument("--width", type=int, default=Tetris.MATRIX_WIDTH, help=f"matrix width in cells (default: {Tetris.MATRIX_WIDTH})")
+    parser.add_argument("--height", type=int, default=Tetris.MATRIX_HEIGHT, help=f"matrix height in cells (default: {Tetris.MATRIX_HEIGHT})")
+    parser.add_argument("--rules", metavar="DIRECTORY", default=None, help="play with the ruleset in this directory of data tables, such as data-tables")
+    parser.add_argument("--autoplay", action="store_true", help="let the built-in bot play")
+    parser.add_argument("--autoplay-budget", metavar="MS", type=float, default=None, help="the bot's search time per piece in milliseconds")
+    parser.add_argument("--autoplay-workers", type=int, default=1, help="processes the bot searches on, or 0 for a thread of this one (default: 1)")
+    args = parser.parse_args()
+
+    # Modules like tetris_bot import the tetris module, which is a separate copy of this one when it's run as a script.
+    if args.rules != None:
+        from tetris_rules import apply_ruleset, load_ruleset
+        ruleset = load_ruleset(args.rules)
+        apply_ruleset(ruleset, sys.modules[__name__])
+        apply_ruleset(ruleset)
+
+    das_ticks, arr_ticks = load_handling(args.handling)
+    if args.das != None:
+        das_ticks = ms_to_ticks(args.das)
+    if args.arr != None:
+        arr_ticks = ms_to_ticks(args.arr)
+
+    # The bot's processes are started before the window is opened.
+    autoplayer = None
+    if args.autoplay:
+        from tetris_bot import TIME_BUDGET_MS, start_autoplayer
+        autoplayer = start_autoplayer(args.autoplay_budget or TIME_BUDGET_MS, args.autoplay_workers, (args.width, args.height))
+
+    try:
+        main(args.record, (das_ticks, arr_ticks), args.measure_latency, (args.width, args.height), autoplayer)
+    finally:
+        if autoplayer != None:
+            autoplayer.close()
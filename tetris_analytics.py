@@ -0,0 +1,300 @@
+# Analyzes archives of replays offline: plays each one back through the headless engine on a process pool and grades
+# every piece for keys per piece (KPP), speed (pieces per second, PPS), finesse and hold usage.
+#
+# A piece's keys are the keys pressed from the tick it spawned to the tick it locked, holding a key counting as one
+# press. Its finesse faults are the presses beyond the fewest that reach the same placement from its spawn position on
+# the same board (see tetris_placements.search_key_presses()), plus one for the hold if it was held.
+#
+# Replays are read lazily from the sources given and only a bounded number are in flight at once, so an archive
+# doesn't have to fit in memory. Results are written to an output directory:
+#   pieces.csv        one row per piece
+#   games.jsonl       one JSON summary per game, in the order the replays were found
+#   checkpoint.json   how many replays are done, the output files' sizes at that point and the running totals
+#   summary.json      the aggregate summary, once every replay is done
+# With --resume, a run picks up after the last checkpoint: the output files are cut back to the sizes it recorded and
+# the replays it had covered are skipped. Directories are walked in sorted order, so the replays line up again.
+#
+# Usage:
+#   python tetris_analytics.py replays/ more.replay --output analysis [--workers 4] [--resume]
+
+import argparse
+import csv
+import json
+import os
+import struct
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+from tetris import FPS, register_table_rebuilder
+from tetris_placements import MASK_MARGIN, TranspositionTable, board_bits, build_board_masks, search_key_presses
+from tetris_replay import load_replay, play_replay
+
+PIECE_LETTERS = "IJLOSTZ"
+REPLAY_EXTENSION = ".replay"
+CHECKPOINT_FORMAT = 1
+PIECE_COLUMNS = ["game", "piece", "type", "held", "keys", "optimal_keys", "finesse_faults", "ticks", "pps", "lines"]
+
+# Fewest key presses per placement found by search_key_presses(), keyed by (board, piece type, width, height).
+FINESSE_TABLE = TranspositionTable(1024)
+register_table_rebuilder(FINESSE_TABLE.clear)
+
+def iter_replay_paths(sources):
+    '''Yields the replay files in "sources", which are files or directories. Directories are walked recursively in
+    sorted order for files ending in REPLAY_EXTENSION.'''
+
+    for source in sources:
+        if not os.path.isdir(source):
+            yield(source)
+            continue
+
+        for directory, subdirectories, filenames in os.walk(source):
+            subdirectories.sort()
+            for filename in sorted(filenames):
+                if filename.endswith(REPLAY_EXTENSION):
+                    yield(os.path.join(directory, filename))
+
+def placement_presses(board, piece_type, matrix_width, matrix_height):
+    '''Returns search_key_presses() for the board and piece, from FINESSE_TABLE if it's been searched before.'''
+
+    key = (board, piece_type, matrix_width, matrix_height)
+    presses = FINESSE_TABLE.get(key)
+    if presses == None:
+        presses = search_key_presses(board, piece_type, matrix_width, matrix_height)
+        FINESSE_TABLE.put(key, presses)
+
+    return(presses)
+
+def count_totals(pieces):
+    '''Adds up per-piece rows (laid out as PIECE_COLUMNS) into the counts summaries are made from.'''
+
+    counts = {"pieces": 0, "ticks": 0, "keys": 0, "graded": 0, "faults": 0, "perfect": 0, "holds": 0,
+              "by_type": {letter: [0, 0, 0] for letter in PIECE_LETTERS}}
+    for game, piece, letter, held, keys, optimal_keys, faults, ticks, pps, lines in pieces:
+        counts["pieces"] += 1
+        counts["ticks"] += ticks
+        counts["keys"] += keys
+        counts["holds"] += held
+        type_counts = counts["by_type"][letter]
+        type_counts[0] += 1
+        type_counts[1] += keys
+        if optimal_keys != None:
+            counts["graded"] += 1
+            counts["faults"] += faults
+            counts["perfect"] += faults == 0
+            type_counts[2] += faults
+
+    return(counts)
+
+def rates(counts):
+    '''Returns the rates a summary reports from its counts. Faults are per graded piece, the pieces whose placement the
+    key press search found.'''
+
+    seconds = counts["ticks"] / FPS
+    return({
+        "pps": counts["pieces"] / seconds if seconds > 0 else 0.0,
+        "kpp": counts["keys"] / counts["pieces"] if counts["pieces"] else 0.0,
+        "faults_per_piece": counts["faults"] / counts["graded"] if counts["graded"] else 0.0,
+        "finesse_accuracy": counts["perfect"] / counts["graded"] if counts["graded"] else 0.0,
+        "hold_rate": counts["holds"] / counts["pieces"] if counts["pieces"] else 0.0,
+        "by_type": {letter: {"pieces": pieces, "kpp": keys / pieces if pieces else 0.0, "faults": faults}
+                    for letter, (pieces, keys, faults) in counts["by_type"].items()},
+    })
+
+def analyze_replay(path):
+    '''Plays back the replay at "path" and grades every piece that locked. Pool worker entry point.
+
+    Returns the game's summary and its pieces as rows laid out like PIECE_COLUMNS, with the game column left None for
+    the caller to fill in. A replay that can't be read comes back as a summary with an "error" and no pieces.'''
+
+    try:
+        seed, handling, matrix_size, runs = load_replay(path)
+    except (OSError, ValueError, IndexError, struct.error) as error:
+        return({"path": path, "error": str(error)}, [])
+
+    masks = build_board_masks(*matrix_size)
+    pieces = []
+    # The piece in play: the board it spawned onto, keys pressed and ticks taken since then.
+    piece = {"board": 0, "keys": 0, "ticks": 0, "previous_inputs": 0}
+
+    def on_tick(game, tick):
+        piece["keys"] += bin(game.held_inputs & ~piece["previous_inputs"]).count("1")
+        piece["previous_inputs"] = game.held_inputs
+        piece["ticks"] += 1
+        if game.last_line_clear == None:
+            return
+
+        piece_type, x, y, rotation, hold_used = game.last_placement
+        cells = masks[piece_type][rotation][x + MASK_MARGIN][y + MASK_MARGIN]
+        optimal_keys = placement_presses(piece["board"], piece_type, *matrix_size).get(cells)
+        faults = None
+        if optimal_keys != None:
+            optimal_keys += 1 if hold_used else 0
+            faults = max(0, piece["keys"] - optimal_keys)
+
+        pieces.append((None, len(pieces), PIECE_LETTERS[piece_type], int(hold_used), piece["keys"], optimal_keys, faults,
+                       piece["ticks"], round(FPS / piece["ticks"], 3), game.last_line_clear[1]))
+        piece["board"] = board_bits(game)
+        piece["keys"] = 0
+        piece["ticks"] = 0
+
+    game = play_replay(seed, handling, runs, on_tick=on_tick, matrix_size=matrix_size)
+
+    counts = count_totals(pieces)
+    summary = {"path": path, "seed": seed, "score": game.score, "lines": game.total_lines_cleared, "level": game.level,
+               "topped_out": not game.game_active, "ticks": sum(length for inputs, length in runs)}
+    summary.update((name, counts[name]) for name in ("pieces", "keys", "graded", "faults", "holds"))
+    summary.update(rates(counts))
+    return(summary, pieces)
+
+def analyze_stream(paths, workers = None, max_pending = 64):
+    '''Analyzes the replays in the iterable "paths" on a process pool, yielding (game summary, pieces) for each in order.
+
+    "paths" is only read as far as the pool needs: at most "max_pending" replays are queued or being played back at once.'''
+
+    with ProcessPoolExecutor(workers) as executor:
+        pending = deque()
+        for path in paths:
+            pending.append(executor.submit(analyze_replay, path))
+            if len(pending) >= max_pending:
+                yield(pending.popleft().result())
+
+        while pending:
+            yield(pending.popleft().result())
+
+def new_totals():
+    '''Returns the running totals of a run that hasn't analyzed anything yet.'''
+
+    totals = count_totals([])
+    totals.update({"games": 0, "errors": 0, "lines": 0, "topped_out": 0, "pps_min": None, "pps_max": None})
+    return(totals)
+
+def add_game(totals, summary, pieces):
+    '''Adds a game's summary and pieces to the running totals.'''
+
+    totals["games"] += 1
+    if "error" in summary:
+        totals["errors"] += 1
+        return
+
+    counts = count_totals(pieces)
+    for name in ("pieces", "ticks", "keys", "graded", "faults", "perfect", "holds"):
+        totals[name] += counts[name]
+    for letter, type_counts in counts["by_type"].items():
+        totals["by_type"][letter] = [total + count for total, count in zip(totals["by_type"][letter], type_counts)]
+    totals["lines"] += summary["lines"]
+    totals["topped_out"] += summary["topped_out"]
+    if summary["pieces"] > 0:
+        totals["pps_min"] = summary["pps"] if totals["pps_min"] == None else min(totals["pps_min"], summary["pps"])
+        totals["pps_max"] = summary["pps"] if totals["pps_max"] == None else max(totals["pps_max"], summary["pps"])
+
+def summarize(totals):
+    '''Returns the aggregate summary of a run's totals. "pps" is over the time spent on every piece together and
+    "pps_min" and "pps_max" are the slowest and fastest games.'''
+
+    summary = {name: totals[name] for name in ("games", "errors", "pieces", "lines", "topped_out", "keys", "graded", "faults", "holds")}
+    summary.update(rates(totals))
+    summary["pps_min"] = totals["pps_min"]
+    summary["pps_max"] = totals["pps_max"]
+    return(summary)
+
+def write_json(path, value):
+    '''Writes "value" to "path" as JSON under a temporary name and renames it into place, so it's never half-written.'''
+
+    file_descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+    with os.fdopen(file_descriptor, "w") as json_file:
+        json.dump(value, json_file, indent=2)
+        json_file.flush()
+        os.fsync(json_file.fileno())
+    os.replace(temporary_path, path)
+
+def load_checkpoint(path, sources):
+    '''Returns the checkpoint at "path", or None if there isn't one. Raises ValueError if it's from a run over other sources.'''
+
+    try:
+        with open(path) as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+    except FileNotFoundError:
+        return(None)
+
+    if checkpoint.get("format") != CHECKPOINT_FORMAT or checkpoint.get("sources") != sources:
+        raise ValueError(f"{path} is a checkpoint of a run over other replays")
+    return(checkpoint)
+
+def open_output(path, size):
+    '''Opens an output file for appending after cutting it back to "size" bytes, or creating it empty if "size" is 0.'''
+
+    output_file = open(path, "a+" if size > 0 else "w", newline="")
+    output_file.truncate(size)
+    output_file.seek(size)
+    return(output_file)
+
+def run_analysis(sources, output_directory, workers = None, checkpoint_every = 100, resume = False, max_pending = 64):
+    '''Analyzes every replay in "sources" into "output_directory" and returns the aggregate summary.
+
+    A checkpoint is saved after every "checkpoint_every" replays. With "resume", the run carries on from the last
+    checkpoint in "output_directory" if there is one, otherwise it starts over.'''
+
+    os.makedirs(output_directory, exist_ok=True)
+    pieces_path = os.path.join(output_directory, "pieces.csv")
+    games_path = os.path.join(output_directory, "games.jsonl")
+    checkpoint_path = os.path.join(output_directory, "checkpoint.json")
+
+    checkpoint = load_checkpoint(checkpoint_path, sources) if resume else None
+    if checkpoint == None:
+        checkpoint = {"format": CHECKPOINT_FORMAT, "sources": sources, "games": 0, "pieces_bytes": 0, "games_bytes": 0,
+                      "totals": new_totals()}
+    totals = checkpoint["totals"]
+
+    def save_checkpoint():
+        pieces_file.flush()
+        games_file.flush()
+        os.fsync(pieces_file.fileno())
+        os.fsync(games_file.fileno())
+        checkpoint.update({"games": totals["games"], "pieces_bytes": pieces_file.tell(), "games_bytes": games_file.tell()})
+        write_json(checkpoint_path, checkpoint)
+
+    with open_output(pieces_path, checkpoint["pieces_bytes"]) as pieces_file, open_output(games_path, checkpoint["games_bytes"]) as games_file:
+        pieces_writer = csv.writer(pieces_file)
+        if checkpoint["pieces_bytes"] == 0:
+            pieces_writer.writerow(PIECE_COLUMNS)
+
+        paths = islice(iter_replay_paths(sources), checkpoint["games"], None)
+        for summary, pieces in analyze_stream(paths, workers, max_pending):
+            game_number = totals["games"]
+            pieces_writer.writerows((game_number,) + row[1:] for row in pieces)
+            games_file.write(json.dumps(dict(summary, game=game_number)) + "\n")
+            add_game(totals, summary, pieces)
+
+            if totals["games"] % checkpoint_every == 0:
+                save_checkpoint()
+
+        save_checkpoint()
+
+    summary = summarize(totals)
+    write_json(os.path.join(output_directory, "summary.json"), summary)
+    return(summary)
+
+def main():
+    '''Command-line entry point.'''
+
+    parser = argparse.ArgumentParser(description="Grades KPP, PPS, finesse and hold usage over archives of Tetris replays.")
+    parser.add_argument("sources", nargs="+", help="replay files, or directories searched recursively for *.replay files")
+    parser.add_argument("--output", required=True, help="directory to write pieces.csv, games.jsonl, checkpoint.json and summary.json to")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: one per core)")
+    parser.add_argument("--checkpoint-every", type=int, default=100, help="save a checkpoint after this many replays (default: 100)")
+    parser.add_argument("--max-pending", type=int, default=64, help="most replays queued on the pool at once (default: 64)")
+    parser.add_argument("--resume", action="store_true", help="carry on from the output directory's checkpoint")
+    args = parser.parse_args()
+
+    start_time = time.perf_counter()
+    summary = run_analysis(args.sources, args.output, args.workers, args.checkpoint_every, args.resume, args.max_pending)
+    elapsed = time.perf_counter() - start_time
+
+    summary["wall_time"] = elapsed
+    print(json.dumps(summary, indent=2))
+
+if __name__ == "__main__":
+    main()
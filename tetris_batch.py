@@ -0,0 +1,452 @@
+# Runs many games of Tetris in lockstep, with every board's state stored in NumPy arrays.
+# Follows the same rules as Tetris.step() in tetris.py, tick for tick.
+
+import numpy as np
+
+from tetris import (FPS, INPUT_HARD_DROP, INPUT_HOLD, INPUT_MOVE_LEFT, INPUT_MOVE_RIGHT, INPUT_ROTATE_180,
+                    INPUT_ROTATE_CCW, INPUT_ROTATE_CW, INPUT_SOFT_DROP, SevenBagRandomizer, Tetris, Tetromino,
+                    register_table_rebuilder)
+
+def build_piece_cells():
+    '''Returns an array of shape (7, 4, 4, 2) holding the (row, column) of each cell of every figure, indexed [type][rotation][cell].'''
+
+    cells = np.zeros((7, 4, 4, 2), dtype=np.int64)
+    for piece_type, figure_rotations in enumerate(Tetris.FIGURE_CELLS):
+        for rotation, figure in enumerate(figure_rotations):
+            cells[piece_type, rotation] = figure
+
+    return(cells)
+
+def build_kick_table():
+    '''Returns the SRS kicks as arrays indexed [type][rotation][new rotation][test].
+
+    The first array holds the (x, y) difference of each test, matching the x_difference and y_difference
+    worked out in Tetromino.rotate(). The second array marks which tests exist for each type (the O piece only has one).'''
+
+    kicks = np.zeros((7, 4, 4, 5, 2), dtype=np.int64)
+    valid = np.zeros((7, 5), dtype=bool)
+    for piece_type in range(7):
+        for rotation in range(4):
+            for new_rotation in range(4):
+                if piece_type == 0:
+                    tests = [(Tetromino.I_OFFSET_DATA[rotation][i], Tetromino.I_OFFSET_DATA[new_rotation][i]) for i in range(5)]
+                elif piece_type == 3:
+                    tests = [(Tetromino.O_OFFSET_DATA[rotation], Tetromino.O_OFFSET_DATA[new_rotation])]
+                else:
+                    tests = [(Tetromino.JLSTZ_OFFSET_DATA[rotation][i], Tetromino.JLSTZ_OFFSET_DATA[new_rotation][i]) for i in range(5)]
+
+                for i, (previous_offset, new_offset) in enumerate(tests):
+                    kicks[piece_type, rotation, new_rotation, i] = (previous_offset[0] - new_offset[0], previous_offset[1] - new_offset[1])
+                    valid[piece_type, i] = True
+
+    return(kicks, valid)
+
+PIECE_CELLS = build_piece_cells()
+KICKS, KICK_TESTS = build_kick_table()
+GRAVITY_STEPS = np.array(Tetris.GRAVITY_STEPS, dtype=np.int64)
+SPAWN_X = np.array([Tetromino.spawn_position(piece_type)[0] for piece_type in range(7)], dtype=np.int64)
+SPAWN_Y = np.array([Tetromino.spawn_position(piece_type)[1] for piece_type in range(7)], dtype=np.int64)
+LINE_SCORES = np.array([0, 100, 300, 500, 800], dtype=np.int64)
+
+@register_table_rebuilder
+def rebuild_tables():
+    '''Rebuilds the piece, kick, gravity and spawn tables from the engine's tables. The fixed-size ones are updated in
+    place, since tetris_features.py imports PIECE_CELLS by name.'''
+
+    global GRAVITY_STEPS
+    PIECE_CELLS[...] = build_piece_cells()
+    KICKS[...], KICK_TESTS[...] = build_kick_table()
+    GRAVITY_STEPS = np.array(Tetris.GRAVITY_STEPS, dtype=np.int64)
+    SPAWN_X[...] = [Tetromino.spawn_position(piece_type)[0] for piece_type in range(7)]
+    SPAWN_Y[...] = [Tetromino.spawn_position(piece_type)[1] for piece_type in range(7)]
+
+# Each board's queue is a ring buffer. It never holds more than 12 pieces.
+QUEUE_CAPACITY = 16
+
+class BatchTetris:
+    '''N independent games of Tetris, advanced together with one call to step().
+
+    The field is an (N, MATRIX_HEIGHT, MATRIX_WIDTH) array using the same cell values as Tetris.field.
+    The active piece is stored in piece_type, piece_x, piece_y and piece_rotation, where piece_type is -1 if there is no active piece.
+    piece_held is -1 when nothing is held.'''
+
+    def __init__(self, board_count, seeds = None):
+        '''Creates "board_count" new games. Board i deals its pieces from SevenBagRandomizer(seeds[i]), which
+        gives the same pieces as Tetris(seed = seeds[i]). Boards are unseeded if "seeds" is None.'''
+
+        n = board_count
+        self.board_count = n
+        if seeds == None:
+            seeds = [None for i in range(n)]
+        self.randomizers = [SevenBagRandomizer(seed) for seed in seeds]
+
+        # Game info - Stats
+        self.score = np.zeros(n, dtype=np.int64)
+        self.level = np.ones(n, dtype=np.int64)
+        self.total_lines_cleared = np.zeros(n, dtype=np.int64)
+        self.lines_cleared = np.zeros(n, dtype=np.int64)
+        self.pieces_locked = np.zeros(n, dtype=bool)
+
+        # Game info - Active piece
+        self.piece_type = np.full(n, -1, dtype=np.int64)
+        self.piece_x = np.zeros(n, dtype=np.int64)
+        self.piece_y = np.zeros(n, dtype=np.int64)
+        self.piece_rotation = np.zeros(n, dtype=np.int64)
+        self.move_reset_counter = np.zeros(n, dtype=np.int64)
+
+        # Game info - Other
+        self.piece_held = np.full(n, -1, dtype=np.int64)
+        self.hold_used = np.zeros(n, dtype=bool)
+        self.lock_delay = np.zeros(n, dtype=bool)
+        self.lock_timer = np.zeros(n, dtype=np.int64)
+        self.current_frame = np.zeros(n, dtype=np.int64)
+        self.gravity_progress = np.zeros(n, dtype=np.int64)
+
+        # User input info
+        self.held_inputs = np.zeros(n, dtype=np.int64)
+        self.soft_dropping = np.zeros(n, dtype=bool)
+        self.do_das_left = np.zeros(n, dtype=bool)
+        self.do_das_right = np.zeros(n, dtype=bool)
+        self.das_left_timer = np.zeros(n, dtype=np.int64)
+        self.das_right_timer = np.zeros(n, dtype=np.int64)
+        self.arr_timer = np.zeros(n, dtype=np.int64)
+
+        # Matrices, queues and game states
+        self.field = np.zeros((n, Tetris.MATRIX_HEIGHT, Tetris.MATRIX_WIDTH), dtype=np.int8)
+        self.queue = np.zeros((n, QUEUE_CAPACITY), dtype=np.int64)
+        self.queue_head = np.zeros(n, dtype=np.int64)
+        self.queue_length = np.zeros(n, dtype=np.int64)
+        self.game_active = np.ones(n, dtype=bool)
+
+    def preview(self, count = 5):
+        '''Returns the next "count" pieces in every board's queue as an (N, count) array.'''
+
+        positions = (self.queue_head[:, None] + np.arange(count)) % QUEUE_CAPACITY
+        return(np.take_along_axis(self.queue, positions, axis=1))
+
+    def step(self, inputs = 0):
+        '''Advances every board by one tick. "inputs" is a single INPUT_* bitmask or one per board.
+
+        Returns the number of lines cleared on each board during this tick. self.pieces_locked marks the boards where a
+        piece locked during this tick, like Tetris.step() returning a line clear.'''
+
+        inputs = np.broadcast_to(np.asarray(inputs, dtype=np.int64), (self.board_count,))
+        self.lines_cleared[:] = 0
+        self.pieces_locked[:] = False
+
+        active = np.nonzero(self.game_active)[0]
+        if len(active) == 0:
+            return(self.lines_cleared.copy())
+
+        # Stores the current frame and level.
+        self.current_frame[active] = (self.current_frame[active] + 1) % FPS
+        self.level[active] = 1 + self.total_lines_cleared[active] // 10
+
+        self.spawn_pieces(active[self.piece_type[active] < 0], "Queue")
+
+        # Gravity, added up in fractions of a row like Tetris.apply_gravity()
+        gravity_rows = np.minimum(self.level[active], len(GRAVITY_STEPS)) - 1
+        falling_distance, self.gravity_progress[active] = np.divmod(self.gravity_progress[active] + GRAVITY_STEPS[gravity_rows],
+                                                                    Tetris.GRAVITY_DENOMINATOR)
+        for i in range(falling_distance.max()):
+            self.move_pieces_down(active[falling_distance > i])
+
+        self.handle_inputs(active, inputs[active])
+        self.update_timers(active)
+
+        self.move_pieces_down(active[self.soft_dropping[active]])
+
+        # Auto-repeat, on the tick DAS charges and then every ARR_TICKS ticks. An ARR of 0 isn't supported here.
+        repeating = active[self.do_das_right[active] | self.do_das_left[active]]
+        counting = repeating[self.arr_timer[repeating] > 0]
+        self.arr_timer[counting] -= 1
+        repeating = repeating[self.arr_timer[repeating] == 0]
+        self.arr_timer[repeating] = Tetris.ARR_TICKS
+        das_right = repeating[self.do_das_right[repeating]]
+        das_left = repeating[~self.do_das_right[repeating]]
+        self.move_pieces_h(das_right, 1)
+        self.move_pieces_h(das_left, -1)
+
+        # Checks for intersection after everything else.
+        with_piece = active[self.piece_type[active] >= 0]
+        topped_out = self.intersects(with_piece, self.piece_type[with_piece], self.piece_rotation[with_piece],
+                                     self.piece_x[with_piece], self.piece_y[with_piece])
+        self.game_active[with_piece[topped_out]] = False
+
+        return(self.lines_cleared.copy())
+
+    def handle_inputs(self, boards, inputs):
+        '''Applies the keys pressed and released since the previous tick on each of "boards".'''
+
+        pressed = inputs & ~self.held_inputs[boards]
+        released = self.held_inputs[boards] & ~inputs
+        self.held_inputs[boards] = inputs
+
+        self.soft_dropping[boards[pressed & INPUT_SOFT_DROP != 0]] = True
+
+        # Left and right movement
+        moving_left = boards[pressed & INPUT_MOVE_LEFT != 0]
+        self.move_pieces_h(moving_left, -1)
+        self.das_left_timer[moving_left] = Tetris.DAS_TICKS
+        self.do_das_right[moving_left] = False
+
+        moving_right = boards[pressed & INPUT_MOVE_RIGHT != 0]
+        self.move_pieces_h(moving_right, 1)
+        self.das_right_timer[moving_right] = Tetris.DAS_TICKS
+        self.do_das_left[moving_right] = False
+
+        # Piece rotation
+        self.rotate_pieces(boards[pressed & INPUT_ROTATE_CCW != 0], -1)
+        self.rotate_pieces(boards[pressed & INPUT_ROTATE_180 != 0], 2)
+        self.rotate_pieces(boards[pressed & INPUT_ROTATE_CW != 0], 1)
+
+        self.hold_pieces(boards[pressed & INPUT_HOLD != 0])
+        self.hard_drop(boards[pressed & INPUT_HARD_DROP != 0])
+
+        # Key releases
+        self.soft_dropping[boards[released & INPUT_SOFT_DROP != 0]] = False
+
+        released_left = boards[released & INPUT_MOVE_LEFT != 0]
+        self.das_left_timer[released_left] = 0
+        self.do_das_left[released_left] = False
+
+        released_right = boards[released & INPUT_MOVE_RIGHT != 0]
+        self.das_right_timer[released_right] = 0
+        self.do_das_right[released_right] = False
+
+    def update_timers(self, boards):
+        '''Counts down the piece lock and DAS timers of "boards" by one tick, acting on any that run out.'''
+
+        locking = boards[self.lock_delay[boards]]
+        self.lock_timer[locking] -= 1
+        expired = locking[self.lock_timer[locking] <= 0]
+        self.lock_timer[expired] = Tetris.LOCK_DELAY_TICKS
+        self.place_pieces(expired)
+
+        das_left = boards[self.das_left_timer[boards] > 0]
+        self.das_left_timer[das_left] -= 1
+        fired = das_left[self.das_left_timer[das_left] == 0]
+        self.do_das_left[fired] = True
+        self.das_right_timer[fired] = 0
+        self.arr_timer[fired] = 0
+
+        das_right = boards[self.das_right_timer[boards] > 0]
+        self.das_right_timer[das_right] -= 1
+        fired = das_right[self.das_right_timer[das_right] == 0]
+        self.do_das_right[fired] = True
+        self.das_left_timer[fired] = 0
+        self.arr_timer[fired] = 0
+
+    def advance_piece_queues(self, boards):
+        '''Refills the queues of "boards" if needed, then removes the first piece of each and returns them.'''
+
+        for board in boards[self.queue_length[boards] < 6]:
+            randomizer = self.randomizers[board]
+            bag = randomizer.bag(randomizer.bags_dealt)
+            randomizer.bags_dealt += 1
+            positions = (self.queue_head[board] + self.queue_length[board] + np.arange(7)) % QUEUE_CAPACITY
+            self.queue[board, positions] = bag
+            self.queue_length[board] += 7
+
+        new_pieces = self.queue[boards, self.queue_head[boards]]
+        self.queue_head[boards] = (self.queue_head[boards] + 1) % QUEUE_CAPACITY
+        self.queue_length[boards] -= 1
+        return(new_pieces)
+
+    def spawn_pieces(self, boards, source):
+        '''Spawns a new active piece on each of "boards". "source" is either "Hold" or "Queue", like Tetromino().'''
+
+        if source == "Queue":
+            new_pieces = self.advance_piece_queues(boards)
+        else:
+            new_pieces = self.piece_held[boards].copy()
+            from_queue = new_pieces < 0
+            new_pieces[from_queue] = self.advance_piece_queues(boards[from_queue])
+
+        self.piece_type[boards] = new_pieces
+        self.piece_x[boards] = SPAWN_X[new_pieces]
+        self.piece_y[boards] = SPAWN_Y[new_pieces]
+        self.piece_rotation[boards] = 0
+        self.move_reset_counter[boards] = 0
+        self.lock_delay[boards] = False
+        self.lock_timer[boards] = 0
+
+    def intersects(self, boards, types, rotations, xs, ys):
+        '''Checks, for each of "boards", whether a piece with the given type, rotation and position is outside the matrix or overlaps it.'''
+
+        cells = PIECE_CELLS[types, rotations]
+        rows = ys[:, None] + cells[:, :, 0]
+        columns = xs[:, None] + cells[:, :, 1]
+        outside = (rows < 0) | (rows >= Tetris.MATRIX_HEIGHT) | (columns < 0) | (columns >= Tetris.MATRIX_WIDTH)
+        filled = self.field[boards[:, None], np.clip(rows, 0, Tetris.MATRIX_HEIGHT - 1), np.clip(columns, 0, Tetris.MATRIX_WIDTH - 1)] != 0
+        return((outside | filled).any(axis=1))
+
+    def move_pieces_h(self, boards, dx):
+        '''Moves the active piece of each of "boards" along the X axis.'''
+
+        boards = boards[self.piece_type[boards] >= 0]
+        blocked = self.intersects(boards, self.piece_type[boards], self.piece_rotation[boards],
+                                  self.piece_x[boards] + dx, self.piece_y[boards])
+        self.piece_x[boards[~blocked]] += dx
+
+        resetting = boards[self.lock_delay[boards]]
+        self.move_reset_counter[resetting] += 1
+        self.lock_timer[resetting] = Tetris.LOCK_DELAY_TICKS
+
+    def move_pieces_down(self, boards):
+        '''Moves the active piece of each of "boards" down 1 space, starting piece lock where it lands.'''
+
+        boards = boards[self.piece_type[boards] >= 0]
+        landed = self.intersects(boards, self.piece_type[boards], self.piece_rotation[boards],
+                                 self.piece_x[boards], self.piece_y[boards] + 1)
+
+        # Deactivates piece lock if the piece moves down before the player maxes out their move reset.
+        moved = boards[~landed]
+        self.piece_y[moved] += 1
+        moved = moved[self.move_reset_counter[moved] < Tetris.MOVE_RESET_LIMIT]
+        self.lock_delay[moved] = False
+        self.lock_timer[moved] = 0
+
+        # Places pieces that have evaded piece lock 15 times, and starts piece lock on the rest.
+        landed = boards[landed]
+        out_of_resets = self.move_reset_counter[landed] >= Tetris.MOVE_RESET_LIMIT
+        starting = landed[~out_of_resets]
+        starting = starting[~self.lock_delay[starting]]
+        self.lock_delay[starting] = True
+        self.move_reset_counter[starting] = 0
+        self.lock_timer[starting] = Tetris.LOCK_DELAY_TICKS
+
+        self.place_pieces(landed[out_of_resets])
+
+    def rotate_pieces(self, boards, rotation_distance):
+        '''Rotates the active piece of each of "boards" using the Super Rotation System.'''
+
+        boards = boards[self.piece_type[boards] >= 0]
+        types = self.piece_type[boards]
+        rotations = self.piece_rotation[boards]
+        new_rotations = (rotations + rotation_distance) % 4
+        rotated = np.zeros(len(boards), dtype=bool)
+
+        # Tries each kick in order, stopping at the first one that fits.
+        for i in range(KICKS.shape[3]):
+            trying = np.nonzero(~rotated & KICK_TESTS[types, i])[0]
+            kicks = KICKS[types[trying], rotations[trying], new_rotations[trying], i]
+            new_xs = self.piece_x[boards[trying]] + kicks[:, 0]
+            new_ys = self.piece_y[boards[trying]] - kicks[:, 1]
+            fits = ~self.intersects(boards[trying], types[trying], new_rotations[trying], new_xs, new_ys)
+
+            fitting = boards[trying[fits]]
+            self.piece_rotation[fitting] = new_rotations[trying[fits]]
+            self.piece_x[fitting] = new_xs[fits]
+            self.piece_y[fitting] = new_ys[fits]
+            rotated[trying[fits]] = True
+
+        resetting = boards[self.lock_delay[boards]]
+        self.move_reset_counter[resetting] += 1
+        self.lock_timer[resetting] = Tetris.LOCK_DELAY_TICKS
+
+    def hold_pieces(self, boards):
+        '''Swaps the active piece of each of "boards" with the piece in its hold space.'''
+
+        boards = boards[(self.piece_type[boards] >= 0) & ~self.hold_used[boards]]
+        previous_pieces = self.piece_type[boards].copy()
+        self.spawn_pieces(boards, "Hold")
+        self.piece_held[boards] = previous_pieces
+        self.hold_used[boards] = True
+
+    def drop_distances(self, boards):
+        '''Returns how many rows the active piece of each of "boards" can fall before landing.'''
+
+        # next_filled[b, r, c] is the first filled row at or below row r in column c, or MATRIX_HEIGHT if there is none.
+        filled_rows = np.where(self.field[boards] != 0, np.arange(Tetris.MATRIX_HEIGHT)[:, None], Tetris.MATRIX_HEIGHT)
+        next_filled = np.minimum.accumulate(filled_rows[:, ::-1], axis=1)[:, ::-1]
+        next_filled = np.concatenate([next_filled, np.full((len(boards), 1, Tetris.MATRIX_WIDTH), Tetris.MATRIX_HEIGHT)], axis=1)
+
+        # Each cell can fall until the next filled cell below it, so the piece falls as far as its most limited cell.
+        cells = PIECE_CELLS[self.piece_type[boards], self.piece_rotation[boards]]
+        rows = self.piece_y[boards][:, None] + cells[:, :, 0]
+        columns = self.piece_x[boards][:, None] + cells[:, :, 1]
+        distances = next_filled[np.arange(len(boards))[:, None], rows + 1, columns] - rows - 1
+        return(distances.min(axis=1))
+
+    def hard_drop(self, boards):
+        '''Drops the active piece of each of "boards" as far as it can go and locks it.'''
+
+        self.soft_dropping[boards] = False
+        boards = boards[self.piece_type[boards] >= 0]
+        self.piece_y[boards] += self.drop_distances(boards)
+        self.place_pieces(boards)
+
+    def place_pieces(self, boards):
+        '''Locks the active piece of each of "boards" into place and clears any completed lines.'''
+
+        # Check to make sure the piece should be placed
+        boards = boards[(self.piece_type[boards] >= 0) & self.game_active[boards]]
+        grounded = self.intersects(boards, self.piece_type[boards], self.piece_rotation[boards],
+                                   self.piece_x[boards], self.piece_y[boards] + 1)
+        boards = boards[grounded]
+        if len(boards) == 0:
+            return
+
+        cells = PIECE_CELLS[self.piece_type[boards], self.piece_rotation[boards]]
+        rows = self.piece_y[boards][:, None] + cells[:, :, 0]
+        columns = self.piece_x[boards][:, None] + cells[:, :, 1]
+        self.field[boards[:, None], rows, columns] = (self.piece_type[boards] + 1)[:, None]
+        self.pieces_locked[boards] = True
+
+        self.clear_lines(boards)
+
+        self.lock_delay[boards] = False
+        self.lock_timer[boards] = 0
+        self.hold_used[boards] = False
+        self.piece_type[boards] = -1
+
+    def clear_lines(self, boards):
+        '''Clears every full row on each of "boards", shifting the rows above down, and adds to the score.'''
+
+        full_rows = (self.field[boards] != 0).all(axis=2)
+        lines = full_rows.sum(axis=1)
+
+        clearing = boards[lines > 0]
+        if len(clearing) > 0:
+            # A stable sort moves the full rows to the top while keeping the order of every other row. They are then emptied.
+            full_rows = full_rows[lines > 0]
+            order = np.argsort(~full_rows, axis=1, kind="stable")
+            self.field[clearing] = np.take_along_axis(self.field[clearing], order[:, :, None], axis=1)
+            self.field[clearing] *= np.arange(Tetris.MATRIX_HEIGHT)[None, :, None] >= lines[lines > 0][:, None, None]
+
+        self.lines_cleared[boards] = lines
+        self.total_lines_cleared[boards] += lines
+        self.score[boards] += LINE_SCORES[lines] * self.level[boards]
+
+    def insert_garbage(self, boards, hole_columns):
+        '''Pushes the matrix of each of "boards" up and fills the rows left at the bottom with garbage, like
+        Tetris.insert_garbage(). "hole_columns" is an (N, lines) array of each garbage row's hole, top to bottom. Past
+        the height of the matrix, only the last rows are kept.'''
+
+        lines = min(hole_columns.shape[1], Tetris.MATRIX_HEIGHT)
+        if len(boards) == 0 or lines == 0:
+            return
+
+        hole_columns = hole_columns[:, -lines:]
+
+        # Rows pushed off the top that weren't empty top the game out.
+        topped_out = (self.field[boards, :lines] != 0).any(axis=(1, 2))
+        self.game_active[boards[topped_out]] = False
+
+        # Shifts every row up in one copy, then writes the garbage under it.
+        self.field[boards, :-lines] = self.field[boards, lines:]
+        self.field[boards, -lines:] = np.where(np.arange(Tetris.MATRIX_WIDTH) == hole_columns[:, :, None], 0, Tetris.GARBAGE_CELL)
+
+        # The active piece is pushed up out of the garbage, if it can be.
+        with_piece = boards[self.piece_type[boards] >= 0]
+        for i in range(lines):
+            overlapping = with_piece[self.intersects(with_piece, self.piece_type[with_piece], self.piece_rotation[with_piece],
+                                                     self.piece_x[with_piece], self.piece_y[with_piece])]
+            if len(overlapping) == 0:
+                break
+            self.piece_y[overlapping] -= 1
+
+        overlapping = self.intersects(with_piece, self.piece_type[with_piece], self.piece_rotation[with_piece],
+                                      self.piece_x[with_piece], self.piece_y[with_piece])
+        self.game_active[with_piece[overlapping]] = False
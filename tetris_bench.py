@@ -0,0 +1,460 @@
+# Benchmarks the engine's hot paths on fixed, seeded boards, plus one full frame of the pygame renderer.
+#
+# Usage:
+#   python tetris_bench.py --output results.json
+#   python tetris_bench.py --compare baseline.json --threshold 0.10
+#
+# Results are JSON, keyed by benchmark name, in nanoseconds per call. With --compare, any benchmark that got
+# slower than the baseline by more than the threshold is reported and the exit code is 1.
+
+import argparse
+import copy
+import json
+import os
+import platform
+import random as rand
+import statistics
+import subprocess
+import sys
+import time
+
+from tetris import FPS, Tetris, Tetromino
+from tetris_placements import KICK_OFFSETS
+
+FIXTURE_SEED = 2025
+BACKENDS = ["list", "bitboard"]
+# (width, height) of the matrices the "sizes" group compares
+MATRIX_SIZES = [(10, 20), (40, 80), (100, 400)]
+# Matches stepped together by the "versus" group
+VERSUS_MATCHES = 500
+
+def make_stack_field(rng, stack_height, full_rows = 0, matrix_width = Tetris.MATRIX_WIDTH, matrix_height = Tetris.MATRIX_HEIGHT):
+    '''Returns a field with "full_rows" complete rows at the bottom and "stack_height" rows of garbage above them, each with one or two holes.'''
+
+    field = [[0 for j in range(matrix_width)] for i in range(matrix_height)]
+    for i in range(matrix_height - full_rows, matrix_height):
+        field[i] = [rng.randint(1, 7) for j in range(matrix_width)]
+
+    for i in range(matrix_height - full_rows - stack_height, matrix_height - full_rows):
+        holes = rng.sample(range(matrix_width), rng.randint(1, 2))
+        field[i] = [0 if j in holes else rng.randint(1, 7) for j in range(matrix_width)]
+
+    return(field)
+
+def make_game(field_backend, field, piece_type = None, x = None, y = None, rotation = 0):
+    '''Returns a game with "field" loaded, sized to fit it, and an active piece of "piece_type" at the given position
+    (its spawn position by default).'''
+
+    game = Tetris(field_backend, seed=FIXTURE_SEED, matrix_width=len(field[0]), matrix_height=len(field))
+    game.load_field(field)
+    if piece_type != None:
+        game.active_piece = Tetromino(game, "Queue")
+        game.active_piece.type = piece_type
+        spawn_x, spawn_y = Tetromino.spawn_position(piece_type, game.matrix_width)
+        game.active_piece.x = spawn_x if x == None else x
+        game.active_piece.y = spawn_y if y == None else y
+        game.active_piece.rotation = rotation
+
+    return(game)
+
+def first_fitting_kick(game, rotation_distance):
+    '''Returns the index of the SRS kick test that the active piece's rotation would use, or None if it can't rotate.'''
+
+    piece = game.active_piece
+    new_rotation = (piece.rotation + rotation_distance) % 4
+    for i, (kick_x, kick_y) in enumerate(KICK_OFFSETS[piece.type][piece.rotation][new_rotation]):
+        if not game.intersects(kick_x, -kick_y, rotation_distance):
+            return(i)
+
+    return(None)
+
+def piece_cells(piece_type, x, y, rotation):
+    '''Returns the (row, column) of every cell a piece of "piece_type" covers at the given position.'''
+
+    scan_dimension = 5 if piece_type == 0 else 3
+    return([(y + cell // scan_dimension, x + cell % scan_dimension) for cell in Tetromino.FIGURES[piece_type][rotation]])
+
+def find_kick_fixture(field_backend, piece_type, kick_index):
+    '''Builds a seeded board where rotating the piece uses kick test "kick_index". Returns the game and rotation distance.
+
+    The board starts as random filled cells around the piece. The cells the piece and the wanted kick cover are cleared,
+    then one cell of every earlier kick that would fit is filled in, so the rotation has to fall through to the wanted one.'''
+
+    rng = rand.Random(FIXTURE_SEED * 31 + piece_type * 7 + kick_index)
+    for attempt in range(10000):
+        x = rng.randint(0, Tetris.MATRIX_WIDTH - 4)
+        y = rng.randint(4, Tetris.MATRIX_HEIGHT - 5)
+        rotation = rng.randint(0, 3)
+        rotation_distance = rng.choice([1, -1, 2])
+        new_rotation = (rotation + rotation_distance) % 4
+        kicks = KICK_OFFSETS[piece_type][rotation][new_rotation]
+
+        kick_x, kick_y = kicks[kick_index]
+        kept_clear = set(piece_cells(piece_type, x, y, rotation)) | set(piece_cells(piece_type, x + kick_x, y + kick_y, new_rotation))
+        if not all(0 <= row < Tetris.MATRIX_HEIGHT and 0 <= column < Tetris.MATRIX_WIDTH for row, column in kept_clear):
+            continue
+
+        field = [[rng.randint(1, 7) if i > y - 2 and rng.random() < 0.5 else 0 for j in range(Tetris.MATRIX_WIDTH)]
+                 for i in range(Tetris.MATRIX_HEIGHT)]
+        for row, column in kept_clear:
+            field[row][column] = 0
+        for kick_x, kick_y in kicks[:kick_index]:
+            blockable = [(row, column) for row, column in piece_cells(piece_type, x + kick_x, y + kick_y, new_rotation)
+                         if (row, column) not in kept_clear and 0 <= row < Tetris.MATRIX_HEIGHT and 0 <= column < Tetris.MATRIX_WIDTH]
+            if blockable:
+                row, column = rng.choice(blockable)
+                field[row][column] = rng.randint(1, 7)
+
+        game = make_game(field_backend, field, piece_type, x, y, rotation)
+        if first_fitting_kick(game, rotation_distance) == kick_index:
+            return(game, rotation_distance)
+
+    raise RuntimeError(f"no fixture found for piece {piece_type}, kick {kick_index}")
+
+def time_calls(run, states, repeats):
+    '''Times run(state) over every state in "states", "repeats" times. Returns nanoseconds per call (best and median of the repeats).'''
+
+    samples = []
+    for i in range(repeats):
+        batch = states() if callable(states) else states
+        start_time = time.perf_counter_ns()
+        for state in batch:
+            run(state)
+        samples.append((time.perf_counter_ns() - start_time) / len(batch))
+
+    return({"ns_per_call": min(samples), "median_ns_per_call": statistics.median(samples)})
+
+def bench_intersects(results, repeats, calls):
+    '''Collision checks of a T piece resting on a garbage stack, for each field backend.'''
+
+    rng = rand.Random(FIXTURE_SEED)
+    field = make_stack_field(rng, 8)
+    for field_backend in BACKENDS:
+        game = make_game(field_backend, field, 5)
+        game.active_piece.y += game.drop_distance()
+        results[f"intersects[{field_backend}]"] = time_calls(lambda offset: game.intersects(0, offset, 0), [-1, 0] * (calls // 2), repeats)
+
+def bench_rotate(results, repeats, calls):
+    '''Tetromino.rotate() through each kick test of the I, O and T (JLSTZ) offset tables, for each field backend.'''
+
+    kick_counts = {0: 5, 3: 1, 5: 5}
+    for field_backend in BACKENDS:
+        for piece_type, kick_count in kick_counts.items():
+            for kick_index in range(kick_count):
+                game, rotation_distance = find_kick_fixture(field_backend, piece_type, kick_index)
+                piece = game.active_piece
+                pose = (piece.x, piece.y, piece.rotation)
+
+                # Puts the piece back after every rotation, so each call takes the same kick path.
+                def rotate_and_reset(state):
+                    piece.rotate(rotation_distance)
+                    piece.x, piece.y, piece.rotation = pose
+
+                name = "IOT"[[0, 3, 5].index(piece_type)]
+                results[f"rotate[{field_backend},{name},kick{kick_index}]"] = time_calls(rotate_and_reset, range(calls), repeats)
+
+def bench_clear_lines(results, repeats, calls):
+    '''clear_lines() on 1 to 4 full rows with 6 rows of garbage above them, for each field backend.'''
+
+    rng = rand.Random(FIXTURE_SEED)
+    for field_backend in BACKENDS:
+        for lines in range(1, 5):
+            template = make_game(field_backend, make_stack_field(rng, 6, lines))
+            rows = range(Tetris.MATRIX_HEIGHT - lines, Tetris.MATRIX_HEIGHT)
+            results[f"clear_lines[{field_backend},{lines}]"] = time_calls(lambda game: game.clear_lines(rows),
+                                                                          lambda: [copy.deepcopy(template) for i in range(calls)], repeats)
+
+def bench_hard_drop(results, repeats, calls):
+    '''hard_drop() of a T piece from its spawn position onto a garbage stack, for each field backend.'''
+
+    rng = rand.Random(FIXTURE_SEED)
+    field = make_stack_field(rng, 8)
+    for field_backend in BACKENDS:
+        template = make_game(field_backend, field, 5)
+        results[f"hard_drop[{field_backend}]"] = time_calls(lambda game: game.hard_drop(),
+                                                            lambda: [copy.deepcopy(template) for i in range(calls)], repeats)
+
+def bench_advance_piece_queue(results, repeats, calls):
+    '''Dealing pieces from the 7-bag randomizer.'''
+
+    game = Tetris(seed=FIXTURE_SEED)
+    results["advance_piece_queue"] = time_calls(lambda state: game.advance_piece_queue(), range(calls), repeats)
+
+def bench_ghost(results, repeats, calls):
+    '''Finding the ghost piece, both from scratch and from the cache, for each field backend.'''
+
+    rng = rand.Random(FIXTURE_SEED)
+    field = make_stack_field(rng, 8)
+    for field_backend in BACKENDS:
+        game = make_game(field_backend, field, 5)
+
+        def uncached(state):
+            game.ghost_key = None
+            game.ghost_piece_y()
+
+        results[f"ghost_piece[{field_backend},uncached]"] = time_calls(uncached, range(calls), repeats)
+        results[f"ghost_piece[{field_backend},cached]"] = time_calls(lambda state: game.ghost_piece_y(), range(calls), repeats)
+
+def bench_snapshot(results, repeats, calls):
+    '''Tetris.snapshot() and restore() of a game with a garbage stack, against copy.deepcopy(), for each field backend.'''
+
+    rng = rand.Random(FIXTURE_SEED)
+    field = make_stack_field(rng, 8)
+    for field_backend in BACKENDS:
+        game = make_game(field_backend, field, 5)
+        snapshot = game.snapshot()
+        results[f"snapshot[{field_backend}]"] = time_calls(lambda state: game.snapshot(), range(calls), repeats)
+        results[f"restore[{field_backend}]"] = time_calls(lambda state: game.restore(snapshot), range(calls), repeats)
+        results[f"deepcopy[{field_backend}]"] = time_calls(lambda state: copy.deepcopy(game), range(max(1, calls // 10)), repeats)
+
+def bench_features(results, repeats, calls):
+    '''Tetris.features() for each field backend, and scoring every placement of a piece one at a time against all at once with NumPy.'''
+
+    from tetris_features import score_placements
+    from tetris_placements import generate_placements
+    from tetris_tournament import evaluate_placement
+
+    rng = rand.Random(FIXTURE_SEED)
+    field = make_stack_field(rng, 8)
+    for field_backend in BACKENDS:
+        game = make_game(field_backend, field, 5)
+        results[f"features[{field_backend}]"] = time_calls(lambda state: game.features(), range(calls), repeats)
+
+    game = make_game("bitboard", field, 5)
+    placements = list(generate_placements(game))
+    results["score_placements[scalar]"] = time_calls(lambda state: [evaluate_placement(game, placement) for placement in placements],
+                                                     range(max(1, calls // 20)), repeats)
+    results["score_placements[numpy]"] = time_calls(lambda state: score_placements(game, placements), range(max(1, calls // 20)), repeats)
+
+def bench_frame(results, repeats, calls):
+    '''One full frame of draw_game() and display.flip(), and one of the FrameRenderer the main loop uses, on SDL's dummy video driver.'''
+
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    import pygame
+    from tetris import FrameRenderer, draw_game, init_display
+
+    screen = init_display()
+    rng = rand.Random(FIXTURE_SEED)
+    game = make_game("bitboard", make_stack_field(rng, 8), 5)
+    game.piece_held = 0
+    game.randomizer.fill(6)
+
+    def frame(state):
+        draw_game(screen, game)
+        pygame.display.flip()
+
+    results["frame[render]"] = time_calls(frame, range(max(1, calls // 100)), repeats)
+    results["frame[render]"]["frame_budget_used"] = results["frame[render]"]["ns_per_call"] / (1e9 / FPS)
+
+    # The dirty-rect renderer, with the active piece moving one column every frame
+    renderer = FrameRenderer(screen)
+    renderer.draw(game)
+
+    def dirty_frame(state):
+        game.active_piece.x += 1 if state % 2 == 0 else -1
+        pygame.display.update(renderer.draw(game))
+
+    results["frame[dirty]"] = time_calls(dirty_frame, range(max(2, calls // 10)), repeats)
+    results["frame[dirty]"]["frame_budget_used"] = results["frame[dirty]"]["ns_per_call"] / (1e9 / FPS)
+    pygame.quit()
+
+def bench_sizes(results, repeats, calls):
+    '''Per-move costs on matrices of each of MATRIX_SIZES with the same 8 rows of garbage, for each field backend:
+    collision checks, a hard drop from the spawn position, clearing 2 lines, and a frame of the FrameRenderer.
+
+    These should stay about the same as the matrix grows, since they only touch the rows under the piece or being
+    cleared. A full draw_game() frame is timed too for comparison, and grows with the area of the matrix.'''
+
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    import pygame
+    from tetris import FrameRenderer, draw_game, init_display
+
+    for matrix_width, matrix_height in MATRIX_SIZES:
+        size = f"{matrix_width}x{matrix_height}"
+        rng = rand.Random(FIXTURE_SEED)
+        field = make_stack_field(rng, 8, 0, matrix_width, matrix_height)
+        cleared_field = make_stack_field(rng, 6, 2, matrix_width, matrix_height)
+
+        for field_backend in BACKENDS:
+            game = make_game(field_backend, field, 5)
+            game.active_piece.y += game.drop_distance()
+            results[f"sizes[{size},intersects,{field_backend}]"] = time_calls(lambda offset: game.intersects(0, offset, 0), [-1, 0] * (calls // 2), repeats)
+
+            # Fresh games are shallow copies restored from a snapshot, which share the rows rather than copying the whole matrix.
+            def fresh_games(template, count):
+                snapshot = template.snapshot()
+                games = []
+                for i in range(count):
+                    game = copy.copy(template)
+                    game.randomizer = copy.deepcopy(template.randomizer)
+                    game.queue = game.randomizer.window
+                    game.restore(snapshot)
+                    games.append(game)
+                return(games)
+
+            template = make_game(field_backend, field, 5)
+            results[f"sizes[{size},hard_drop,{field_backend}]"] = time_calls(lambda game: game.hard_drop(),
+                                                                            lambda: fresh_games(template, calls), repeats)
+
+            cleared_template = make_game(field_backend, cleared_field)
+            rows = range(matrix_height - 2, matrix_height)
+            results[f"sizes[{size},clear_lines,{field_backend}]"] = time_calls(lambda game: game.clear_lines(rows),
+                                                                              lambda: fresh_games(cleared_template, calls), repeats)
+
+        screen = init_display(matrix_width, matrix_height)
+        game = make_game("bitboard", field, 5)
+        game.piece_held = 0
+        game.randomizer.fill(6)
+
+        # The active piece moves one column every frame, as in bench_frame().
+        renderer = FrameRenderer(screen)
+        renderer.draw(game)
+
+        def dirty_frame(state):
+            game.active_piece.x += 1 if state % 2 == 0 else -1
+            pygame.display.update(renderer.draw(game))
+
+        def full_frame(state):
+            draw_game(screen, game)
+            pygame.display.flip()
+
+        results[f"sizes[{size},frame_dirty]"] = time_calls(dirty_frame, range(max(2, calls // 10)), repeats)
+        results[f"sizes[{size},frame_full]"] = time_calls(full_frame, range(max(1, calls // 200)), repeats)
+        pygame.quit()
+
+def bench_versus(results, repeats, calls):
+    '''One tick of VERSUS_MATCHES two-player versus matches with random inputs: each match stepped on its own with
+    VersusMatch, against all of them at once with BatchVersus. Reported per match.'''
+
+    import numpy as np
+    from tetris_versus import BatchVersus, VersusMatch, random_inputs
+
+    rng = np.random.default_rng(FIXTURE_SEED)
+    seeds = [FIXTURE_SEED + i for i in range(VERSUS_MATCHES)]
+    ticks = max(2, calls // 20)
+    inputs = []
+    held_inputs = np.zeros(VERSUS_MATCHES * 2, dtype=np.int64)
+    for i in range(ticks):
+        held_inputs = random_inputs(rng, held_inputs, 0.05)
+        inputs.append(held_inputs)
+
+    matches = [VersusMatch(2, seed) for seed in seeds]
+    scalar_inputs = [[held_inputs[2 * i:2 * i + 2].tolist() for i in range(VERSUS_MATCHES)] for held_inputs in inputs]
+
+    def scalar_tick(tick_inputs):
+        for match, match_inputs in zip(matches, tick_inputs):
+            match.step(match_inputs)
+
+    versus = BatchVersus(VERSUS_MATCHES, 2, seeds)
+    results["versus[scalar]"] = time_calls(scalar_tick, scalar_inputs, repeats)
+    results["versus[batch]"] = time_calls(versus.step, inputs, repeats)
+    for name in ["versus[scalar]", "versus[batch]"]:
+        results[name] = {key: value / VERSUS_MATCHES for key, value in results[name].items()}
+
+def bench_bot(results, repeats, calls):
+    '''The bot's work per piece on a garbage stack: expanding one board of the beam search, and planning the route to a placement.'''
+
+    from tetris_bot import BEAM_WIDTH, BeamNode, expand_node
+    from tetris_features import DEFAULT_WEIGHTS
+    from tetris_placements import board_bits, search_states, trace_route
+
+    rng = rand.Random(FIXTURE_SEED)
+    game = make_game("bitboard", make_stack_field(rng, 8), 5)
+    node = BeamNode(0.0, None, game.snapshot(), None)
+    scratch = Tetris("bitboard", 0)
+    results["bot[expand_node]"] = time_calls(lambda state: expand_node(scratch, node, BEAM_WIDTH, 0, DEFAULT_WEIGHTS, False),
+                                             range(max(1, calls // 20)), repeats)
+
+    board = board_bits(game)
+    def plan_route(state):
+        resting_states, parents = search_states(board, 5)
+        return([trace_route(parents, resting_state) for resting_state in resting_states.values()])
+    results["bot[plan_route]"] = time_calls(plan_route, range(max(1, calls // 20)), repeats)
+
+BENCHMARKS = {
+    "intersects": bench_intersects,
+    "rotate": bench_rotate,
+    "clear_lines": bench_clear_lines,
+    "hard_drop": bench_hard_drop,
+    "advance_piece_queue": bench_advance_piece_queue,
+    "ghost": bench_ghost,
+    "snapshot": bench_snapshot,
+    "features": bench_features,
+    "frame": bench_frame,
+    "sizes": bench_sizes,
+    "versus": bench_versus,
+    "bot": bench_bot,
+}
+
+def run_benchmarks(names = None, repeats = 7, calls = 2000):
+    '''Runs the named benchmark groups (all of them by default) and returns the results with some details about the machine.'''
+
+    results = {}
+    for name in names or BENCHMARKS:
+        BENCHMARKS[name](results, repeats, calls)
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ""
+
+    return({
+        "meta": {
+            "commit": commit,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "repeats": repeats,
+            "calls": calls,
+        },
+        "results": results,
+    })
+
+def compare(baseline, current, threshold):
+    '''Prints each benchmark's change against the baseline. Returns the names of benchmarks that regressed by more than "threshold".'''
+
+    regressions = []
+    for name, result in current["results"].items():
+        if name not in baseline["results"]:
+            print(f"{name:45} {result['ns_per_call']:12.0f} ns  (new)")
+            continue
+
+        ratio = result["ns_per_call"] / baseline["results"][name]["ns_per_call"]
+        flag = ""
+        if ratio > 1 + threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:45} {result['ns_per_call']:12.0f} ns  {ratio - 1:+8.1%}{flag}")
+
+    return(regressions)
+
+def main():
+    '''Command-line entry point.'''
+
+    parser = argparse.ArgumentParser(description="Benchmarks the Tetris engine's hot paths.")
+    parser.add_argument("--only", nargs="*", choices=sorted(BENCHMARKS), help="benchmark groups to run (default: all)")
+    parser.add_argument("--repeats", type=int, default=7, help="times to repeat each measurement; the best is kept")
+    parser.add_argument("--calls", type=int, default=2000, help="calls per measurement")
+    parser.add_argument("--output", default=None, help="write the results to this JSON file")
+    parser.add_argument("--compare", default=None, help="baseline JSON file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="slowdown that counts as a regression (default: 0.10)")
+    args = parser.parse_args()
+
+    current = run_benchmarks(args.only, args.repeats, args.calls)
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(current, output_file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(baseline, current, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} benchmark(s) regressed by more than {args.threshold:.0%}")
+            sys.exit(1)
+    elif not args.output:
+        print(json.dumps(current, indent=2))
+
+if __name__ == "__main__":
+    main()
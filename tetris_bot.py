@@ -0,0 +1,541 @@
+# A built-in bot. BeamSearch looks ahead through the preview queue and the hold piece with a beam search under a time
+# budget, and Autoplayer turns the placements it picks into key presses, one tick at a time, for Tetris.step().
+#
+# Each layer of the search places one more piece on the best BEAM_WIDTH boards of the layer before, scoring every
+# placement with tetris_features.score_placements() plus the lines cleared on the way there. Boards can be expanded on a
+# process pool. When the time budget runs out, the search stops and returns the best first placement of the last layer
+# it finished, so a tight budget costs lookahead rather than time. The first layer always finishes.
+#
+# Autoplayer can run the search on a background thread, so a render loop keeps drawing while the bot thinks. The piece
+# keeps falling in the meantime, so the route to the chosen placement is planned from wherever the piece is when
+# the search finishes. It's planned again whenever gravity moves the piece off it.
+#
+# Usage:
+#   python tetris_bot.py --games 10 --budget 50
+#   python tetris_bot.py --games 1 --level 14 --realtime
+#   python tetris_bot.py --versus 2 --ticks 7200
+#
+# As a tournament policy: python tetris_tournament.py --policy tetris_bot:beam_policy
+
+import argparse
+import concurrent.futures
+import json
+import math
+import statistics
+import threading
+import time
+from collections import deque, namedtuple
+
+import numpy as np
+
+from tetris import FPS, INPUT_HARD_DROP, INPUT_HOLD, INPUT_SOFT_DROP, TickScheduler, Tetris, Tetromino
+from tetris_features import DEFAULT_WEIGHTS, score_placements
+from tetris_placements import (MASK_MARGIN, apply_placement, board_bits, build_board_masks, find_placements, generate_placements,
+                               hold_option, search_states, trace_route)
+
+BEAM_WIDTH = 6
+SEARCH_DEPTH = 3
+TIME_BUDGET_MS = 80
+# Pieces shown in the preview. The search never looks at a piece past them.
+PREVIEW_LENGTH = 5
+# Routes are planned without gravity. Past this many new routes for one piece, gravity is undoing the moves (a kick up
+# that falls straight back at high levels can reset piece lock forever), so the piece is hard dropped where it is.
+MAX_REPLANS = 20
+
+# One board in the beam. "first" is the placement of the root's piece that leads to it, and "key" its position_hash().
+BeamNode = namedtuple("BeamNode", ["score", "first", "snapshot", "key"])
+
+# What BeamSearch.search() found. "depth" is the number of layers finished, "nodes" the number of boards expanded, and
+# "timed_out" whether the budget ran out before every layer was done.
+SearchResult = namedtuple("SearchResult", ["placement", "score", "depth", "nodes", "timed_out", "elapsed_ms"])
+
+# Games to expand boards on, one per thread, matrix size and ruleset.
+SCRATCH = threading.local()
+
+def scratch_game(matrix_width, matrix_height):
+    '''Returns this thread's scratch game of the given size, making it the first time. A game made before a ruleset
+    was applied keeps the old collision masks, so each ruleset gets its own.'''
+
+    games = SCRATCH.__dict__.setdefault("games", {})
+    key = (matrix_width, matrix_height, Tetris.RULESET_KEY)
+    if key not in games:
+        games[key] = Tetris("bitboard", 0, matrix_width, matrix_height)
+
+    return(games[key])
+
+def restore_bitboard(game, snapshot):
+    '''Restores "snapshot" into "game", filling in the row bits if it came from a game with the list field backend.'''
+
+    game.restore(snapshot)
+    if game.row_bits == None:
+        game.row_bits = [game.row_mask(i) for i in range(game.matrix_height)]
+
+def preview_depth(game):
+    '''Returns how many pieces can be placed ahead without the search seeing a piece that isn't in the preview yet.
+
+    With the hold space empty, holding brings out the next piece early, so one piece less can be placed.'''
+
+    return(PREVIEW_LENGTH if game.piece_held != None else PREVIEW_LENGTH - 1)
+
+def reachable_placements(game):
+    '''Returns the placements the active piece can reach from where it is now, along with those of the piece holding would bring out.
+
+    The same as generate_placements() while the piece is at its spawn position. Once gravity has moved it, the paths
+    start from its current position instead.'''
+
+    piece = game.active_piece
+    start = (piece.x, piece.y, piece.rotation)
+    if start == Tetromino.spawn_position(piece.type, game.matrix_width) + (0,):
+        return(generate_placements(game))
+
+    return(find_placements(board_bits(game), piece.type, hold_option(game), game.matrix_width, game.matrix_height, start))
+
+def expand_node(game, node, beam_width, root_lines, weights, from_current):
+    '''Places the active piece of the board in "node" at its "beam_width" best placements. Returns a BeamNode for each.
+
+    Placements are scored by "weights", plus the "lines" weight for every line cleared since the root, which had
+    cleared "root_lines". A placement that tops the game out scores -inf. If "from_current" is True, placements are
+    searched from where the piece is rather than its spawn position.'''
+
+    restore_bitboard(game, node.snapshot)
+    if not game.game_active or game.active_piece == None:
+        return([])
+
+    placements = reachable_placements(game) if from_current else generate_placements(game)
+    if len(placements) == 0:
+        return([])
+
+    scores = score_placements(game, placements, weights) + weights["lines"] * (game.total_lines_cleared - root_lines)
+
+    children = []
+    for i in np.argsort(-scores, kind="stable")[:beam_width]:
+        if len(children) > 0:
+            restore_bitboard(game, node.snapshot)
+
+        # The next piece spawns straight away, like it does on the tick after a piece locks.
+        apply_placement(game, placements[i])
+        game.active_piece = Tetromino(game, "Queue")
+        if game.intersects():
+            game.game_active = False
+
+        children.append(BeamNode(float(scores[i]) if game.game_active else -math.inf,
+                                 placements[i] if node.first == None else node.first, game.snapshot(), game.position_hash()))
+
+    return(children)
+
+def expand_nodes(task):
+    '''Pool worker entry point. "task" is a (matrix size, nodes, beam width, root lines, weights, from current) tuple.
+    Returns the children of every node, in order.'''
+
+    matrix_size, nodes, beam_width, root_lines, weights, from_current = task
+    game = scratch_game(*matrix_size)
+
+    children = []
+    for node in nodes:
+        children += expand_node(game, node, beam_width, root_lines, weights, from_current)
+
+    return(children)
+
+class BeamSearch:
+    '''Picks placements by beam search over the active piece, the preview and the hold piece.
+
+    "executor" is a concurrent.futures executor to expand each layer's boards on, split into "workers" tasks, or None
+    to expand them on the calling thread. A process pool spreads the work over several cores. A search that runs out
+    of time stops waiting for a pool's tasks, but tasks already running finish before the pool starts on the next search.'''
+
+    def __init__(self, beam_width = BEAM_WIDTH, depth = SEARCH_DEPTH, weights = DEFAULT_WEIGHTS, executor = None, workers = 1):
+        self.beam_width = beam_width
+        self.depth = depth
+        self.weights = weights
+        self.executor = executor
+        self.workers = workers
+
+    def expand_layer(self, beam, matrix_size, root_lines, from_current, deadline):
+        '''Expands every node in the beam. Returns the children, or None if "deadline" (a time.perf_counter() time, or None
+        for no deadline) passed first.'''
+
+        if self.executor == None:
+            game = scratch_game(*matrix_size)
+            children = []
+            for node in beam:
+                if deadline != None and time.perf_counter() > deadline:
+                    return(None)
+                children += expand_node(game, node, self.beam_width, root_lines, self.weights, from_current)
+
+            return(children)
+
+        chunks = [beam[i::self.workers] for i in range(min(self.workers, len(beam)))]
+        futures = [self.executor.submit(expand_nodes, (matrix_size, chunk, self.beam_width, root_lines, self.weights, from_current))
+                   for chunk in chunks]
+        not_done = concurrent.futures.wait(futures, None if deadline == None else max(0.0, deadline - time.perf_counter())).not_done
+        if not_done:
+            for future in not_done:
+                future.cancel()
+            return(None)
+
+        return([child for future in futures for child in future.result()])
+
+    def search_snapshot(self, snapshot, matrix_size, budget_ms = TIME_BUDGET_MS):
+        '''Searches from a TetrisSnapshot of a game of size "matrix_size" (width, height) with an active piece, for at
+        most about "budget_ms" milliseconds after the first layer. Returns a SearchResult.
+
+        Takes no game, so it can run on another thread while the game it came from keeps playing.'''
+
+        start_time = time.perf_counter()
+        deadline = start_time + budget_ms / 1000
+
+        game = scratch_game(*matrix_size)
+        restore_bitboard(game, snapshot)
+        depth_limit = min(self.depth, preview_depth(game))
+        root_lines = game.total_lines_cleared
+
+        beam = [BeamNode(0.0, None, snapshot, None)]
+        best = None
+        depth = 0
+        nodes = 0
+        timed_out = False
+        while depth < depth_limit:
+            children = self.expand_layer(beam, matrix_size, root_lines, depth == 0, deadline if best != None else None)
+            if children == None:
+                timed_out = True
+                break
+            nodes += len(beam)
+            if len(children) == 0:
+                break
+
+            # Boards reached by placing the same pieces in a different order are kept once, with their best score.
+            unique = {}
+            for child in children:
+                if child.key not in unique or child.score > unique[child.key].score:
+                    unique[child.key] = child
+
+            beam = sorted(unique.values(), key=lambda child: child.score, reverse=True)[:self.beam_width]
+            best = beam[0]
+            depth += 1
+
+        return(SearchResult(None if best == None else best.first, -math.inf if best == None else best.score, depth, nodes,
+                            timed_out, (time.perf_counter() - start_time) * 1000))
+
+    def search(self, game, budget_ms = TIME_BUDGET_MS):
+        '''Searches from the game's current position. See search_snapshot().'''
+
+        return(self.search_snapshot(game.snapshot(), (game.matrix_width, game.matrix_height), budget_ms))
+
+DEFAULT_SEARCH = BeamSearch()
+
+def beam_policy(game, placements, rng):
+    '''Tournament policy: the placement BeamSearch picks with the default settings and TIME_BUDGET_MS. How far it looks
+    ahead depends on the machine's speed, so results aren't reproducible across machines.'''
+
+    result = DEFAULT_SEARCH.search(game)
+    return(placements[0] if result.placement == None else result.placement)
+
+def landing_ms(game):
+    '''Returns how long the active piece takes to fall to the stack under the current level's gravity, in milliseconds.'''
+
+    level = 1 + game.total_lines_cleared // 10
+    rows_per_tick = Tetris.GRAVITY_STEPS[min(level, len(Tetris.GRAVITY_STEPS)) - 1] / Tetris.GRAVITY_DENOMINATOR
+
+    return(game.drop_distance() / rows_per_tick * 1000 / FPS)
+
+def predicted_state(game):
+    '''Returns the (x, y, rotation) the active piece will be in on the next tick once gravity has moved it, before any input.'''
+
+    piece = game.active_piece
+    level = 1 + game.total_lines_cleared // 10
+    gravity_step = Tetris.GRAVITY_STEPS[min(level, len(Tetris.GRAVITY_STEPS)) - 1]
+    rows = (game.gravity_progress + gravity_step) // Tetris.GRAVITY_DENOMINATOR
+
+    return((piece.x, piece.y + min(rows, game.drop_distance()), piece.rotation))
+
+class Autoplayer:
+    '''Plays a game through Tetris.step(): call inputs() before every step and pass it what it returns.
+
+    Every new piece is searched with "search" for up to "budget_ms" milliseconds, cut to the time the piece takes to
+    land. With "background" set, the search runs on a thread of its own and the bot presses nothing until it's done,
+    so inputs() returns straight away. Otherwise inputs() waits for it, which suits games that aren't played in real time.
+
+    The route to the chosen placement presses one key a tick, releasing it for a tick when the same key comes twice in
+    a row. If the piece can no longer reach the placement, the bot takes the best placement it can still reach, and
+    after MAX_REPLANS routes it hard drops the piece.'''
+
+    def __init__(self, search = DEFAULT_SEARCH, budget_ms = TIME_BUDGET_MS, background = False):
+        self.search = search
+        self.budget_ms = budget_ms
+        self.coordinator = concurrent.futures.ThreadPoolExecutor(1) if background else None
+
+        # The piece being played, the placement chosen for it, and the (state, input) steps left on the way there
+        self.piece = None
+        self.target = None
+        self.route = None
+        self.piece_replans = 0
+        self.last_inputs = 0
+
+        # The piece a background search is running for, and its future
+        self.pending = None
+
+        self.search_times = []
+        self.search_depths = []
+        self.timeouts = 0
+        self.replans = 0
+        self.fallbacks = 0
+        self.forced_drops = 0
+
+    def close(self):
+        '''Shuts down the background thread and the search's executor, without waiting for a search still running.'''
+
+        if self.coordinator != None:
+            self.coordinator.shutdown(wait=False, cancel_futures=True)
+        if self.search.executor != None:
+            self.search.executor.shutdown(wait=False, cancel_futures=True)
+
+    def record_result(self, result):
+        '''Takes the placement from a finished search.'''
+
+        self.search_times.append(result.elapsed_ms)
+        self.search_depths.append(result.depth)
+        self.timeouts += result.timed_out
+        self.target = result.placement
+        self.route = None
+
+    def start_search(self, game):
+        '''Starts searching for a placement of the game's new active piece.'''
+
+        budget_ms = min(self.budget_ms, landing_ms(game))
+        if self.coordinator == None:
+            self.record_result(self.search.search(game, budget_ms))
+        else:
+            snapshot = game.snapshot()
+            self.pending = (game.active_piece, self.coordinator.submit(self.search.search_snapshot, snapshot,
+                                                                       (game.matrix_width, game.matrix_height), budget_ms))
+
+    def plan_route(self, game, state):
+        '''Plans the steps from "state" to the target. Returns False if the active piece can't get there.'''
+
+        target = self.target
+        if target.held and not game.hold_used:
+            self.route = deque([(state, INPUT_HOLD)])
+            return(True)
+
+        piece = game.active_piece
+        if piece.type != target.piece_type:
+            return(False)
+
+        resting_states, parents = search_states(board_bits(game), piece.type, game.matrix_width, game.matrix_height, state)
+        mask = build_board_masks(game.matrix_width, game.matrix_height)[target.piece_type][target.rotation][target.x + MASK_MARGIN][target.y + MASK_MARGIN]
+        if mask not in resting_states:
+            return(False)
+
+        resting_state = resting_states[mask]
+        self.route = deque(trace_route(parents, resting_state) + [(resting_state, INPUT_HARD_DROP)])
+        return(True)
+
+    def fall_back(self, game, state):
+        '''Targets the best placement the active piece can still reach from "state", without looking ahead.'''
+
+        self.fallbacks += 1
+        piece = game.active_piece
+        placements = find_placements(board_bits(game), piece.type, hold_option(game), game.matrix_width, game.matrix_height, state)
+        if len(placements) == 0:
+            self.target = None
+            return
+
+        self.target = placements[int(np.argmax(score_placements(game, placements, self.search.weights)))]
+        if not self.plan_route(game, state):
+            self.target = None
+
+    def press(self, inputs):
+        '''Returns "inputs", remembering them so the next tick can tell whether a key is still held.'''
+
+        self.last_inputs = inputs
+        return(inputs)
+
+    def inputs(self, game):
+        '''Returns the INPUT_* bitmask to pass to the game's next step().'''
+
+        piece = game.active_piece
+        if not game.game_active or piece == None:
+            return(self.press(0))
+
+        # A new piece object comes out on every spawn and every hold. Holding for the target keeps it, and a spawn,
+        # which always has hold unused, starts a new search.
+        if piece is not self.piece:
+            self.piece = piece
+            self.route = None
+            self.piece_replans = 0
+            if not (game.hold_used and self.target != None and self.target.held):
+                self.target = None
+                self.start_search(game)
+
+        if self.pending != None and self.pending[1].done():
+            pending_piece, future = self.pending
+            self.pending = None
+            if pending_piece is piece:
+                self.record_result(future.result())
+
+        if self.target == None:
+            return(self.press(0))
+
+        state = predicted_state(game)
+        if self.route == None or len(self.route) == 0 or self.route[0][0] != state:
+            if self.route != None:
+                self.replans += 1
+                self.piece_replans += 1
+            if self.piece_replans > MAX_REPLANS:
+                self.forced_drops += self.piece_replans == MAX_REPLANS + 1
+                self.route = deque([(state, INPUT_HARD_DROP)])
+            elif not self.plan_route(game, state):
+                self.fall_back(game, state)
+                if self.target == None:
+                    return(self.press(0))
+
+        # Soft drop keeps moving the piece down while it's held, so only other keys are let go of between presses.
+        action = self.route[0][1]
+        if action == self.last_inputs and action != INPUT_SOFT_DROP:
+            return(self.press(0))
+
+        self.route.popleft()
+        return(self.press(action))
+
+    def stats(self):
+        '''Returns how long searches took, how deep they got, and how often the bot had to change its plans.'''
+
+        search_times = sorted(self.search_times)
+        return({
+            "searches": len(search_times),
+            "mean_search_ms": statistics.fmean(search_times) if search_times else 0.0,
+            "max_search_ms": search_times[-1] if search_times else 0.0,
+            "mean_depth": statistics.fmean(self.search_depths) if self.search_depths else 0.0,
+            "timeouts": self.timeouts,
+            "replans": self.replans,
+            "fallbacks": self.fallbacks,
+            "forced_drops": self.forced_drops,
+        })
+
+def start_autoplayer(budget_ms = TIME_BUDGET_MS, workers = 1, matrix_size = (Tetris.MATRIX_WIDTH, Tetris.MATRIX_HEIGHT)):
+    '''Returns a background Autoplayer for a real-time front end, expanding boards on a pool of "workers" processes
+    (on its own thread if 0).
+
+    The pool's processes are started straight away, so call this before opening a window.'''
+
+    executor = None
+    if workers > 0:
+        executor = concurrent.futures.ProcessPoolExecutor(workers)
+        concurrent.futures.wait([executor.submit(build_board_masks, *matrix_size) for i in range(workers)])
+
+    return(Autoplayer(BeamSearch(executor=executor, workers=max(1, workers)), budget_ms, background=True))
+
+def play_game(autoplayer, seed, level = 1, line_cap = None, tick_limit = None, realtime = False):
+    '''Plays one headless game with "autoplayer" from "level" until it's lost, reaches "line_cap" lines or "tick_limit" ticks. Returns its stats.
+
+    With "realtime" set, ticks run at FPS on a TickScheduler, as in the pygame front end, and the time spent on each
+    frame's ticks is measured. A frame that takes longer than a tick would drop frames in a render loop.'''
+
+    game = Tetris("bitboard", seed)
+    game.total_lines_cleared = (level - 1) * 10
+    game.level = level
+    scheduler = TickScheduler() if realtime else None
+    frame_times = []
+    pieces_placed = 0
+    ticks = 0
+
+    def run_tick():
+        nonlocal pieces_placed, ticks
+        if game.step(autoplayer.inputs(game)) != None:
+            pieces_placed += 1
+        ticks += 1
+
+    def playing():
+        return(game.game_active and (line_cap == None or game.total_lines_cleared - (level - 1) * 10 < line_cap)
+               and (tick_limit == None or ticks < tick_limit))
+
+    start_time = time.perf_counter()
+    while playing():
+        if scheduler == None:
+            run_tick()
+            continue
+
+        frame_start = time.perf_counter()
+        for tick_time in scheduler.due_ticks():
+            if playing():
+                run_tick()
+        frame_times.append((time.perf_counter() - frame_start) * 1000)
+        scheduler.wait()
+    elapsed = time.perf_counter() - start_time
+
+    result = {
+        "seed": seed,
+        "score": game.score,
+        "lines_cleared": game.total_lines_cleared - (level - 1) * 10,
+        "level": game.level,
+        "pieces_placed": pieces_placed,
+        "ticks": ticks,
+        "pieces_per_second": pieces_placed / elapsed if elapsed > 0 else 0.0,
+        "topped_out": not game.game_active,
+    }
+    result.update(autoplayer.stats())
+    if scheduler != None:
+        result["max_frame_ms"] = max(frame_times, default=0.0)
+        result["slow_frames"] = sum(frame_time > 1000 / FPS for frame_time in frame_times)
+        result["dropped_ticks"] = scheduler.dropped_ticks
+
+    return(result)
+
+def play_versus(player_count, seed, ticks, budget_ms, search):
+    '''Plays a versus match (see tetris_versus.py) between "player_count" bots for up to "ticks" ticks. Returns the match's stats.'''
+
+    from tetris_versus import VersusMatch
+
+    match = VersusMatch(player_count, seed)
+    autoplayers = [Autoplayer(search, budget_ms) for i in range(player_count)]
+    while not match.finished and match.ticks < ticks:
+        match.step([autoplayer.inputs(game) for autoplayer, game in zip(autoplayers, match.games)])
+
+    stats = match.stats()
+    for player_stats, autoplayer in zip(stats["players"], autoplayers):
+        player_stats.update(autoplayer.stats())
+
+    return(stats)
+
+def main():
+    '''Command-line entry point.'''
+
+    parser = argparse.ArgumentParser(description="Plays headless Tetris games with the beam search bot and reports how it did.")
+    parser.add_argument("--games", type=int, default=1, help="number of games to play (default: 1)")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the first game; game i uses seed + i")
+    parser.add_argument("--budget", type=float, default=TIME_BUDGET_MS, help=f"search time per piece in milliseconds (default: {TIME_BUDGET_MS})")
+    parser.add_argument("--beam-width", type=int, default=BEAM_WIDTH, help=f"boards kept in each layer of the search (default: {BEAM_WIDTH})")
+    parser.add_argument("--depth", type=int, default=SEARCH_DEPTH, help=f"pieces to look ahead, at most {PREVIEW_LENGTH} (default: {SEARCH_DEPTH})")
+    parser.add_argument("--workers", type=int, default=0, help="processes to expand boards on (default: 0, on the calling thread)")
+    parser.add_argument("--level", type=int, default=1, help="level to start at (default: 1)")
+    parser.add_argument("--line-cap", type=int, default=None, help="stop a game once it has cleared this many lines")
+    parser.add_argument("--ticks", type=int, default=None, help="stop a game after this many ticks")
+    parser.add_argument("--realtime", action="store_true", help="play at FPS ticks per second with the search in the background, and measure frame times")
+    parser.add_argument("--versus", type=int, default=None, metavar="PLAYERS", help="play versus matches between this many bots instead")
+    args = parser.parse_args()
+
+    executor = concurrent.futures.ProcessPoolExecutor(args.workers) if args.workers > 0 else None
+    search = BeamSearch(args.beam_width, args.depth, executor=executor, workers=max(1, args.workers))
+
+    try:
+        results = []
+        for i in range(args.games):
+            if args.versus != None:
+                result = play_versus(args.versus, args.seed + i, args.ticks or 7200, args.budget, search)
+            else:
+                autoplayer = Autoplayer(search, args.budget, background=args.realtime)
+                result = play_game(autoplayer, args.seed + i, args.level, args.line_cap, args.ticks, args.realtime)
+                if autoplayer.coordinator != None:
+                    autoplayer.coordinator.shutdown()
+            results.append(result)
+            print(json.dumps(result))
+    finally:
+        if executor != None:
+            executor.shutdown()
+
+    if args.versus == None and len(results) > 1:
+        print(json.dumps({stat: statistics.fmean(result[stat] for result in results)
+                          for stat in ["score", "lines_cleared", "pieces_placed", "pieces_per_second", "mean_search_ms", "mean_depth"]}, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,376 @@
+# Connects to a tetris_server.py server to play or watch a match in a pygame window. The game runs on the server; the
+# window draws the copy of it kept up to date from the server's state updates.
+#
+# Usage:
+#   python tetris_client.py                    start a match and play it
+#   python tetris_client.py --spectate [ID]    watch a match (the oldest one if no ID is given)
+#   python tetris_client.py --list             print the ids of the running matches
+
+import argparse
+import asyncio
+import time
+from collections import deque
+
+from tetris import FPS, KEY_BINDINGS, Tetris, Tetromino
+from tetris_replay import read_varint, write_varint
+from tetris_server import (DEFAULT_PORT, MSG_CREATE, MSG_ERROR, MSG_INPUT, MSG_JOINED, MSG_LIST, MSG_MATCHES, MSG_SPECTATE,
+                           MSG_STATE, NO_PIECE, READ_SIZE, ROLE_PLAYER, STATE_ACK, STATE_CELLS, STATE_CLEARS, STATE_HOLD,
+                           STATE_KEYFRAME, STATE_PIECE, STATE_QUEUE, STATE_STATS, U64, frame_message, read_messages, unzigzag)
+
+class RemoteGame:
+    '''A copy of a game running on a server, kept up to date from its MSG_STATE updates.
+
+    Has the attributes and methods of a Tetris that draw_game() and FrameRenderer use, so it's drawn the same way.'''
+
+    def __init__(self, match_id, role, seed, matrix_width, matrix_height):
+        self.match_id = match_id
+        self.role = role
+        self.seed = seed
+        self.matrix_width = matrix_width
+        self.matrix_height = matrix_height
+
+        # The last tick the server has sent, and the (client timestamp, tick) of the last input it acknowledged
+        self.tick = 0
+        self.ack = None
+
+        self.reset()
+
+    def reset(self):
+        '''Empties the game, as a keyframe starts from.'''
+
+        self.field = [[0] * self.matrix_width for i in range(self.matrix_height)]
+        # Counts changes to the matrix. FrameRenderer only compares it with its last value.
+        self.field_hash = 0
+        self.active_piece = None
+        self.queue = []
+        self.piece_held = None
+        self.hold_used = False
+        self.score = 0
+        self.level = 1
+        self.total_lines_cleared = 0
+        self.game_active = True
+        self.ghost_key = None
+        self.ghost_y = 0
+
+    get_scan_dimension = Tetris.get_scan_dimension
+
+    def ghost_piece_y(self):
+        '''Returns the Y position of the ghost piece. Only recomputed when the active piece or the matrix has changed.'''
+
+        piece = self.active_piece
+        if piece == None:
+            return(0)
+
+        ghost_key = (piece.type, piece.x, piece.y, piece.rotation, self.field_hash)
+        if ghost_key != self.ghost_key:
+            scan_dimension = self.get_scan_dimension()
+            cells = [divmod(cell, scan_dimension) for cell in piece.image()]
+
+            y = piece.y
+            while all(y + 1 + row < 0 or (y + 1 + row < self.matrix_height and self.field[y + 1 + row][piece.x + column] == 0)
+                      for row, column in cells):
+                y += 1
+
+            self.ghost_key = ghost_key
+            self.ghost_y = y
+
+        return(self.ghost_y)
+
+    def apply_state(self, body):
+        '''Applies the body of a MSG_STATE from the server.'''
+
+        tick, position = read_varint(body, 0)
+        flags, position = read_varint(body, position)
+        self.tick = tick
+
+        if flags & STATE_KEYFRAME:
+            self.reset()
+
+        if flags & STATE_CLEARS:
+            clear_count, position = read_varint(body, position)
+            for i in range(clear_count):
+                row_count, position = read_varint(body, position)
+                cleared_rows = set()
+                for j in range(row_count):
+                    row, position = read_varint(body, position)
+                    cleared_rows.add(row)
+                self.field = [[0] * self.matrix_width for row in cleared_rows] + [row for i, row in enumerate(self.field) if i not in cleared_rows]
+            self.field_hash += 1
+
+        if flags & STATE_CELLS:
+            cell_count, position = read_varint(body, position)
+
+            # Rows are replaced rather than written to, like in Tetris, so FrameRenderer can tell which rows changed.
+            copied_rows = set()
+            for i in range(cell_count):
+                cell_index, position = read_varint(body, position)
+                row, column = divmod(cell_index, self.matrix_width)
+                if row not in copied_rows:
+                    self.field[row] = list(self.field[row])
+                    copied_rows.add(row)
+                self.field[row][column] = body[position]
+                position += 1
+            self.field_hash += 1
+
+        if flags & STATE_PIECE:
+            piece_type = body[position]
+            position += 1
+            if piece_type == NO_PIECE:
+                self.active_piece = None
+            else:
+                piece = Tetromino.__new__(Tetromino)
+                piece.game = self
+                piece.type = piece_type
+                x, position = read_varint(body, position)
+                y, position = read_varint(body, position)
+                piece.x = unzigzag(x)
+                piece.y = unzigzag(y)
+                piece.rotation = body[position]
+                piece.move_reset_counter = 0
+                position += 1
+                self.active_piece = piece
+
+        if flags & STATE_QUEUE:
+            dropped, position = read_varint(body, position)
+            added, position = read_varint(body, position)
+            self.queue = self.queue[dropped:] + list(body[position:position + added])
+            position += added
+
+        if flags & STATE_HOLD:
+            self.piece_held = None if body[position] == NO_PIECE else body[position]
+            self.hold_used = bool(body[position + 1])
+            position += 2
+
+        if flags & STATE_STATS:
+            self.score, position = read_varint(body, position)
+            self.level, position = read_varint(body, position)
+            self.total_lines_cleared, position = read_varint(body, position)
+            self.game_active = bool(body[position])
+            position += 1
+
+        if flags & STATE_ACK:
+            timestamp, = U64.unpack_from(body, position)
+            ack_tick, position = read_varint(body, position + U64.size)
+            self.ack = (timestamp, ack_tick)
+
+class TetrisClient:
+    '''A connection to a TetrisServer, playing or watching one match.'''
+
+    def __init__(self):
+        self.reader = None
+        self.writer = None
+        self.buffer = bytearray()
+        self.messages = deque()
+        self.game = None
+
+        # When the last state arrived, to estimate the server's tick from
+        self.state_time = None
+
+        self.states_received = 0
+        self.bytes_received = 0
+        self.keyframe_sizes = []
+
+        # Seconds from sending an input to getting the state with it applied
+        self.input_latencies = []
+
+    async def connect(self, host = "127.0.0.1", port = DEFAULT_PORT):
+        '''Opens the connection to the server.'''
+
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+
+    def close(self):
+        '''Closes the connection.'''
+
+        if self.writer != None:
+            self.writer.close()
+
+    async def read_message(self):
+        '''Returns the next (message type, body) from the server. Raises ConnectionError if it has disconnected, and
+        RuntimeError if it sent a MSG_ERROR.'''
+
+        while not self.messages:
+            data = await self.reader.read(READ_SIZE)
+            if not data:
+                raise ConnectionError("server disconnected")
+            self.bytes_received += len(data)
+            self.buffer += data
+            self.messages.extend(read_messages(self.buffer))
+
+        message_type, body = self.messages.popleft()
+        if message_type == MSG_ERROR:
+            raise RuntimeError(f"server error: {body.decode(errors='replace')}")
+
+        return(message_type, body)
+
+    def handle_state(self, body):
+        '''Applies a MSG_STATE to the game, and records the input latency if it acknowledges an input.'''
+
+        ack = self.game.ack
+        self.game.apply_state(body)
+        self.state_time = time.perf_counter()
+        self.states_received += 1
+
+        if self.game.ack is not ack and self.game.ack != None:
+            self.input_latencies.append((time.perf_counter_ns() - self.game.ack[0]) / 1e9)
+
+    async def join(self, message_type, body):
+        '''Sends a MSG_CREATE or MSG_SPECTATE and waits for the server to answer with the match and its keyframe. Returns the game.'''
+
+        self.writer.write(frame_message(message_type, body))
+
+        message_type, body = await self.read_message()
+        if message_type != MSG_JOINED:
+            raise RuntimeError(f"unexpected message type: {message_type}")
+
+        match_id, position = read_varint(body, 0)
+        role = body[position]
+        seed, = U64.unpack_from(body, position + 1)
+        matrix_width, position = read_varint(body, position + 1 + U64.size)
+        matrix_height, position = read_varint(body, position)
+        self.game = RemoteGame(match_id, role, seed, matrix_width, matrix_height)
+
+        message_type, body = await self.read_message()
+        self.keyframe_sizes.append(len(body))
+        self.handle_state(body)
+
+        return(self.game)
+
+    async def create(self, seed = 0, matrix_width = Tetris.MATRIX_WIDTH, matrix_height = Tetris.MATRIX_HEIGHT):
+        '''Starts a match on the server to play. A seed of 0 has the server pick one. Returns the game.'''
+
+        body = bytearray(U64.pack(seed))
+        write_varint(body, matrix_width)
+        write_varint(body, matrix_height)
+        return(await self.join(MSG_CREATE, body))
+
+    async def spectate(self, match_id = 0):
+        '''Watches the match "match_id", or the oldest match if it's 0. Returns the game.'''
+
+        body = bytearray()
+        write_varint(body, match_id)
+        return(await self.join(MSG_SPECTATE, body))
+
+    async def list_matches(self):
+        '''Returns the ids of the matches running on the server. Only for use before joining a match.'''
+
+        self.writer.write(frame_message(MSG_LIST))
+        message_type, body = await self.read_message()
+        if message_type != MSG_MATCHES:
+            raise RuntimeError(f"unexpected message type: {message_type}")
+
+        count, position = read_varint(body, 0)
+        match_ids = []
+        for i in range(count):
+            match_id, position = read_varint(body, position)
+            match_ids.append(match_id)
+
+        return(match_ids)
+
+    def estimated_tick(self):
+        '''Returns the tick the server is most likely running now, from the last state's tick and the time since it arrived.'''
+
+        if self.state_time == None:
+            return(self.game.tick)
+
+        return(self.game.tick + int((time.perf_counter() - self.state_time) * FPS))
+
+    def send_inputs(self, inputs):
+        '''Sends the INPUT_* keys held from now on, stamped with the estimated tick and the time they were sent.'''
+
+        body = bytearray()
+        write_varint(body, self.estimated_tick())
+        body.append(inputs)
+        body += U64.pack(time.perf_counter_ns())
+        self.writer.write(frame_message(MSG_INPUT, body))
+
+    async def receive_states(self):
+        '''Applies state updates to the game as they arrive, until the server disconnects.'''
+
+        try:
+            while True:
+                message_type, body = await self.read_message()
+                if message_type == MSG_STATE:
+                    self.handle_state(body)
+
+        except ConnectionError:
+            pass
+
+async def run_window(client, playing):
+    '''Draws the client's game in a pygame window until it's closed, sending the keys pressed if "playing".'''
+
+    import pygame
+    from tetris import FrameRenderer, init_display
+
+    game = client.game
+    screen = init_display(game.matrix_width, game.matrix_height)
+    pygame.display.set_caption(f"Tetris but Awesome - match {game.match_id}")
+    renderer = FrameRenderer(screen)
+
+    receive_task = asyncio.create_task(client.receive_states())
+    held_inputs = 0
+    try:
+        while not receive_task.done():
+            for event in pygame.event.get():
+                if event.type == pygame.QUIT:
+                    return
+
+                # Every press and release is sent as it happens, so a tap shorter than a tick still reaches the server.
+                if playing and event.type in (pygame.KEYDOWN, pygame.KEYUP) and event.key in KEY_BINDINGS:
+                    if event.type == pygame.KEYDOWN:
+                        held_inputs |= KEY_BINDINGS[event.key]
+                    else:
+                        held_inputs &= ~KEY_BINDINGS[event.key]
+                    client.send_inputs(held_inputs)
+
+            pygame.display.update(renderer.draw(game))
+            await asyncio.sleep(1 / FPS)
+
+        # Raises the error that ended the connection, if any
+        receive_task.result()
+
+    finally:
+        receive_task.cancel()
+        pygame.quit()
+
+async def run_client(args):
+    '''Connects to the server and lists, watches or plays a match as the command line asks.'''
+
+    client = TetrisClient()
+    await client.connect(args.host, args.port)
+    try:
+        if args.list:
+            print(" ".join(str(match_id) for match_id in await client.list_matches()))
+            return
+
+        if args.spectate != None:
+            await client.spectate(args.spectate)
+        else:
+            await client.create(args.seed, args.width, args.height)
+
+        await run_window(client, client.game.role == ROLE_PLAYER)
+
+    finally:
+        client.close()
+
+def main():
+    '''Command-line entry point.'''
+
+    parser = argparse.ArgumentParser(description="Plays or watches a Tetris match on a tetris_server.py server.")
+    parser.add_argument("--host", default="127.0.0.1", help="server address (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help=f"server port (default: {DEFAULT_PORT})")
+    parser.add_argument("--spectate", metavar="ID", type=int, nargs="?", const=0, default=None, help="watch a match instead of playing (the oldest one if no ID is given)")
+    parser.add_argument("--list", action="store_true", help="print the ids of the running matches and exit")
+    parser.add_argument("--seed", type=int, default=0, help="seed for a new match (default: picked by the server)")
+    parser.add_argument("--width", type=int, default=Tetris.MATRIX_WIDTH, help=f"matrix width of a new match (default: {Tetris.MATRIX_WIDTH})")
+    parser.add_argument("--height", type=int, default=Tetris.MATRIX_HEIGHT, help=f"matrix height of a new match (default: {Tetris.MATRIX_HEIGHT})")
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(run_client(args))
+    except (ConnectionError, RuntimeError) as error:
+        print(error)
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,349 @@
+# Exports the placements of headless or replayed games as a fixed-width binary dataset, and reads it back with NumPy
+# through a memory map, so training pipelines can index and sample it without loading it into RAM.
+#
+# Dataset file layout (little-endian):
+#   4 bytes   magic, b"TDST"
+#   1 byte    format version
+#   2 bytes   matrix width in cells
+#   2 bytes   matrix height in cells
+#   2 bytes   record size in bytes
+#   8 bytes   number of records
+#   zero padding up to DATASET_HEADER_SIZE bytes, then the records, laid out as record_dtype().
+#
+# Each record is one placement: the board, active piece, held piece and preview queue the piece spawned into, where it
+# was placed, and what came of it. Boards are packed one bit per cell, bit (row * matrix width + column) of the board
+# being cell (row, column), so a 10x20 board takes 25 bytes. unpack_boards() turns them back into arrays of cells.
+#
+# Usage:
+#   python tetris_dataset.py placements.tds --games 1000 --policy heuristic [--line-cap 500]
+#   python tetris_dataset.py placements.tds --replays game1.replay game2.replay
+#   python tetris_dataset.py placements.tds --info
+
+import argparse
+import json
+import multiprocessing
+import os
+import struct
+import time
+
+import numpy as np
+
+from tetris import SevenBagRandomizer, Tetris
+from tetris_placements import board_bits
+from tetris_replay import load_replay, play_replay
+from tetris_tournament import load_policy, play_game
+
+DATASET_MAGIC = b"TDST"
+DATASET_VERSION = 1
+DATASET_HEADER = struct.Struct("<4sBHHHQ")
+# The records start at this offset, so each field of the first record is aligned the same way in the file and in memory.
+DATASET_HEADER_SIZE = 64
+
+# Stands for no piece in the piece and hold fields
+NO_PIECE = 7
+QUEUE_PREVIEW = 5
+
+def board_bytes(matrix_width, matrix_height):
+    '''Returns the number of bytes a board of the given size is packed into.'''
+
+    return((matrix_width * matrix_height + 7) // 8)
+
+def record_dtype(matrix_width = Tetris.MATRIX_WIDTH, matrix_height = Tetris.MATRIX_HEIGHT):
+    '''Returns the NumPy dtype of a record for boards of the given size.
+
+    "game" numbers the games in the order they were written, and "piece_index" the placements within a game.
+    The outcome of a placement is the lines it cleared, whether the game topped out right after it, and the placements
+    and lines the game went on to make after it before it ended.'''
+
+    return(np.dtype([
+        ("board", np.uint8, (board_bytes(matrix_width, matrix_height),)),
+        ("piece", np.uint8),
+        ("hold", np.uint8),
+        ("queue", np.uint8, (QUEUE_PREVIEW,)),
+        ("level", np.uint8),
+        ("placement_type", np.uint8),
+        ("placement_x", "<i2"),
+        ("placement_y", "<i2"),
+        ("placement_rotation", np.uint8),
+        ("placement_held", np.uint8),
+        ("lines_cleared", np.uint8),
+        ("game_over", np.uint8),
+        ("game", "<u4"),
+        ("piece_index", "<u4"),
+        ("pieces_remaining", "<u4"),
+        ("lines_remaining", "<u4"),
+    ]))
+
+def pack_board(game):
+    '''Returns the game's matrix packed one bit per cell, as bytes.'''
+
+    return(board_bits(game).to_bytes(board_bytes(game.matrix_width, game.matrix_height), "little"))
+
+def unpack_boards(boards, matrix_width = Tetris.MATRIX_WIDTH, matrix_height = Tetris.MATRIX_HEIGHT):
+    '''Unpacks an (..., board bytes) array of packed boards into an (..., matrix_height, matrix_width) array of 0s and 1s.'''
+
+    cells = np.unpackbits(boards, axis=-1, count=matrix_width * matrix_height, bitorder="little")
+    return(cells.reshape(boards.shape[:-1] + (matrix_height, matrix_width)))
+
+class GameRecorder:
+    '''Collects the records of one game as its pieces are placed.
+
+    Every piece spawns into the board the previous piece left behind, so the state a piece was placed from is taken
+    right after the previous one locks, starting from the empty board of a new game with "seed".'''
+
+    def __init__(self, seed, matrix_width = Tetris.MATRIX_WIDTH, matrix_height = Tetris.MATRIX_HEIGHT):
+        self.matrix_width = matrix_width
+        self.matrix_height = matrix_height
+        self.records = []
+
+        upcoming = SevenBagRandomizer(seed).peek(QUEUE_PREVIEW + 1)
+        self.spawn_state = (bytes(board_bytes(matrix_width, matrix_height)), upcoming[0], NO_PIECE, upcoming[1:], 1)
+
+    def capture_spawn_state(self, game):
+        '''Stores the state the game's next piece spawns into: the active piece if there is one, otherwise the next in the queue.'''
+
+        upcoming = game.randomizer.peek(QUEUE_PREVIEW + 1)
+        if game.active_piece != None:
+            piece = game.active_piece.type
+            queue = upcoming[:QUEUE_PREVIEW]
+        else:
+            piece = upcoming[0]
+            queue = upcoming[1:]
+
+        hold = NO_PIECE if game.piece_held == None else game.piece_held
+        self.spawn_state = (pack_board(game), piece, hold, queue, min(1 + game.total_lines_cleared // 10, 255))
+
+    def record_placement(self, game):
+        '''Records the piece the game just locked, from game.last_placement and game.last_line_clear.'''
+
+        board, piece, hold, queue, level = self.spawn_state
+        self.records.append((board, piece, hold, queue, level) + game.last_placement + (game.last_line_clear[1],))
+        self.capture_spawn_state(game)
+
+    def finish(self, game_over):
+        '''Returns the game's records as an array of record_dtype(). "game_over" is whether the game ended by topping out.'''
+
+        records = np.zeros(len(self.records), dtype=record_dtype(self.matrix_width, self.matrix_height))
+        if len(self.records) == 0:
+            return(records)
+
+        boards, pieces, holds, queues, levels, types, xs, ys, rotations, held, lines = zip(*self.records)
+        records["board"] = np.frombuffer(b"".join(boards), dtype=np.uint8).reshape(len(self.records), -1)
+        records["piece"] = pieces
+        records["hold"] = holds
+        records["queue"] = queues
+        records["level"] = levels
+        records["placement_type"] = types
+        records["placement_x"] = xs
+        records["placement_y"] = ys
+        records["placement_rotation"] = rotations
+        records["placement_held"] = held
+        records["lines_cleared"] = lines
+        records["game_over"][-1] = game_over
+        records["piece_index"] = np.arange(len(records))
+        records["pieces_remaining"] = np.arange(len(records) - 1, -1, -1)
+
+        # Lines cleared after each placement, up to the end of the game
+        lines_cleared = records["lines_cleared"].astype(np.int64)
+        records["lines_remaining"] = np.cumsum(lines_cleared[::-1])[::-1] - lines_cleared
+
+        return(records)
+
+def record_policy_game(seed, policy_name, line_cap = None):
+    '''Plays a headless game with a tetris_tournament.py policy and returns its records.'''
+
+    recorder = GameRecorder(seed)
+    result = play_game(seed, load_policy(policy_name), line_cap, lambda game, placement: recorder.record_placement(game))
+    return(recorder.finish(result["topped_out"]))
+
+def record_replay(path):
+    '''Plays back the replay at "path" and returns its records.'''
+
+    seed, handling, matrix_size, runs = load_replay(path)
+    recorder = GameRecorder(seed, *matrix_size)
+    def on_tick(game, tick):
+        if game.last_line_clear != None:
+            recorder.record_placement(game)
+
+    game = play_replay(seed, handling, runs, on_tick=on_tick, matrix_size=matrix_size)
+    return(recorder.finish(not game.game_active))
+
+def record_task(task):
+    '''Pool worker entry point. "task" is ("policy", seed, policy name, line cap) or ("replay", path).'''
+
+    if task[0] == "policy":
+        return(record_policy_game(*task[1:]))
+
+    return(record_replay(task[1]))
+
+class DatasetWriter:
+    '''Appends games' records to a dataset file. The record count in the header is brought up to date after every
+    game, so a file cut short by a crash still reads back every game written before it.'''
+
+    def __init__(self, path, matrix_width = Tetris.MATRIX_WIDTH, matrix_height = Tetris.MATRIX_HEIGHT):
+        self.matrix_width = matrix_width
+        self.matrix_height = matrix_height
+        self.dtype = record_dtype(matrix_width, matrix_height)
+        self.record_count = 0
+        self.game_count = 0
+
+        self.file = open(path, "wb")
+        self.write_header()
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, exception_type, exception, traceback):
+        self.close()
+
+    def write_header(self):
+        '''Writes the header at the start of the file, leaving the file position at the end.'''
+
+        self.file.seek(0)
+        header = DATASET_HEADER.pack(DATASET_MAGIC, DATASET_VERSION, self.matrix_width, self.matrix_height, self.dtype.itemsize, self.record_count)
+        self.file.write(header.ljust(DATASET_HEADER_SIZE, b"\0"))
+        self.file.seek(0, os.SEEK_END)
+
+    def write_game(self, records):
+        '''Appends the records of one game from GameRecorder.finish(), numbering the game.'''
+
+        if records.dtype != self.dtype:
+            raise ValueError(f"records don't match the dataset's {self.matrix_width}x{self.matrix_height} matrix")
+
+        records["game"] = self.game_count
+        self.file.write(records.tobytes())
+        self.record_count += len(records)
+        self.game_count += 1
+        self.write_header()
+
+    def close(self):
+        self.file.close()
+
+class Dataset:
+    '''A dataset file opened read-only through a memory map. Only the pages that are read are loaded.
+
+    records is the structured array of every record, and indexing it, slicing it or taking a field like
+    records["board"] gives views into the file without copying.'''
+
+    def __init__(self, path):
+        with open(path, "rb") as dataset_file:
+            header = dataset_file.read(DATASET_HEADER_SIZE)
+        if len(header) < DATASET_HEADER.size or header[:4] != DATASET_MAGIC:
+            raise ValueError("not a dataset file")
+
+        magic, version, matrix_width, matrix_height, record_size, record_count = DATASET_HEADER.unpack_from(header)
+        if version != DATASET_VERSION:
+            raise ValueError(f"unsupported dataset version: {version}")
+
+        self.matrix_width = matrix_width
+        self.matrix_height = matrix_height
+        dtype = record_dtype(matrix_width, matrix_height)
+        if record_size != dtype.itemsize:
+            raise ValueError(f"record size {record_size} doesn't match the {matrix_width}x{matrix_height} layout ({dtype.itemsize})")
+
+        # np.memmap can't map an empty range.
+        if record_count > 0:
+            self.records = np.memmap(path, dtype=dtype, mode="r", offset=DATASET_HEADER_SIZE, shape=(record_count,))
+        else:
+            self.records = np.zeros(0, dtype=dtype)
+
+    def __len__(self):
+        return(len(self.records))
+
+    def __getitem__(self, index):
+        return(self.records[index])
+
+    def unpack_boards(self, boards):
+        '''Unpacks packed boards of this dataset into arrays of cells, like unpack_boards().'''
+
+        return(unpack_boards(boards, self.matrix_width, self.matrix_height))
+
+    def sample(self, batch_size, rng = None):
+        '''Returns "batch_size" records picked at random (with replacement), copied out of the file.
+
+        The indices are sorted first so the pages are read in order. "rng" is a numpy.random.Generator.'''
+
+        if rng == None:
+            rng = np.random.default_rng()
+
+        indices = np.sort(rng.integers(0, len(self.records), size=batch_size))
+        return(self.records[indices])
+
+    def batches(self, batch_size):
+        '''Yields the records in order, "batch_size" at a time, as views into the file.'''
+
+        for start in range(0, len(self.records), batch_size):
+            yield(self.records[start:start + batch_size])
+
+def summarize(dataset):
+    '''Returns the size and some totals of a dataset, reading it a batch at a time.'''
+
+    games = 0
+    lines = 0
+    game_overs = 0
+    for batch in dataset.batches(1 << 20):
+        games = max(games, int(batch["game"][-1]) + 1)
+        lines += int(batch["lines_cleared"].sum(dtype=np.int64))
+        game_overs += int(batch["game_over"].sum(dtype=np.int64))
+
+    return({
+        "records": len(dataset),
+        "games": games,
+        "games_topped_out": game_overs,
+        "matrix_size": [dataset.matrix_width, dataset.matrix_height],
+        "record_bytes": dataset.records.dtype.itemsize,
+        "lines_cleared": lines,
+    })
+
+def main():
+    '''Command-line entry point.'''
+
+    parser = argparse.ArgumentParser(description="Exports the placements of Tetris games as a memory-mappable dataset.")
+    parser.add_argument("output", help="dataset file to write (or to read, with --info)")
+    parser.add_argument("--replays", nargs="*", default=None, help="export these replay files instead of playing games")
+    parser.add_argument("--games", type=int, default=100, help="number of games to play (default: 100)")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the first game; game i uses seed + i")
+    parser.add_argument("--policy", default="heuristic", help="tetris_tournament.py policy to play with (default: heuristic)")
+    parser.add_argument("--line-cap", type=int, default=None, help="stop a game once it has cleared this many lines")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: one per core)")
+    parser.add_argument("--info", action="store_true", help="summarize an existing dataset instead of writing one")
+    args = parser.parse_args()
+
+    if args.info:
+        print(json.dumps(summarize(Dataset(args.output)), indent=2))
+        return
+
+    if args.replays != None:
+        tasks = [("replay", path) for path in args.replays]
+
+        # A dataset has one matrix size, so every replay is checked before anything is written.
+        matrix_sizes = {}
+        for path in args.replays:
+            try:
+                matrix_sizes.setdefault(load_replay(path)[2], []).append(path)
+            except (OSError, ValueError) as error:
+                parser.error(f"{path}: {error}")
+        if len(matrix_sizes) > 1:
+            parser.error("replays of different matrix sizes can't go in one dataset: "
+                         + ", ".join(f"{len(paths)} at {width}x{height} (such as {paths[0]})" for (width, height), paths in matrix_sizes.items()))
+        matrix_size = next(iter(matrix_sizes), (Tetris.MATRIX_WIDTH, Tetris.MATRIX_HEIGHT))
+    else:
+        load_policy(args.policy)
+        tasks = [("policy", args.seed + i, args.policy, args.line_cap) for i in range(args.games)]
+        matrix_size = (Tetris.MATRIX_WIDTH, Tetris.MATRIX_HEIGHT)
+
+    # Games are written in task order as they come back, so game numbers don't depend on the number of workers.
+    start_time = time.perf_counter()
+    with DatasetWriter(args.output, *matrix_size) as writer, multiprocessing.Pool(args.workers) as pool:
+        for records in pool.imap(record_task, tasks):
+            writer.write_game(records)
+    elapsed = time.perf_counter() - start_time
+
+    summary = summarize(Dataset(args.output))
+    summary["file_bytes"] = os.path.getsize(args.output)
+    summary["wall_time"] = elapsed
+    summary["records_per_second"] = summary["records"] / elapsed if elapsed > 0 else 0.0
+    print(json.dumps(summary, indent=2))
+
+if __name__ == "__main__":
+    main()
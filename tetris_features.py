@@ -0,0 +1,128 @@
+# Works out the board features of Tetris.features() for many candidate placements at once with NumPy, and scores them.
+# The features are those of the board each placement leaves behind once its full rows are cleared.
+
+import numpy as np
+
+from tetris import BoardFeatures, Tetris
+from tetris_batch import PIECE_CELLS
+
+# Rows are int64 row bits, with room for the two walls when counting transitions.
+MAX_MATRIX_WIDTH = 61
+
+# Set bits of every 16-bit integer.
+POPCOUNTS_16 = np.zeros(1 << 16, dtype=np.int64)
+for bit in range(16):
+    POPCOUNTS_16 += np.arange(1 << 16) >> bit & 1
+
+# Weights for score_placements(), by BoardFeatures field. "lines" weighs the lines a placement clears, and the
+# per-column features are weighed by their total.
+DEFAULT_WEIGHTS = {
+    "lines": 0.76,
+    "column_heights": -0.51,
+    "holes": -0.36,
+    "bumpiness": -0.18,
+}
+
+def popcount(values):
+    '''Returns the number of set bits of every value in an array of non-negative int64s.'''
+
+    return(POPCOUNTS_16[values & 0xFFFF] + POPCOUNTS_16[values >> 16 & 0xFFFF] + POPCOUNTS_16[values >> 32 & 0xFFFF]
+           + POPCOUNTS_16[values >> 48 & 0xFFFF])
+
+def placement_boards(game, placements):
+    '''Returns an (N, matrix height) array of the game's matrix with each placement's cells filled in, one row per row bits.'''
+
+    if game.matrix_width > MAX_MATRIX_WIDTH:
+        raise ValueError(f"matrix too wide for batched features: {game.matrix_width} columns (at most {MAX_MATRIX_WIDTH})")
+
+    rows = np.array([game.row_mask(i) for i in range(game.matrix_height)], dtype=np.int64)
+
+    positions = np.array([(placement.piece_type, placement.rotation, placement.y, placement.x) for placement in placements], dtype=np.int64)
+    cells = PIECE_CELLS[positions[:, 0], positions[:, 1]] + positions[:, None, 2:]
+
+    # Cells of one placement can share a row, so the bits are ORed in with np.bitwise_or.at().
+    boards = np.repeat(rows[None], len(placements), axis=0)
+    np.bitwise_or.at(boards, (np.repeat(np.arange(len(placements)), cells.shape[1]), cells[:, :, 0].ravel()), 1 << cells[:, :, 1].ravel())
+
+    return(boards)
+
+def clear_full_rows(boards, width):
+    '''Clears the full rows of every board in an (N, height) array of row bits in place, moving the rows above them down.
+
+    Returns the number of lines cleared on each board.'''
+
+    full = boards == (1 << width) - 1
+    lines = np.count_nonzero(full, axis=1)
+
+    # Most placements don't clear anything, so only the boards that do are compacted.
+    for n in np.flatnonzero(lines):
+        remaining_rows = boards[n, ~full[n]]
+        boards[n, :lines[n]] = 0
+        boards[n, lines[n]:] = remaining_rows
+
+    return(lines)
+
+def board_features(boards, width):
+    '''Returns the features of every board in an (N, height) array of row bits as a BoardFeatures of arrays.
+
+    Uses the same definitions as Tetris.features(): the per-column fields are (N, width) arrays and the rest are (N,) arrays.'''
+
+    count, height = boards.shape
+
+    # Bit j of a row of "stacked" is set if column j is filled in that row or any row above it.
+    stacked = np.bitwise_or.accumulate(boards, axis=1)
+    column_heights = ((stacked[:, :, None] >> np.arange(width)) & 1).sum(axis=1)
+
+    hole_cells = stacked & ~boards
+    holes = popcount(hole_cells).sum(axis=1)
+
+    # A filled cell is covered if there's a hole anywhere below it in its column.
+    hole_below = np.bitwise_or.accumulate(hole_cells[:, ::-1], axis=1)[:, ::-1]
+    covered_cells = popcount(boards & hole_below).sum(axis=1)
+
+    bumpiness = np.abs(np.diff(column_heights, axis=1)).sum(axis=1)
+
+    # The walls count as filled cells, and empty rows count as having no transitions.
+    walled_rows = boards << 1 | 1 | 1 << (width + 1)
+    row_transitions = (popcount((walled_rows ^ walled_rows >> 1) & ((1 << (width + 1)) - 1)) * (boards != 0)).sum(axis=1)
+
+    # The floor counts as a filled row.
+    column_transitions = popcount(boards[:, :-1] ^ boards[:, 1:]).sum(axis=1) + popcount(boards[:, -1] ^ ((1 << width) - 1))
+
+    walled_heights = np.full((count, width + 2), height)
+    walled_heights[:, 1:-1] = column_heights
+    well_depths = np.maximum(0, np.minimum(walled_heights[:, :-2], walled_heights[:, 2:]) - column_heights)
+
+    empty_cells = width - popcount(boards)
+    near_complete_rows = np.count_nonzero((empty_cells > 0) & (empty_cells <= Tetris.NEAR_COMPLETE_EMPTY_CELLS), axis=1)
+
+    return(BoardFeatures(column_heights, holes, covered_cells, bumpiness, row_transitions, column_transitions, well_depths, near_complete_rows))
+
+def placement_features(game, placements):
+    '''Returns the lines each placement would clear, as an (N,) array, and the features of the board it would leave behind,
+    as a BoardFeatures of arrays (see board_features()). Doesn't change the game.'''
+
+    if len(placements) == 0:
+        return(np.zeros(0, dtype=np.int64), board_features(np.zeros((0, game.matrix_height), dtype=np.int64), game.matrix_width))
+
+    boards = placement_boards(game, placements)
+    lines = clear_full_rows(boards, game.matrix_width)
+    return(lines, board_features(boards, game.matrix_width))
+
+def score_placements(game, placements, weights = DEFAULT_WEIGHTS):
+    '''Scores every placement with a weighted sum of the lines it clears and the features of the board it leaves behind.
+    Returns an (N,) array of scores. Higher is better.'''
+
+    lines, features = placement_features(game, placements)
+
+    scores = np.zeros(len(placements))
+    for name, weight in weights.items():
+        if name == "lines":
+            values = lines
+        else:
+            values = getattr(features, name)
+            if values.ndim == 2:
+                values = values.sum(axis=1)
+        scores += weight * values
+
+    return(scores)
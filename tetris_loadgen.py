@@ -0,0 +1,158 @@
+# Loads a tetris_server.py server with many matches at once, all from one process. Each match has a player sending
+# random inputs and some spectators. Prints the stream each connection got and the input latency as JSON.
+#
+# Without --port, a server is started in this process on a free port. Its own load is reported too, and once the ticks
+# stop, every client's copy of its game is checked against the server's. The clients share the process with the
+# server, so for the server's load on its own, run tetris_server.py --stats-interval separately and pass --port.
+#
+# Usage: python tetris_loadgen.py [--matches 100] [--spectators 2] [--duration 10] [--host HOST --port PORT]
+
+import argparse
+import asyncio
+import itertools
+import json
+import random as rand
+import time
+
+from tetris import FPS
+from tetris_client import TetrisClient
+from tetris_profiler import percentile
+from tetris_server import TetrisServer
+
+# Connections opened at once, to stay inside the server's listen backlog
+CONNECT_BATCH_SIZE = 50
+
+async def connect_all(host, port, count):
+    '''Opens "count" connections to the server. Returns the clients.'''
+
+    clients = []
+    while len(clients) < count:
+        batch = [TetrisClient() for i in range(min(CONNECT_BATCH_SIZE, count - len(clients)))]
+        await asyncio.gather(*(client.connect(host, port) for client in batch))
+        clients += batch
+
+    return(clients)
+
+async def play_randomly(client, rng, input_rate, stop_time):
+    '''Sends random inputs for the client's match until "stop_time": every tick, each key is pressed or released with
+    probability "input_rate". Returns the number of inputs sent.'''
+
+    held_inputs = 0
+    inputs_sent = 0
+    while time.perf_counter() < stop_time:
+        new_inputs = held_inputs
+        for bit in range(8):
+            if rng.random() < input_rate:
+                new_inputs ^= 1 << bit
+
+        if new_inputs != held_inputs:
+            held_inputs = new_inputs
+            client.send_inputs(held_inputs)
+            inputs_sent += 1
+
+        await asyncio.sleep(1 / FPS)
+
+    return(inputs_sent)
+
+def game_differences(remote, game):
+    '''Returns the names of the parts of the RemoteGame "remote" that don't match the server's Tetris "game".'''
+
+    piece = game.active_piece
+    remote_piece = remote.active_piece
+    checks = {
+        "field": [list(row) for row in remote.field] == [list(row) for row in game.field],
+        "piece": (None if remote_piece == None else (remote_piece.type, remote_piece.x, remote_piece.y, remote_piece.rotation))
+                 == (None if piece == None else (piece.type, piece.x, piece.y, piece.rotation)),
+        "queue": remote.queue == list(itertools.islice(game.queue, len(remote.queue))),
+        "hold": (remote.piece_held, remote.hold_used) == (game.piece_held, game.hold_used),
+        "stats": (remote.score, remote.level, remote.total_lines_cleared, remote.game_active)
+                 == (game.score, game.level, game.total_lines_cleared, game.game_active),
+    }
+
+    return([name for name, matches in checks.items() if not matches])
+
+async def run_load(args):
+    '''Runs the load test the command line asks for and returns its report.'''
+
+    server = None
+    host = args.host
+    port = args.port
+    if port == None:
+        server = TetrisServer()
+        port = await server.start(host, 0)
+
+    players = await connect_all(host, port, args.matches)
+    games = await asyncio.gather(*(client.create(args.seed + i if args.seed else 0, args.width, args.height) for i, client in enumerate(players)))
+
+    spectators = await connect_all(host, port, args.matches * args.spectators)
+    await asyncio.gather(*(client.spectate(games[i // args.spectators].match_id) for i, client in enumerate(spectators)))
+
+    clients = players + spectators
+    if server != None:
+        server.report_stats()
+
+    start_time = time.perf_counter()
+    receive_tasks = [asyncio.create_task(client.receive_states()) for client in clients]
+    rng = rand.Random(args.seed)
+    inputs_sent = await asyncio.gather(*(play_randomly(client, rand.Random(rng.getrandbits(64)), args.input_rate, start_time + args.duration)
+                                         for client in players))
+    elapsed = time.perf_counter() - start_time
+
+    report = {
+        "matches": args.matches,
+        "spectators_per_match": args.spectators,
+        "connections": len(clients),
+        "duration_s": elapsed,
+        "inputs_sent": sum(inputs_sent),
+    }
+    if server != None:
+        report["server"] = server.report_stats()
+
+        # Stops the ticks and gives the last updates time to arrive, then checks every copy against the server's game.
+        await server.close()
+        await asyncio.sleep(0.5)
+        differences = {}
+        for client in clients:
+            for name in game_differences(client.game, server.matches[client.game.match_id].game):
+                differences[name] = differences.get(name, 0) + 1
+        report["mismatched_games"] = differences
+
+    for client in clients:
+        client.close()
+    await asyncio.gather(*receive_tasks)
+
+    states = sum(client.states_received for client in clients)
+    bytes_received = sum(client.bytes_received for client in clients)
+    keyframe_sizes = [size for client in clients for size in client.keyframe_sizes]
+    latencies_ms = sorted(latency * 1000 for client in players for latency in client.input_latencies)
+    report.update({
+        "states_per_connection_per_s": states / len(clients) / elapsed,
+        "bytes_per_connection_per_s": bytes_received / len(clients) / elapsed,
+        "bytes_per_state": bytes_received / states if states > 0 else 0.0,
+        "keyframe_bytes": sum(keyframe_sizes) / len(keyframe_sizes) if keyframe_sizes else 0.0,
+        "input_latency_ms_p50": percentile(latencies_ms, 50),
+        "input_latency_ms_p95": percentile(latencies_ms, 95),
+        "input_latency_ms_p99": percentile(latencies_ms, 99),
+    })
+
+    return(report)
+
+def main():
+    '''Command-line entry point.'''
+
+    parser = argparse.ArgumentParser(description="Loads a Tetris server with many matches and spectators.")
+    parser.add_argument("--host", default="127.0.0.1", help="server address (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=None, help="server port (default: start a server in this process)")
+    parser.add_argument("--matches", type=int, default=100, help="matches to play at once (default: 100)")
+    parser.add_argument("--spectators", type=int, default=2, help="spectators watching each match (default: 2)")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to play for (default: 10)")
+    parser.add_argument("--input-rate", type=float, default=0.02, help="chance each key is pressed or released every tick (default: 0.02)")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the inputs and, if not 0, the matches (default: 0)")
+    parser.add_argument("--width", type=int, default=10, help="matrix width of the matches (default: 10)")
+    parser.add_argument("--height", type=int, default=20, help="matrix height of the matches (default: 20)")
+    args = parser.parse_args()
+
+    print(json.dumps(asyncio.run(run_load(args)), indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,379 @@
+# Finds every final resting placement a piece can reach, along with the inputs that get it there.
+
+from collections import OrderedDict, deque
+from functools import lru_cache
+
+from tetris import (INPUT_HARD_DROP, INPUT_HOLD, INPUT_MOVE_LEFT, INPUT_MOVE_RIGHT, INPUT_ROTATE_180, INPUT_ROTATE_CCW,
+                    INPUT_ROTATE_CW, INPUT_SOFT_DROP, Tetris, Tetromino, register_table_rebuilder)
+
+# How far outside the matrix a piece's grid may sit. Covers the empty rows and columns of the 5x5 I piece grid.
+MASK_MARGIN = 4
+
+# Rotation inputs and the rotation distance each one passes to Tetromino.rotate()
+ROTATIONS = [(INPUT_ROTATE_CW, 1), (INPUT_ROTATE_CCW, -1), (INPUT_ROTATE_180, 2)]
+
+class Placement:
+    '''A final resting position for a piece, and the inputs that get it there from its spawn position.
+
+    "path" is a tuple of INPUT_* flags, one per action. INPUT_SOFT_DROP stands for moving down one row,
+    and the path always ends with INPUT_HARD_DROP. If "held" is True, the path starts with INPUT_HOLD.'''
+
+    def __init__(self, piece_type, x, y, rotation, path, held = False):
+        self.piece_type = piece_type
+        self.x = x
+        self.y = y
+        self.rotation = rotation
+        self.path = path
+        self.held = held
+
+    def __repr__(self):
+        return(f"Placement(type={self.piece_type}, x={self.x}, y={self.y}, rotation={self.rotation}, held={self.held}, path_length={len(self.path)})")
+
+    def cells(self):
+        '''Returns the (row, column) of every cell the piece covers once placed.'''
+
+        return([(self.y + row, self.x + column) for row, column in Tetris.FIGURE_CELLS[self.piece_type][self.rotation]])
+
+def build_kick_offsets():
+    '''Returns the SRS kicks indexed [type][rotation][new rotation], as a tuple of (x, y) moves in the order Tetromino.rotate() tries them.'''
+
+    kicks = []
+    for piece_type in range(7):
+        type_kicks = []
+        for rotation in range(4):
+            rotation_kicks = []
+            for new_rotation in range(4):
+                if piece_type == 0:
+                    tests = [(Tetromino.I_OFFSET_DATA[rotation][i], Tetromino.I_OFFSET_DATA[new_rotation][i]) for i in range(5)]
+                elif piece_type == 3:
+                    tests = [(Tetromino.O_OFFSET_DATA[rotation], Tetromino.O_OFFSET_DATA[new_rotation])]
+                else:
+                    tests = [(Tetromino.JLSTZ_OFFSET_DATA[rotation][i], Tetromino.JLSTZ_OFFSET_DATA[new_rotation][i]) for i in range(5)]
+
+                # Tetromino.rotate() adds the X difference and subtracts the Y difference.
+                rotation_kicks.append(tuple((previous[0] - new[0], new[1] - previous[1]) for previous, new in tests))
+            type_kicks.append(rotation_kicks)
+        kicks.append(type_kicks)
+
+    return(kicks)
+
+KICK_OFFSETS = build_kick_offsets()
+
+@lru_cache(maxsize=None)
+def build_board_masks(matrix_width, matrix_height):
+    '''Precomputes every piece's cells as a single integer over the whole matrix, where bit (row * matrix_width + column) is a cell.
+
+    Returns masks[type][rotation][x + MASK_MARGIN][y + MASK_MARGIN], or None where part of the piece is outside the matrix.
+    A piece fits if its mask ANDed with the board integer from board_bits() is 0.'''
+
+    masks = []
+    for piece_type in range(7):
+        type_masks = []
+        for rotation in range(4):
+            figure_cells = Tetris.FIGURE_CELLS[piece_type][rotation]
+            rotation_masks = []
+            for x in range(-MASK_MARGIN, matrix_width):
+                column_masks = []
+                for y in range(-MASK_MARGIN, matrix_height):
+                    mask = 0
+                    for row, column in figure_cells:
+                        if not (0 <= x + column < matrix_width and 0 <= y + row < matrix_height):
+                            mask = None
+                            break
+                        mask |= 1 << ((y + row) * matrix_width + x + column)
+
+                    column_masks.append(mask)
+                rotation_masks.append(column_masks)
+            type_masks.append(rotation_masks)
+        masks.append(type_masks)
+
+    return(masks)
+
+def board_bits(game):
+    '''Returns the game's matrix as one integer, where bit (row * matrix width + column) is set if the cell is filled.'''
+
+    board = 0
+    for i in range(game.matrix_height - 1, -1, -1):
+        board = board << game.matrix_width | game.row_mask(i)
+
+    return(board)
+
+def search_states(board, piece_type, matrix_width = Tetris.MATRIX_WIDTH, matrix_height = Tetris.MATRIX_HEIGHT, start = None):
+    '''Runs a breadth-first search over shifts, one-row soft drops and SRS rotations (kicks included), from "start", an
+    (x, y, rotation) state, or from the piece's spawn position if None.
+
+    Returns the resting states, keyed by the board mask of the cells they cover (the first state found for each), and a
+    dict mapping every state reached to the (state, input) it was first reached from, or None for the start state.
+    Both are empty if the piece doesn't fit at the start. The move reset limit isn't modelled, so every state assumes
+    the piece doesn't lock early.'''
+
+    masks = build_board_masks(matrix_width, matrix_height)[piece_type]
+    kicks = KICK_OFFSETS[piece_type]
+
+    def fits(x, y, rotation):
+        if not (-MASK_MARGIN <= x < matrix_width and -MASK_MARGIN <= y < matrix_height):
+            return(False)
+        mask = masks[rotation][x + MASK_MARGIN][y + MASK_MARGIN]
+        return(mask != None and not board & mask)
+
+    if start == None:
+        start = Tetromino.spawn_position(piece_type, matrix_width) + (0,)
+    if not fits(*start):
+        return({}, {})
+
+    # Each state is (x, y, rotation).
+    parents = {start: None}
+    frontier = deque([start])
+    resting_states = {}
+
+    while frontier:
+        state = frontier.popleft()
+        x, y, rotation = state
+
+        successors = []
+        if fits(x - 1, y, rotation):
+            successors.append(((x - 1, y, rotation), INPUT_MOVE_LEFT))
+        if fits(x + 1, y, rotation):
+            successors.append(((x + 1, y, rotation), INPUT_MOVE_RIGHT))
+
+        # A piece that can't move down any further is a resting placement.
+        if fits(x, y + 1, rotation):
+            successors.append(((x, y + 1, rotation), INPUT_SOFT_DROP))
+        else:
+            cells = masks[rotation][x + MASK_MARGIN][y + MASK_MARGIN]
+            if cells not in resting_states:
+                resting_states[cells] = state
+
+        for rotation_input, rotation_distance in ROTATIONS:
+            new_rotation = (rotation + rotation_distance) % 4
+            for kick_x, kick_y in kicks[rotation][new_rotation]:
+                if fits(x + kick_x, y + kick_y, new_rotation):
+                    successors.append(((x + kick_x, y + kick_y, new_rotation), rotation_input))
+                    break
+
+        for successor, action in successors:
+            if successor not in parents:
+                parents[successor] = (state, action)
+                frontier.append(successor)
+
+    return(resting_states, parents)
+
+def trace_route(parents, state):
+    '''Returns the shortest route from the start of a search_states() search to "state", as a list of (state, input) steps
+    giving each input and the state it's pressed in.'''
+
+    route = []
+    step = parents[state]
+    while step != None:
+        route.append(step)
+        step = parents[step[0]]
+    route.reverse()
+
+    return(route)
+
+def search_placements(board, piece_type, matrix_width = Tetris.MATRIX_WIDTH, matrix_height = Tetris.MATRIX_HEIGHT, start = None):
+    '''Finds every resting placement of a piece from "start", an (x, y, rotation) state, or from its spawn position if None.
+
+    Returns a list of Placements, one per distinct set of covered cells, each with the shortest path that reaches it.
+    The move reset limit isn't modelled, so every placement assumes the piece doesn't lock early.'''
+
+    resting_states, parents = search_states(board, piece_type, matrix_width, matrix_height, start)
+
+    results = []
+    for state in resting_states.values():
+        path = tuple(action for previous_state, action in trace_route(parents, state)) + (INPUT_HARD_DROP,)
+        results.append(Placement(piece_type, state[0], state[1], state[2], path))
+
+    return(results)
+
+def search_key_presses(board, piece_type, matrix_width = Tetris.MATRIX_WIDTH, matrix_height = Tetris.MATRIX_HEIGHT):
+    '''Finds the fewest key presses that take a piece from its spawn position to each of its resting placements, the
+    measure finesse is graded against.
+
+    Each press is one move of the search: a tap left or right, holding left or right until the piece stops (DAS), a
+    rotation, or holding soft drop until it lands. Gravity isn't modelled. A placement is then reached with a hard drop,
+    which is one more press. Returns a dict mapping the board mask of every reachable placement's cells to its fewest
+    presses, hard drop included. It's empty if the piece doesn't fit at its spawn position.'''
+
+    masks = build_board_masks(matrix_width, matrix_height)[piece_type]
+    kicks = KICK_OFFSETS[piece_type]
+
+    def fits(x, y, rotation):
+        if not (-MASK_MARGIN <= x < matrix_width and -MASK_MARGIN <= y < matrix_height):
+            return(False)
+        mask = masks[rotation][x + MASK_MARGIN][y + MASK_MARGIN]
+        return(mask != None and not board & mask)
+
+    start = Tetromino.spawn_position(piece_type, matrix_width) + (0,)
+    if not fits(*start):
+        return({})
+
+    # States are searched in order of presses, so the first hard drop found onto a placement is the cheapest.
+    presses = {start: 0}
+    frontier = deque([start])
+    placement_presses = {}
+
+    while frontier:
+        state = frontier.popleft()
+        x, y, rotation = state
+
+        landed_y = y
+        while fits(x, landed_y + 1, rotation):
+            landed_y += 1
+        cells = masks[rotation][x + MASK_MARGIN][landed_y + MASK_MARGIN]
+        if cells not in placement_presses:
+            placement_presses[cells] = presses[state] + 1
+
+        successors = []
+        if landed_y != y:
+            successors.append((x, landed_y, rotation))
+        for dx in (-1, 1):
+            if fits(x + dx, y, rotation):
+                successors.append((x + dx, y, rotation))
+                wall_x = x + dx
+                while fits(wall_x + dx, y, rotation):
+                    wall_x += dx
+                successors.append((wall_x, y, rotation))
+
+        for rotation_input, rotation_distance in ROTATIONS:
+            new_rotation = (rotation + rotation_distance) % 4
+            for kick_x, kick_y in kicks[rotation][new_rotation]:
+                if fits(x + kick_x, y + kick_y, new_rotation):
+                    successors.append((x + kick_x, y + kick_y, new_rotation))
+                    break
+
+        for successor in successors:
+            if successor not in presses:
+                presses[successor] = presses[state] + 1
+                frontier.append(successor)
+
+    return(placement_presses)
+
+class TranspositionTable:
+    '''A bounded least-recently-used cache keyed on Zobrist hashes of positions (see Tetris.position_hash()).
+
+    Keys are 64-bit hashes rather than the positions themselves, so two positions can share a key. With a bounded table
+    the chance of that happening over even billions of lookups is negligible.'''
+
+    def __init__(self, maxsize = 65536):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return(len(self.entries))
+
+    def get(self, key, default = None):
+        '''Returns the value stored under "key" and marks it as recently used, or "default" if there isn't one.'''
+
+        if key not in self.entries:
+            self.misses += 1
+            return(default)
+
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return(self.entries[key])
+
+    def put(self, key, value):
+        '''Stores "value" under "key", dropping the least recently used entry if the table is full.'''
+
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        '''Empties the table and resets its hit and miss counts.'''
+
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+# Placement lists found by generate_placements(), keyed by placement_key().
+PLACEMENT_TABLE = TranspositionTable(4096)
+
+@register_table_rebuilder
+def rebuild_tables():
+    '''Rebuilds KICK_OFFSETS and the board masks from the engine's tables, and empties PLACEMENT_TABLE.
+    KICK_OFFSETS is updated in place, since it's imported by name.'''
+
+    KICK_OFFSETS[:] = build_kick_offsets()
+    build_board_masks.cache_clear()
+    PLACEMENT_TABLE.clear()
+
+def placement_key(game, hold_piece_type):
+    '''Returns the transposition table key of the game's board, its active piece type and the piece holding would bring out.
+
+    Boards of different sizes get different keys.'''
+
+    return(game.field_hash ^ game.zobrist_row_keys[-1] ^ game.zobrist_column_keys[-1]
+           ^ Tetris.ZOBRIST_PIECE_KEYS[game.active_piece.type]
+           ^ Tetris.ZOBRIST_HOLD_KEYS[7 if hold_piece_type == None else hold_piece_type])
+
+def placement_hash(game, placement):
+    '''Returns the Zobrist hash of the board "placement" would leave behind, before any lines are cleared.
+
+    Equal to the field_hash the game would have after placing the piece there, without placing it.'''
+
+    return(game.hash_with_cells(placement.cells()))
+
+def find_placements(board, piece_type, hold_piece_type, matrix_width = Tetris.MATRIX_WIDTH, matrix_height = Tetris.MATRIX_HEIGHT, start = None):
+    '''Searches the placements of the active piece from "start" (see search_placements()) and, unless "hold_piece_type"
+    is None, those of the piece holding would bring out from its spawn position.'''
+
+    placements = search_placements(board, piece_type, matrix_width, matrix_height, start)
+    if hold_piece_type != None:
+        for placement in search_placements(board, hold_piece_type, matrix_width, matrix_height):
+            placements.append(Placement(placement.piece_type, placement.x, placement.y, placement.rotation,
+                                        (INPUT_HOLD,) + placement.path, True))
+
+    return(tuple(placements))
+
+def hold_option(game):
+    '''Returns the type of the piece holding would bring out (the held piece, or the next piece in the queue), or None if hold has been used for this piece.'''
+
+    if game.hold_used:
+        return(None)
+    if game.piece_held != None:
+        return(game.piece_held)
+    if len(game.queue) > 0:
+        return(game.queue[0])
+
+    return(None)
+
+def generate_placements(game, use_hold = True):
+    '''Returns every placement reachable by the game's active piece from its spawn position.
+
+    If "use_hold" is True and hold hasn't been used for this piece, also returns the placements of the piece that
+    holding would bring out (the held piece, or the next piece in the queue). The results are kept in PLACEMENT_TABLE
+    and shared between calls, so don't change them.'''
+
+    if game.active_piece == None:
+        return(())
+
+    hold_piece_type = hold_option(game) if use_hold else None
+
+    # The board integer is only built when the placements have to be searched.
+    key = placement_key(game, hold_piece_type)
+    placements = PLACEMENT_TABLE.get(key)
+    if placements == None:
+        placements = find_placements(board_bits(game), game.active_piece.type, hold_piece_type, game.matrix_width, game.matrix_height)
+        PLACEMENT_TABLE.put(key, placements)
+
+    return(placements)
+
+def apply_placement(game, placement):
+    '''Puts the game's active piece at "placement", holding first if the placement needs it, and locks it in.
+
+    Returns the line clear from Tetris.place_piece().'''
+
+    if placement.held:
+        game.hold_piece()
+
+    game.active_piece.x = placement.x
+    game.active_piece.y = placement.y
+    game.active_piece.rotation = placement.rotation
+    game.hard_drop()
+
+    return(game.last_line_clear)
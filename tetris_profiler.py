@@ -0,0 +1,261 @@
+# Measures where the pygame front end's frames go: time per phase of the main loop and of Tetris.step(), calls to the
+# engine's hot paths, and frame time percentiles. Shown as an overlay and written out as CSV and JSON while enabled.
+#
+# Turned on with F1 (along with the debug prints), or from the start by setting TETRIS_PROFILE to the directory
+# the dumps should go in. Without TETRIS_PROFILE, dumps go in ./profiles.
+
+import csv
+import functools
+import json
+import os
+import time
+from collections import deque
+
+# Frames a frame may take, as a multiple of the frame budget, before it counts as dropped.
+DROPPED_FRAME_FACTOR = 1.5
+
+# Frames between updates of the overlay's text.
+OVERLAY_REFRESH_FRAMES = 15
+
+class FrameProfiler:
+    '''Times the phases of each frame and counts calls to the engine's hot paths.
+
+    The engine methods are wrapped while the profiler is enabled and put back when it's disabled, so the engine runs
+    at full speed the rest of the time.'''
+
+    # (class name, method name, phase name). Each tick of Tetris.step() is split into these phases.
+    TIMED_METHODS = [
+        ("Tetris", "apply_gravity", "gravity"),
+        ("Tetris", "handle_inputs", "inputs"),
+        ("Tetris", "update_timers", "lock/das timers"),
+        ("Tetris", "apply_auto_repeat", "auto repeat"),
+        ("Tetris", "check_game_over", "game over check"),
+    ]
+
+    # (class name, method name)
+    COUNTED_METHODS = [
+        ("Tetris", "intersects"),
+        ("Tetris", "move_piece_down"),
+        ("Tetromino", "rotate"),
+        ("Tetris", "place_piece"),
+    ]
+
+    def __init__(self, engine_classes, fps, dump_directory = "profiles", window = 600):
+        '''"engine_classes" maps class names to the Tetris and Tetromino classes to instrument. "window" is how many
+        recent frames the percentiles are taken over.'''
+
+        self.engine_classes = engine_classes
+        self.fps = fps
+        self.frame_budget = 1000 / fps
+        self.dump_directory = dump_directory
+        self.enabled = False
+
+        self.frames = deque(maxlen=window)
+        self.phase_names = []
+        self.phase_times = {}
+        self.call_counts = {}
+        self.total_frames = 0
+        self.dropped_frames = 0
+        self.frame_start = None
+        self.lap_start = None
+        self.original_methods = []
+
+        self.csv_file = None
+        self.csv_writer = None
+        self.dump_name = None
+
+        self.overlay_frame = None
+        self.overlay_texts = []
+
+    def enable(self):
+        '''Starts profiling, wrapping the engine methods and opening a new CSV dump.'''
+
+        if self.enabled:
+            return
+
+        self.phase_names = ["events", "step"] + [phase for class_name, method_name, phase in FrameProfiler.TIMED_METHODS] + ["draw", "overlay", "display", "wait"]
+        self.phase_times = {phase: 0.0 for phase in self.phase_names}
+        self.call_counts = {method_name: 0 for class_name, method_name in FrameProfiler.COUNTED_METHODS}
+
+        for class_name, method_name, phase in FrameProfiler.TIMED_METHODS:
+            self.wrap(class_name, method_name, self.timed(phase))
+        for class_name, method_name in FrameProfiler.COUNTED_METHODS:
+            self.wrap(class_name, method_name, self.counted(method_name))
+
+        os.makedirs(self.dump_directory, exist_ok=True)
+        self.dump_name = os.path.join(self.dump_directory, time.strftime("profile-%Y%m%d-%H%M%S"))
+        self.csv_file = open(self.dump_name + ".csv", "w", newline="")
+        self.csv_writer = csv.writer(self.csv_file)
+        self.csv_writer.writerow(["frame", "frame_ms"] + [f"{phase}_ms" for phase in self.phase_names] + list(self.call_counts))
+
+        self.frames.clear()
+        self.total_frames = 0
+        self.dropped_frames = 0
+        self.frame_start = None
+        self.lap_start = None
+        self.overlay_frame = None
+        self.enabled = True
+
+    def disable(self):
+        '''Stops profiling, putting the engine methods back and writing the JSON summary.'''
+
+        if not self.enabled:
+            return
+
+        for target_class, method_name, method in reversed(self.original_methods):
+            setattr(target_class, method_name, method)
+        self.original_methods = []
+
+        self.write_summary()
+        self.csv_file.close()
+        self.csv_file = None
+        self.csv_writer = None
+        self.enabled = False
+
+    def wrap(self, class_name, method_name, make_wrapper):
+        '''Replaces a method of one of the engine classes with make_wrapper(method), remembering the original.'''
+
+        target_class = self.engine_classes[class_name]
+        method = target_class.__dict__[method_name]
+        self.original_methods.append((target_class, method_name, method))
+        setattr(target_class, method_name, functools.wraps(method)(make_wrapper(method)))
+
+    def timed(self, phase):
+        '''Returns a wrapper factory that adds the time spent in a method to "phase".'''
+
+        def make_wrapper(method):
+            def wrapper(*args, **kwargs):
+                start_time = time.perf_counter()
+                try:
+                    return(method(*args, **kwargs))
+                finally:
+                    self.phase_times[phase] += (time.perf_counter() - start_time) * 1000
+            return(wrapper)
+
+        return(make_wrapper)
+
+    def counted(self, method_name):
+        '''Returns a wrapper factory that counts the calls to a method.'''
+
+        def make_wrapper(method):
+            def wrapper(*args, **kwargs):
+                self.call_counts[method_name] += 1
+                return(method(*args, **kwargs))
+            return(wrapper)
+
+        return(make_wrapper)
+
+    def begin_frame(self):
+        '''Marks the start of a frame of the main loop. Finishes the previous frame's record if there was one.'''
+
+        if not self.enabled:
+            return
+
+        now = time.perf_counter()
+        if self.frame_start != None:
+            self.end_frame(now)
+
+        self.frame_start = now
+        self.lap_start = now
+
+    def lap(self, phase):
+        '''Adds the time since the last lap (or the start of the frame) to "phase".'''
+
+        if not self.enabled or self.lap_start == None:
+            return
+
+        now = time.perf_counter()
+        self.phase_times[phase] += (now - self.lap_start) * 1000
+        self.lap_start = now
+
+    def end_frame(self, now):
+        '''Records the frame that started at self.frame_start and resets the per-frame timers and counters.'''
+
+        frame_ms = (now - self.frame_start) * 1000
+
+        # The engine phases run inside "step", so they're taken out of it to keep the phases adding up to the frame.
+        self.phase_times["step"] -= sum(self.phase_times[phase] for class_name, method_name, phase in FrameProfiler.TIMED_METHODS)
+
+        frame = {"frame": self.total_frames, "frame_ms": frame_ms, "phases": self.phase_times, "calls": self.call_counts}
+        self.frames.append(frame)
+        self.total_frames += 1
+        if frame_ms > self.frame_budget * DROPPED_FRAME_FACTOR:
+            self.dropped_frames += 1
+
+        self.csv_writer.writerow([frame["frame"], f"{frame_ms:.3f}"] + [f"{self.phase_times[phase]:.3f}" for phase in self.phase_names]
+                                 + list(self.call_counts.values()))
+
+        # Flushes the CSV about once a second and rewrites the JSON summary about every 10 seconds.
+        if self.total_frames % self.fps == 0:
+            self.csv_file.flush()
+        if self.total_frames % (self.fps * 10) == 0:
+            self.write_summary()
+
+        self.phase_times = {phase: 0.0 for phase in self.phase_names}
+        self.call_counts = {method_name: 0 for method_name in self.call_counts}
+
+    def summary(self):
+        '''Returns frame time percentiles, dropped frames, and the mean phase times and call counts over the recent frames.'''
+
+        frame_times = sorted(frame["frame_ms"] for frame in self.frames)
+        frame_count = max(1, len(self.frames))
+
+        return({
+            "fps": self.fps,
+            "frame_budget_ms": self.frame_budget,
+            "total_frames": self.total_frames,
+            "dropped_frames": self.dropped_frames,
+            "window_frames": len(self.frames),
+            "frame_ms": {
+                "p50": percentile(frame_times, 50),
+                "p95": percentile(frame_times, 95),
+                "p99": percentile(frame_times, 99),
+                "max": frame_times[-1] if frame_times else 0.0,
+            },
+            "mean_phase_ms": {phase: sum(frame["phases"][phase] for frame in self.frames) / frame_count for phase in self.phase_names},
+            "mean_calls": {method_name: sum(frame["calls"][method_name] for frame in self.frames) / frame_count for method_name in self.call_counts},
+        })
+
+    def write_summary(self):
+        '''Writes summary() next to the CSV dump.'''
+
+        with open(self.dump_name + ".json", "w") as summary_file:
+            json.dump(self.summary(), summary_file, indent=2)
+
+    def draw_overlay(self, screen, font, color):
+        '''Draws the frame time percentiles, dropped frames, phase times and call counts in the top right corner of "screen".
+        Returns the rect drawn over, or None if the profiler is disabled.
+
+        The text is only re-rendered a few times a second, so drawing the overlay doesn't skew the frames it measures.'''
+
+        if not self.enabled:
+            return(None)
+
+        if self.overlay_frame == None or self.total_frames - self.overlay_frame >= OVERLAY_REFRESH_FRAMES:
+            self.overlay_frame = self.total_frames
+            summary = self.summary()
+            frame_ms = summary["frame_ms"]
+            lines = [
+                f"frame p50 {frame_ms['p50']:.1f}  p95 {frame_ms['p95']:.1f}  p99 {frame_ms['p99']:.1f} ms",
+                f"dropped {self.dropped_frames} / {self.total_frames}",
+            ]
+            lines += [f"{phase} {time_ms:.2f} ms" for phase, time_ms in summary["mean_phase_ms"].items() if phase != "wait"]
+            lines += [f"{method_name} {calls:.1f}/frame" for method_name, calls in summary["mean_calls"].items()]
+            self.overlay_texts = [font.render(line, True, color) for line in lines]
+
+        y = 5
+        drawn_rects = []
+        for text in self.overlay_texts:
+            drawn_rects.append(screen.blit(text, (screen.get_width() - text.get_width() - 5, y)))
+            y += text.get_height()
+
+        return(drawn_rects[0].unionall(drawn_rects[1:]) if drawn_rects else None)
+
+def percentile(sorted_values, percent):
+    '''Returns the nearest-rank percentile of a sorted list, or 0 if it's empty.'''
+
+    if not sorted_values:
+        return(0.0)
+
+    rank = max(0, min(len(sorted_values) - 1, round(percent / 100 * len(sorted_values)) - 1))
+    return(sorted_values[rank])
@@ -0,0 +1,318 @@
+# Draws games onto offscreen surfaces with the main loop's FrameRenderer and exports the frames as video, without a
+# window. Games are replays played back headless or boards of a BatchTetris, and several of them can be drawn side by
+# side in a grid.
+#
+# Frames go out as raw RGB24 to a file or pipe, for ffmpeg to encode, or as a numbered PNG sequence. PNGs are compressed
+# by a thread pool while the next frames are simulated and drawn; NumPy and zlib let go of the GIL while they work.
+#
+# Usage:
+#   python tetris_render.py game.replay --png frames/ [--every 2] [--start 600 --ticks 1800]
+#   python tetris_render.py a.replay b.replay c.replay d.replay --columns 2 --raw - | \
+#       ffmpeg -f rawvideo -pix_fmt rgb24 -s WIDTHxHEIGHT -r 60 -i - clip.mp4
+#   python tetris_render.py --batch 16 --ticks 3600 --columns 4 --png frames/
+
+import os
+
+# pygame greets on stdout when it's imported, which would end up in a raw video written to stdout.
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+
+import argparse
+import itertools
+import math
+import struct
+import sys
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pygame
+
+from tetris import FPS, FrameRenderer, Tetris, Tetromino, init_fonts, window_size
+from tetris_batch import QUEUE_CAPACITY, BatchTetris
+from tetris_client import RemoteGame
+from tetris_replay import load_replay
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+def png_chunk(chunk_type, data):
+    '''Returns a PNG chunk of "chunk_type" holding "data".'''
+
+    return(struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", zlib.crc32(chunk_type + data)))
+
+def encode_png(rgba, width, height, compression = 6):
+    '''Returns a PNG file of "rgba", an image's RGBA pixels from the top row down.
+
+    Every row is stored as its difference from the row above (PNG's "Up" filter). The matrix grid repeats down the
+    screen, so that leaves mostly zeros, which compress smaller and faster than the pixels themselves.'''
+
+    pixels = np.frombuffer(rgba, dtype=np.uint8).reshape(height, width * 4)
+    scanlines = np.empty((height, width * 4 + 1), dtype=np.uint8)
+    scanlines[:, 0] = 2
+    scanlines[0, 1:] = pixels[0]
+    np.subtract(pixels[1:], pixels[:-1], out=scanlines[1:, 1:])
+
+    return(PNG_SIGNATURE
+           + png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0))
+           + png_chunk(b"IDAT", zlib.compress(scanlines, compression))
+           + png_chunk(b"IEND", b""))
+
+def write_png(path, rgba, width, height, compression = 6):
+    '''Encodes "rgba" as a PNG and writes it to "path".'''
+
+    with open(path, "wb") as png_file:
+        png_file.write(encode_png(rgba, width, height, compression))
+
+class RawVideoWriter:
+    '''Writes frames to a binary stream as raw RGB24, one after another with nothing in between.'''
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.frame_count = 0
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, exception_type, exception, traceback):
+        self.close()
+
+    def write(self, surface):
+        '''Writes the pixels of "surface" as the next frame.'''
+
+        self.stream.write(pygame.image.tobytes(surface, "RGB"))
+        self.frame_count += 1
+
+    def close(self):
+        self.stream.flush()
+
+class PngSequenceWriter:
+    '''Writes frames as frame_000000.png, frame_000001.png, ... in "directory", encoding them on a pool of "workers" threads
+    at zlib level "compression".
+
+    The pixels are copied out of the surface right away, so it can be drawn over as soon as write() returns. At most
+    "max_pending" frames wait to be encoded at once; write() waits for the oldest if there are more.'''
+
+    def __init__(self, directory, workers = None, max_pending = None, compression = 6):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.compression = compression
+        self.pool = ThreadPoolExecutor(workers)
+        self.max_pending = max_pending or 4 * (workers or os.cpu_count() or 1)
+        self.pending = deque()
+        self.frame_count = 0
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, exception_type, exception, traceback):
+        self.close()
+
+    def write(self, surface):
+        '''Queues the pixels of "surface" to be written as the next frame.'''
+
+        width, height = surface.get_size()
+        path = os.path.join(self.directory, f"frame_{self.frame_count:06d}.png")
+        # RGBA is a straight copy of the surface's pixels, where RGB has to repack them.
+        self.pending.append(self.pool.submit(write_png, path, pygame.image.tobytes(surface, "RGBA"), width, height, self.compression))
+        self.frame_count += 1
+
+        while len(self.pending) > self.max_pending:
+            self.pending.popleft().result()
+
+    def close(self):
+        '''Waits for every frame to be written.'''
+
+        while self.pending:
+            self.pending.popleft().result()
+        self.pool.shutdown()
+
+class BatchBoardView:
+    '''Board "board" of a BatchTetris, with the attributes and methods of a Tetris that FrameRenderer uses.
+
+    Call update() after stepping the batch. Only the rows of the matrix that changed are replaced, so FrameRenderer
+    only redraws those, as it does for a Tetris.'''
+
+    get_scan_dimension = Tetris.get_scan_dimension
+    ghost_piece_y = RemoteGame.ghost_piece_y
+
+    def __init__(self, batch, board):
+        self.batch = batch
+        self.board = board
+        self.matrix_width = Tetris.MATRIX_WIDTH
+        self.matrix_height = Tetris.MATRIX_HEIGHT
+
+        self.cells = np.zeros((self.matrix_height, self.matrix_width), dtype=batch.field.dtype)
+        self.field = [[0] * self.matrix_width for i in range(self.matrix_height)]
+        # Counts changes to the matrix. FrameRenderer only compares it with its last value.
+        self.field_hash = 0
+        self.ghost_key = None
+        self.ghost_y = 0
+
+        self.update()
+
+    def update(self):
+        '''Brings the view up to date with its board.'''
+
+        batch = self.batch
+        board = self.board
+
+        field = batch.field[board]
+        changed_rows = np.nonzero((field != self.cells).any(axis=1))[0]
+        if len(changed_rows) > 0:
+            for i in changed_rows.tolist():
+                self.field[i] = field[i].tolist()
+            self.cells[changed_rows] = field[changed_rows]
+            self.field_hash += 1
+
+        if batch.piece_type[board] < 0:
+            self.active_piece = None
+        else:
+            piece = Tetromino.__new__(Tetromino)
+            piece.game = self
+            piece.type = int(batch.piece_type[board])
+            piece.x = int(batch.piece_x[board])
+            piece.y = int(batch.piece_y[board])
+            piece.rotation = int(batch.piece_rotation[board])
+            piece.move_reset_counter = 0
+            self.active_piece = piece
+
+        positions = (batch.queue_head[board] + np.arange(min(5, batch.queue_length[board]))) % QUEUE_CAPACITY
+        self.queue = batch.queue[board, positions].tolist()
+        self.piece_held = None if batch.piece_held[board] < 0 else int(batch.piece_held[board])
+        self.hold_used = bool(batch.hold_used[board])
+        self.score = int(batch.score[board])
+        self.level = int(batch.level[board])
+        self.total_lines_cleared = int(batch.total_lines_cleared[board])
+        self.game_active = bool(batch.game_active[board])
+
+class TiledRenderer:
+    '''Draws games side by side on one offscreen surface, "columns" to a row, each with its own FrameRenderer on its
+    part of the surface. Every tile is sized for the largest of "matrix_sizes", the (width, height) of each game's matrix.'''
+
+    def __init__(self, matrix_sizes, columns = None):
+        init_fonts()
+
+        count = len(matrix_sizes)
+        if columns == None:
+            columns = math.ceil(math.sqrt(count))
+        tile_width = max(window_size(*matrix_size)[0] for matrix_size in matrix_sizes)
+        tile_height = max(window_size(*matrix_size)[1] for matrix_size in matrix_sizes)
+
+        self.surface = pygame.Surface((tile_width * min(columns, count), tile_height * math.ceil(count / columns)))
+        self.renderers = [FrameRenderer(self.surface.subsurface((tile_width * (i % columns), tile_height * (i // columns), tile_width, tile_height)))
+                          for i in range(count)]
+
+    def draw(self, games):
+        '''Brings every tile up to date with its game. Returns the surface.'''
+
+        for renderer, game in zip(self.renderers, games):
+            renderer.draw(game)
+
+        return(self.surface)
+
+def replay_inputs(runs):
+    '''Returns an iterator over a replay's inputs, one per tick.'''
+
+    return(itertools.chain.from_iterable(itertools.repeat(inputs, length) for inputs, length in runs))
+
+def render_replays(paths, writer, every = 1, start = 0, ticks = None, columns = None):
+    '''Plays the replays at "paths" back together, drawing them side by side on every "every"th tick from tick
+    "start", for "ticks" ticks or until the longest one ends. Each frame is passed to writer.write(). Returns the surface.
+
+    A replay that ends before the others stays on its last tick.'''
+
+    replays = [load_replay(path) for path in paths]
+    games = []
+    for seed, handling, matrix_size, runs in replays:
+        game = Tetris("bitboard", seed=seed, matrix_width=matrix_size[0], matrix_height=matrix_size[1])
+        game.set_handling(*handling)
+        games.append(game)
+
+    inputs = [replay_inputs(runs) for seed, handling, matrix_size, runs in replays]
+    length = max(sum(length for inputs, length in runs) for seed, handling, matrix_size, runs in replays)
+    end = length if ticks == None else min(length, start + ticks)
+
+    renderer = TiledRenderer([(game.matrix_width, game.matrix_height) for game in games], columns)
+    for tick in range(1, end + 1):
+        for game, game_inputs in zip(games, inputs):
+            tick_inputs = next(game_inputs, None)
+            if tick_inputs != None:
+                game.step(tick_inputs)
+
+        if tick >= start and (tick - start) % every == 0:
+            writer.write(renderer.draw(games))
+
+    return(renderer.surface)
+
+def render_batch(batch, writer, ticks, every = 1, columns = None, input_rate = 0.05, seed = 0):
+    '''Steps "batch", a BatchTetris, for "ticks" ticks with random inputs, drawing every board side by side on every
+    "every"th tick. Each key is pressed or released with probability "input_rate" every tick. Returns the surface.'''
+
+    views = [BatchBoardView(batch, board) for board in range(batch.board_count)]
+    renderer = TiledRenderer([(view.matrix_width, view.matrix_height) for view in views], columns)
+    rng = np.random.default_rng(seed)
+    held_inputs = np.zeros(batch.board_count, dtype=np.int64)
+
+    for tick in range(1, ticks + 1):
+        toggles = rng.random((batch.board_count, 8)) < input_rate
+        held_inputs = held_inputs ^ (toggles << np.arange(8)).sum(axis=1)
+        batch.step(held_inputs)
+
+        if tick % every == 0:
+            for view in views:
+                view.update()
+            writer.write(renderer.draw(views))
+
+    return(renderer.surface)
+
+def main():
+    '''Command-line entry point.'''
+
+    parser = argparse.ArgumentParser(description="Renders Tetris replays or a batch of games to video frames without a window.")
+    parser.add_argument("replays", nargs="*", help="replay files to render side by side")
+    parser.add_argument("--batch", type=int, default=0, help="render this many BatchTetris games with random inputs instead")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the first batch game and of the inputs (default: 0)")
+    parser.add_argument("--every", type=int, default=1, help="draw every Nth tick (default: 1)")
+    parser.add_argument("--start", type=int, default=0, help="first replay tick to draw (default: 0)")
+    parser.add_argument("--ticks", type=int, default=None, help="ticks to draw (default: the whole replay, or 3600 for a batch)")
+    parser.add_argument("--columns", type=int, default=None, help="games per row of the grid (default: a square grid)")
+    parser.add_argument("--png", default=None, help="write frames as PNGs into this directory")
+    parser.add_argument("--raw", default=None, help="write frames as raw RGB24 to this file, or - for stdout")
+    parser.add_argument("--workers", type=int, default=None, help="PNG encoding threads (default: Python's default)")
+    parser.add_argument("--compression", type=int, default=6, help="PNG zlib level, 1 (fastest) to 9 (smallest) (default: 6)")
+    args = parser.parse_args()
+
+    if (args.png == None) == (args.raw == None):
+        parser.error("pick one of --png and --raw")
+    if (args.batch > 0) == bool(args.replays):
+        parser.error("give replay files or --batch, not both")
+
+    if args.png != None:
+        writer = PngSequenceWriter(args.png, args.workers, compression=args.compression)
+    elif args.raw == "-":
+        writer = RawVideoWriter(sys.stdout.buffer)
+    else:
+        writer = RawVideoWriter(open(args.raw, "wb"))
+
+    start_time = time.perf_counter()
+    with writer:
+        if args.batch > 0:
+            batch = BatchTetris(args.batch, [args.seed + i for i in range(args.batch)])
+            surface = render_batch(batch, writer, args.ticks or 3600, args.every, args.columns, seed=args.seed)
+        else:
+            surface = render_replays(args.replays, writer, args.every, args.start, args.ticks, args.columns)
+    elapsed = time.perf_counter() - start_time
+
+    if args.raw not in [None, "-"]:
+        writer.stream.close()
+
+    # Reported on stderr, since stdout may be the video.
+    width, height = surface.get_size()
+    print(f"{writer.frame_count} frames of {width}x{height} in {elapsed:.2f}s ({writer.frame_count / elapsed if elapsed > 0 else 0:.0f} frames/s)",
+          file=sys.stderr)
+    if args.raw != None:
+        print(f"encode with: ffmpeg -f rawvideo -pix_fmt rgb24 -s {width}x{height} -r {FPS}/{args.every} -i {args.raw} out.mp4", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
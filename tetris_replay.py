@@ -0,0 +1,226 @@
+# Records games as compact binary input logs, and plays them back through the headless engine as fast as possible.
+#
+# Replay file layout (little-endian):
+#   4 bytes   magic, b"TRPL"
+#   1 byte    format version
+#   8 bytes   seed of the game's SevenBagRandomizer
+#   2 bytes   DAS length in ticks
+#   2 bytes   ARR length in ticks
+#   2 bytes   matrix width in cells
+#   2 bytes   matrix height in cells
+#   16 bytes  the start of the ruleset_key() of the ruleset the game was played under, or zeros for the built-in tables
+#   then one run per change of input: 1 byte INPUT_* bitmask, followed by the number of ticks it was held as a LEB128 varint.
+#
+# Usage: python tetris_replay.py game.replay [--render-every N] [--rules DIRECTORY]
+
+import argparse
+import struct
+import time
+
+from tetris import FrameRenderer, SevenBagRandomizer, Tetris, init_display
+
+REPLAY_MAGIC = b"TRPL"
+# Version 6 widened the DAS and ARR lengths from 1 byte to 2. Version 5 added the ruleset. Version 4 added the matrix
+# size. Version 3 added the DAS and ARR lengths, and auto-repeat on its own timer. Version 2 replays used gravity adding
+# up in fractions of a row, and version 1 replays gravity on a frame counter. Neither plays back the same way any more.
+REPLAY_VERSION = 6
+REPLAY_HEADER = struct.Struct("<4sBQHHHH16s")
+# Longest DAS or ARR length a replay can record
+MAX_HANDLING_TICKS = 0xFFFF
+# Version 5 headers are version 6 headers with 1-byte DAS and ARR lengths. Version 4 headers are version 5 headers
+# without the ruleset, and version 3 headers are those without the matrix size. Those games were taken to be played
+# under the built-in tables, and version 3 games on the default matrix.
+REPLAY_HEADER_V5 = struct.Struct("<4sBQBBHH16s")
+REPLAY_HEADER_V4 = struct.Struct("<4sBQBBHH")
+REPLAY_HEADER_V3 = struct.Struct("<4sBQBB")
+BUILT_IN_RULESET_ID = bytes(16)
+
+def ruleset_id():
+    '''Returns what replays record of the ruleset in use: the first 16 bytes of Tetris.RULESET_KEY, or BUILT_IN_RULESET_ID.'''
+
+    return(bytes.fromhex(Tetris.RULESET_KEY[:32]) if Tetris.RULESET_KEY != None else BUILT_IN_RULESET_ID)
+
+def describe_ruleset(ruleset):
+    '''Describes a ruleset id from ruleset_id() for error messages.'''
+
+    return("the built-in tables" if ruleset == BUILT_IN_RULESET_ID else f"ruleset {ruleset.hex()}")
+
+class ReplayRecorder:
+    '''Records the inputs of one game, tick by tick.'''
+
+    def __init__(self, seed, das_ticks = Tetris.DAS_TICKS, arr_ticks = Tetris.ARR_TICKS, matrix_size = (Tetris.MATRIX_WIDTH, Tetris.MATRIX_HEIGHT)):
+        '''Starts a recording of a game created with Tetris(seed = seed), with the given DAS and ARR lengths and
+        (width, height) of the matrix. Raises ValueError if DAS or ARR is longer than a replay can record, so a game
+        that couldn't be saved isn't started.'''
+
+        if not (0 <= das_ticks <= MAX_HANDLING_TICKS and 0 <= arr_ticks <= MAX_HANDLING_TICKS):
+            raise ValueError(f"DAS and ARR must be 0-{MAX_HANDLING_TICKS} ticks to be recorded, not {das_ticks} and {arr_ticks}")
+
+        self.seed = seed & SevenBagRandomizer.MASK_64
+        self.handling = (das_ticks, arr_ticks)
+        self.matrix_size = tuple(matrix_size)
+        self.ruleset = ruleset_id()
+        self.runs = []
+        self.ticks = 0
+
+    def record(self, inputs):
+        '''Records the INPUT_* bitmask passed to Tetris.step() for one tick.'''
+
+        if self.runs and self.runs[-1][0] == inputs:
+            self.runs[-1][1] += 1
+        else:
+            self.runs.append([inputs, 1])
+        self.ticks += 1
+
+    def step(self, game, inputs = 0):
+        '''Records "inputs" and passes them to game.step(). Returns what game.step() returns.'''
+
+        self.record(inputs)
+        return(game.step(inputs))
+
+    def to_bytes(self):
+        '''Returns the recording in the replay file format.'''
+
+        data = bytearray(REPLAY_HEADER.pack(REPLAY_MAGIC, REPLAY_VERSION, self.seed, *self.handling, *self.matrix_size, self.ruleset))
+        for inputs, length in self.runs:
+            data.append(inputs)
+            write_varint(data, length)
+
+        return(bytes(data))
+
+    def save(self, path):
+        '''Writes the recording to "path". The file is only opened once the recording has been encoded.'''
+
+        data = self.to_bytes()
+        with open(path, "wb") as replay_file:
+            replay_file.write(data)
+
+def write_varint(data, value):
+    '''Appends "value" to the bytearray "data" as a LEB128 varint.'''
+
+    while value >= 0x80:
+        data.append(value & 0x7F | 0x80)
+        value >>= 7
+    data.append(value)
+
+def read_varint(data, position):
+    '''Reads a LEB128 varint from "data" at "position". Returns its value and the position after it.'''
+
+    value = 0
+    shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if byte < 0x80:
+            return(value, position)
+
+def read_replay(data):
+    '''Parses a replay. Returns its seed, its (DAS, ARR) lengths in ticks, its (width, height) of the matrix and a list
+    of (inputs, length) runs.
+
+    Raises ValueError if the replay was recorded under a different ruleset from the one in use, since it wouldn't play
+    back the same way.'''
+
+    # The version is checked before unpacking the rest, since older versions have shorter headers.
+    if data[:4] != REPLAY_MAGIC or len(data) < 5:
+        raise ValueError("not a replay file")
+
+    if data[4] == REPLAY_VERSION:
+        magic, version, seed, das_ticks, arr_ticks, matrix_width, matrix_height, ruleset = REPLAY_HEADER.unpack_from(data)
+        position = REPLAY_HEADER.size
+
+    elif data[4] == 5:
+        magic, version, seed, das_ticks, arr_ticks, matrix_width, matrix_height, ruleset = REPLAY_HEADER_V5.unpack_from(data)
+        position = REPLAY_HEADER_V5.size
+
+    elif data[4] == 4:
+        magic, version, seed, das_ticks, arr_ticks, matrix_width, matrix_height = REPLAY_HEADER_V4.unpack_from(data)
+        ruleset = BUILT_IN_RULESET_ID
+        position = REPLAY_HEADER_V4.size
+
+    elif data[4] == 3:
+        magic, version, seed, das_ticks, arr_ticks = REPLAY_HEADER_V3.unpack_from(data)
+        matrix_width, matrix_height = Tetris.MATRIX_WIDTH, Tetris.MATRIX_HEIGHT
+        ruleset = BUILT_IN_RULESET_ID
+        position = REPLAY_HEADER_V3.size
+
+    else:
+        raise ValueError(f"unsupported replay version: {data[4]}")
+
+    if ruleset != ruleset_id():
+        raise ValueError(f"replay was recorded under {describe_ruleset(ruleset)}, not {describe_ruleset(ruleset_id())}")
+
+    runs = []
+    while position < len(data):
+        inputs = data[position]
+        length, position = read_varint(data, position + 1)
+        runs.append((inputs, length))
+
+    return(seed, (das_ticks, arr_ticks), (matrix_width, matrix_height), runs)
+
+def load_replay(path):
+    '''Reads and parses the replay file at "path". Returns its seed, handling, matrix size and runs, like read_replay().'''
+
+    with open(path, "rb") as replay_file:
+        return(read_replay(replay_file.read()))
+
+def play_replay(seed, handling, runs, field_backend = "bitboard", on_tick = None, matrix_size = (Tetris.MATRIX_WIDTH, Tetris.MATRIX_HEIGHT)):
+    '''Feeds a replay's inputs through a headless game as fast as possible and returns the game.
+
+    "handling" is the (DAS, ARR) lengths in ticks and "matrix_size" the (width, height) of the matrix. "on_tick" is
+    called with the game and the tick number after every tick, if given.'''
+
+    game = Tetris(field_backend, seed=seed, matrix_width=matrix_size[0], matrix_height=matrix_size[1])
+    game.set_handling(*handling)
+    tick = 0
+    for inputs, length in runs:
+        for i in range(length):
+            game.step(inputs)
+            tick += 1
+            if on_tick != None:
+                on_tick(game, tick)
+
+    return(game)
+
+def main():
+    '''Command-line entry point. Plays a replay back and prints the final stats.'''
+
+    parser = argparse.ArgumentParser(description="Plays a Tetris replay back through the headless engine.")
+    parser.add_argument("replay", help="replay file to play")
+    parser.add_argument("--render-every", type=int, default=0, help="draw every Nth tick in a window (default: never)")
+    parser.add_argument("--rules", metavar="DIRECTORY", default=None, help="play back under the ruleset in this directory of data tables")
+    args = parser.parse_args()
+
+    if args.rules != None:
+        from tetris_rules import apply_ruleset, load_ruleset
+        apply_ruleset(load_ruleset(args.rules))
+
+    try:
+        seed, handling, matrix_size, runs = load_replay(args.replay)
+    except ValueError as error:
+        parser.error(f"{args.replay}: {error}")
+
+    on_tick = None
+    if args.render_every > 0:
+        import pygame
+
+        screen = init_display(*matrix_size)
+        renderer = FrameRenderer(screen)
+
+        def on_tick(game, tick):
+            if tick % args.render_every == 0:
+                pygame.event.pump()
+                pygame.display.update(renderer.draw(game))
+
+    start_time = time.perf_counter()
+    game = play_replay(seed, handling, runs, on_tick=on_tick, matrix_size=matrix_size)
+    elapsed = time.perf_counter() - start_time
+
+    ticks = sum(length for inputs, length in runs)
+    print(f"Score: {game.score}  Level: {game.level}  Lines: {game.total_lines_cleared}  Game over: {not game.game_active}")
+    print(f"{ticks} ticks in {elapsed:.3f}s ({ticks / elapsed if elapsed > 0 else 0:.0f} ticks/s, {ticks / elapsed / 60 if elapsed > 0 else 0:.0f}x real time)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+# Loads a ruleset (piece figures, SRS offset tables and level gravities) from data-table JSON files like the ones in
+# data-tables/, compiles it into the tables the engine uses, and caches the compiled form on disk.
+#
+# The data tables put every figure on a 5x5 grid, where Tetromino.FIGURES puts every piece but the I on a 3x3 grid.
+# Offset tables are listed with the piece letters they apply to. A compiled ruleset is stored under a key made from
+# the files' contents, so editing a file compiles it again and every process after that loads the compiled form.
+#
+# The engine's built-in tables stay the default. data-tables/ is the ruleset of the p5.js game, whose top gravity row
+# is [1, 2] (2 rows every tick) where Tetris.GRAVITIES has [0.5, 2].
+#
+# Usage: python tetris_rules.py [DIRECTORY] [--cache-dir DIR]
+
+import argparse
+import hashlib
+import json
+import os
+import pickle
+import sys
+import tempfile
+import time
+from collections import namedtuple
+
+from tetris import Tetris, Tetromino, build_figure_cells, build_gravity_steps, build_piece_bottoms, build_piece_row_masks
+
+DATA_TABLES_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data-tables")
+RULESET_FILES = ("tetromino-figures.json", "offset-data.json", "level-gravities.json")
+# Compiled rulesets are kept next to Python's own compiled modules.
+DEFAULT_CACHE_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "__pycache__", "rulesets")
+# Part of every cache key. Changing what compile_ruleset() produces means changing this.
+RULESET_FORMAT = 3
+
+PIECE_LETTERS = "IJLOSTZ"
+DATA_TABLE_GRID = 5
+
+# A compiled ruleset. "figures", the three offset tables and "gravities" are laid out like Tetromino.FIGURES, the
+# Tetromino *_OFFSET_DATA tables and Tetris.GRAVITIES. "figure_cells" holds each figure as (row, column) offsets
+# within its grid, like Tetris.FIGURE_CELLS, which is what the engine, the placement search and the batch engine read
+# cells from. The rest are the tables the engine builds from those: gravity per tick, the bottom profile of each
+# figure, and the bitboard collision masks for a matrix of the default width. "key" is the ruleset's ruleset_key().
+Ruleset = namedtuple("Ruleset", ["figures", "jlstz_offsets", "i_offsets", "o_offsets", "gravities", "figure_cells",
+                                 "gravity_denominator", "gravity_steps", "piece_bottoms", "piece_row_masks", "key"])
+
+def ruleset_key(directory):
+    '''Returns the cache key of the ruleset in "directory": a hash of the compiled format and every file's contents.'''
+
+    digest = hashlib.sha256(f"format {RULESET_FORMAT}".encode())
+    for name in RULESET_FILES:
+        with open(os.path.join(directory, name), "rb") as table_file:
+            contents = table_file.read()
+        digest.update(f"{name} {len(contents)}".encode())
+        digest.update(contents)
+
+    return(digest.hexdigest())
+
+def convert_figures(figures):
+    '''Converts figures from the data tables' 5x5 grid to Tetromino.FIGURES' grids: 5x5 for the I piece and 3x3 for the rest.'''
+
+    if len(figures) != len(PIECE_LETTERS) or any(len(rotations) != 4 for rotations in figures):
+        raise ValueError(f"expected 4 rotations of each of the {len(PIECE_LETTERS)} pieces")
+
+    converted = []
+    for piece_type, rotations in enumerate(figures):
+        scan_dimension = 5 if piece_type == 0 else 3
+        converted_rotations = []
+        for figure in rotations:
+            cells = [divmod(cell, DATA_TABLE_GRID) for cell in figure]
+            if len(cells) != 4 or any(not (0 <= row < scan_dimension and 0 <= column < scan_dimension) for row, column in cells):
+                raise ValueError(f"{PIECE_LETTERS[piece_type]} figure {figure} isn't 4 cells on a {scan_dimension}x{scan_dimension} grid")
+            converted_rotations.append(sorted(row * scan_dimension + column for row, column in cells))
+        converted.append(converted_rotations)
+
+    return(converted)
+
+def convert_offsets(offset_data):
+    '''Picks the JLSTZ, I and O tables out of the data tables' list of {"types", "table"} entries.
+
+    The engine has one table for the J, L, S, T and Z pieces, one for the I and one for the O, so the offset data must
+    group the pieces the same way. The O table has one test per rotation.'''
+
+    tables = {}
+    for entry in offset_data:
+        for letter in entry["types"]:
+            if letter not in PIECE_LETTERS or letter in tables:
+                raise ValueError(f"unknown or repeated piece in offset data: {letter}")
+            tables[letter] = entry["table"]
+
+    missing = [letter for letter in PIECE_LETTERS if letter not in tables]
+    if missing:
+        raise ValueError(f"no offset data for {''.join(missing)}")
+    if any(tables[letter] != tables["J"] for letter in "LSTZ"):
+        raise ValueError("the J, L, S, T and Z pieces must share one offset table")
+    if len(tables["J"]) != 4 or any(len(tests) != 5 for tests in tables["J"] + tables["I"]):
+        raise ValueError("the JLSTZ and I offset tables need 5 tests for each of the 4 rotations")
+    if len(tables["O"]) != 4 or any(len(tests) != 1 for tests in tables["O"]):
+        raise ValueError("the O offset table needs 1 test for each of the 4 rotations")
+
+    return(tables["J"], tables["I"], [tests[0] for tests in tables["O"]])
+
+def compile_ruleset(directory):
+    '''Reads the ruleset in "directory" and compiles it. Raises ValueError if it doesn't fit the engine.'''
+
+    tables = []
+    for name in RULESET_FILES:
+        with open(os.path.join(directory, name)) as table_file:
+            tables.append(json.load(table_file))
+    figures, offset_data, gravities = tables
+
+    figures = convert_figures(figures)
+    jlstz_offsets, i_offsets, o_offsets = convert_offsets(offset_data)
+    if len(gravities) == 0 or any(len(row) != 2 or row[0] <= 0 for row in gravities):
+        raise ValueError("level gravities must be [ticks per fall, rows per fall] rows")
+
+    figure_cells = build_figure_cells(figures)
+    gravity_denominator, gravity_steps = build_gravity_steps(gravities)
+
+    return(Ruleset(figures, jlstz_offsets, i_offsets, o_offsets, gravities, figure_cells, gravity_denominator, gravity_steps,
+                   build_piece_bottoms(figure_cells), {Tetris.MATRIX_WIDTH: build_piece_row_masks(Tetris.MATRIX_WIDTH, Tetris.PIECE_MASK_MARGIN, figure_cells)},
+                   ruleset_key(directory)))
+
+def load_ruleset(directory = DATA_TABLES_DIRECTORY, cache_directory = DEFAULT_CACHE_DIRECTORY):
+    '''Returns the compiled ruleset in "directory", from the cache if it's been compiled before.
+
+    A newly compiled ruleset is written to the cache under a temporary name and renamed into place, so processes
+    starting at the same time never read a half-written one. It's stored as a plain dict, so the cache doesn't depend
+    on the module Ruleset was defined in. A cache file that can't be read for any reason is compiled and written again.
+    If the cache can't be written, the ruleset is still returned.'''
+
+    path = os.path.join(cache_directory, f"ruleset-{ruleset_key(directory)[:32]}.pickle")
+    try:
+        with open(path, "rb") as cache_file:
+            return(Ruleset(**pickle.load(cache_file)))
+    except Exception:
+        pass
+
+    ruleset = compile_ruleset(directory)
+    try:
+        os.makedirs(cache_directory, exist_ok=True)
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=cache_directory, suffix=".tmp")
+        with os.fdopen(file_descriptor, "wb") as cache_file:
+            pickle.dump(ruleset._asdict(), cache_file, pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary_path, path)
+    except OSError:
+        pass
+
+    return(ruleset)
+
+def apply_ruleset(ruleset, engine = None):
+    '''Makes every game use "ruleset" in place of the built-in tables.
+
+    "engine" is the module to apply it to, the tetris module if None. tetris.py passes itself when it's run as a
+    script, since it's then __main__ and not the tetris module imported here. Modules that work out tables of their
+    own from the engine's, like tetris_placements.py and tetris_batch.py, have them rebuilt through the functions in
+    the engine's TABLE_REBUILDERS. Games made before this is called keep the collision masks they were made with.'''
+
+    engine = engine or sys.modules["tetris"]
+    engine.Tetromino.FIGURES = ruleset.figures
+    engine.Tetromino.JLSTZ_OFFSET_DATA = ruleset.jlstz_offsets
+    engine.Tetromino.I_OFFSET_DATA = ruleset.i_offsets
+    engine.Tetromino.O_OFFSET_DATA = ruleset.o_offsets
+    engine.Tetris.GRAVITIES = ruleset.gravities
+    engine.Tetris.GRAVITY_DENOMINATOR = ruleset.gravity_denominator
+    engine.Tetris.GRAVITY_STEPS = ruleset.gravity_steps
+    engine.Tetris.FIGURE_CELLS = ruleset.figure_cells
+    engine.Tetris.PIECE_BOTTOMS = ruleset.piece_bottoms
+
+    engine.Tetris.RULESET_KEY = ruleset.key
+
+    engine.PIECE_ROW_MASKS.clear()
+    engine.PIECE_ROW_MASKS.update(ruleset.piece_row_masks)
+    for rebuild in engine.TABLE_REBUILDERS:
+        rebuild()
+
+def built_in_differences(ruleset):
+    '''Returns the names of the tables in "ruleset" that differ from the engine's built-in ones.'''
+
+    built_in = {
+        "figures": Tetromino.FIGURES,
+        "jlstz_offsets": Tetromino.JLSTZ_OFFSET_DATA,
+        "i_offsets": Tetromino.I_OFFSET_DATA,
+        "o_offsets": Tetromino.O_OFFSET_DATA,
+        "gravities": Tetris.GRAVITIES,
+    }
+
+    return([name for name, table in built_in.items() if getattr(ruleset, name) != table])
+
+def main():
+    '''Command-line entry point. Loads a ruleset, compiling it if it isn't cached, and reports how it compares with the built-in one.'''
+
+    # Run as a script, this module is __main__. The tetris_rules module is the one every other process loads the cache with.
+    from tetris_rules import compile_ruleset, load_ruleset, ruleset_key
+
+    parser = argparse.ArgumentParser(description="Compiles a Tetris ruleset from data-table JSON files and caches it.")
+    parser.add_argument("directory", nargs="?", default=DATA_TABLES_DIRECTORY, help="directory holding the ruleset's JSON files (default: data-tables)")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIRECTORY, help="where compiled rulesets are kept (default: __pycache__/rulesets)")
+    args = parser.parse_args()
+
+    start_time = time.perf_counter()
+    compile_ruleset(args.directory)
+    compile_time = time.perf_counter() - start_time
+
+    load_ruleset(args.directory, args.cache_dir)
+    start_time = time.perf_counter()
+    ruleset = load_ruleset(args.directory, args.cache_dir)
+    load_time = time.perf_counter() - start_time
+
+    print(json.dumps({
+        "key": ruleset_key(args.directory),
+        "compile_ms": compile_time * 1000,
+        "cached_load_ms": load_time * 1000,
+        "differs_from_built_in": built_in_differences(ruleset),
+    }, indent=2))
+
+if __name__ == "__main__":
+    main()
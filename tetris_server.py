@@ -0,0 +1,599 @@
+# Hosts many headless games in one process with asyncio, and streams each game to the connections playing or watching
+# it. Every tick, only what changed is sent: the cells, piece, queue, hold and stats that differ from the last update.
+#
+# Every message is its length as a LEB128 varint, then a 1-byte message type and its body. Numbers in bodies are varints
+# unless noted otherwise.
+#
+#   Client to server
+#     MSG_CREATE    seed (8 bytes, 0 for a random one), matrix width, matrix height. Starts a match to play.
+#     MSG_SPECTATE  match id, or 0 for the oldest match. Watches a match.
+#     MSG_LIST      Asks for the ids of the running matches.
+#     MSG_INPUT     tick, INPUT_* bitmask (1 byte), client timestamp in nanoseconds (8 bytes). The keys held from that
+#                   tick on. Inputs stamped with a tick that has already run take effect on the next one.
+#
+#   Server to client
+#     MSG_JOINED    match id, role (1 byte, ROLE_*), seed (8 bytes), matrix width, matrix height. Followed by a keyframe.
+#     MSG_STATE     tick, STATE_* flags, then the section for each flag that's set, in flag order:
+#                     STATE_CLEARS  number of line clears, then for each: number of rows, then the cleared rows. Applied
+#                                   before the cells, in order.
+#                     STATE_CELLS   number of cells, then for each: row * matrix width + column, cell value (1 byte).
+#                     STATE_PIECE   piece type (1 byte, NO_PIECE for none), then x and y (zigzag) and rotation (1 byte).
+#                     STATE_QUEUE   pieces gone from the front, pieces added, then the added pieces (1 byte each).
+#                     STATE_HOLD    held piece (1 byte, NO_PIECE for none), hold used (1 byte).
+#                     STATE_STATS   score, level, lines, game active (1 byte).
+#                     STATE_ACK     client timestamp of the last input applied (8 bytes), tick it was applied on.
+#                   A STATE_KEYFRAME state starts from an empty game instead of from the previous state.
+#     MSG_MATCHES   number of matches, then their ids.
+#     MSG_ERROR     UTF-8 message. The connection is closed after it.
+#
+# Usage: python tetris_server.py [--host HOST] [--port PORT] [--stats-interval SECONDS]
+
+import argparse
+import asyncio
+import itertools
+import json
+import struct
+import time
+from collections import deque, namedtuple
+
+from tetris import FPS, Tetris, TickScheduler
+from tetris_profiler import percentile
+from tetris_replay import read_varint, write_varint
+
+MSG_CREATE = 0x01
+MSG_SPECTATE = 0x02
+MSG_LIST = 0x03
+MSG_INPUT = 0x04
+MSG_JOINED = 0x81
+MSG_STATE = 0x82
+MSG_MATCHES = 0x83
+MSG_ERROR = 0x8F
+
+STATE_KEYFRAME = 1 << 0
+STATE_CLEARS = 1 << 1
+STATE_CELLS = 1 << 2
+STATE_PIECE = 1 << 3
+STATE_QUEUE = 1 << 4
+STATE_HOLD = 1 << 5
+STATE_STATS = 1 << 6
+STATE_ACK = 1 << 7
+
+ROLE_PLAYER = 0
+ROLE_SPECTATOR = 1
+
+# Piece type sent for no piece
+NO_PIECE = 7
+
+# Pieces of the queue that are streamed, as many as the window shows
+QUEUE_PREVIEW = 5
+
+DEFAULT_PORT = 7400
+
+# Largest matrix a match can be created with, in cells
+MAX_MATRIX_CELLS = 1 << 16
+# Largest message a client can send, in bytes
+MAX_MESSAGE_SIZE = 64
+# Inputs a player can have waiting for their tick. A client that sends more is disconnected.
+MAX_PENDING_INPUTS = 256
+# Bytes a connection can have waiting to be sent before it's skipped. It's sent a keyframe once it has caught up.
+MAX_BUFFERED_BYTES = 1 << 16
+READ_SIZE = 1 << 16
+
+U64 = struct.Struct("<Q")
+
+# What connections see of a game. "rows" are the game's own row lists, which it copies before writing to, so they stay
+# as they were when captured. "piece" is (type, x, y, rotation) or None, "hold" is (piece held, hold used), and "stats"
+# is (score, level, lines, game active).
+MatchState = namedtuple("MatchState", ["rows", "piece", "queue", "hold", "stats"])
+
+def zigzag(value):
+    '''Maps a signed integer to a non-negative one for writing as a varint: 0, -1, 1, -2... to 0, 1, 2, 3...'''
+
+    return(value << 1 if value >= 0 else (-value << 1) - 1)
+
+def unzigzag(value):
+    '''Undoes zigzag().'''
+
+    return(value >> 1 if value & 1 == 0 else -((value + 1) >> 1))
+
+def frame_message(message_type, body = b""):
+    '''Returns a message ready to send: its length, its type and "body".'''
+
+    data = bytearray()
+    write_varint(data, len(body) + 1)
+    data.append(message_type)
+    data += body
+
+    return(bytes(data))
+
+def read_messages(buffer, max_size = None):
+    '''Takes every complete message off the front of the bytearray "buffer". Returns a list of (message type, body).
+
+    Raises ValueError for a message longer than "max_size" bytes, before it has all arrived.'''
+
+    messages = []
+    position = 0
+    while position < len(buffer):
+        try:
+            length, start = read_varint(buffer, position)
+        except IndexError:
+            break
+
+        if length == 0 or (max_size != None and length > max_size):
+            raise ValueError(f"bad message length: {length}")
+        if start + length > len(buffer):
+            break
+
+        messages.append((buffer[start], bytes(buffer[start + 1:start + length])))
+        position = start + length
+
+    del buffer[:position]
+    return(messages)
+
+def capture_state(game, rows = None):
+    '''Returns what connections see of "game" as a MatchState. "rows" is used instead of the game's rows if given.'''
+
+    piece = game.active_piece
+    return(MatchState(
+        tuple(game.field) if rows == None else rows,
+        None if piece == None else (piece.type, piece.x, piece.y, piece.rotation),
+        tuple(itertools.islice(game.queue, QUEUE_PREVIEW)),
+        (game.piece_held, game.hold_used),
+        (game.score, game.level, game.total_lines_cleared, game.game_active),
+    ))
+
+def empty_state(matrix_width, matrix_height):
+    '''Returns the MatchState keyframes start from: an empty matrix and nothing else.'''
+
+    empty_row = [0] * matrix_width
+    return(MatchState((empty_row,) * matrix_height, None, (), (None, False), None))
+
+def clear_rows(rows, cleared_rows):
+    '''Returns "rows" with the rows in "cleared_rows" taken out and empty rows added at the top, as clear_lines() leaves them.'''
+
+    cleared_rows = set(cleared_rows)
+    return((([0] * len(rows[0]),) * len(cleared_rows)) + tuple(row for i, row in enumerate(rows) if i not in cleared_rows))
+
+def encode_state(tick, previous, current, matrix_width, clears = (), ack = None):
+    '''Returns the body of a MSG_STATE taking a client from the MatchState "previous" to "current", or None if nothing changed.
+
+    "previous" is None for a keyframe. "clears" is the line clears since "previous", each as a list of cleared rows, and
+    "ack" is the (client timestamp, tick) of the last input applied since then, if any.'''
+
+    flags = 0
+    body = bytearray()
+
+    if previous == None:
+        flags |= STATE_KEYFRAME
+        previous = empty_state(matrix_width, len(current.rows))
+
+    # Rows moved down by a line clear are the same row lists in their new place, so sending the clear instead of their
+    # cells leaves only the cells of the locked pieces to send.
+    rows = previous.rows
+    if clears:
+        flags |= STATE_CLEARS
+        write_varint(body, len(clears))
+        for cleared_rows in clears:
+            write_varint(body, len(cleared_rows))
+            for row in cleared_rows:
+                write_varint(body, row)
+            rows = clear_rows(rows, cleared_rows)
+
+    if current.rows is not rows:
+        cells = bytearray()
+        count = 0
+        for i, row in enumerate(current.rows):
+            previous_row = rows[i]
+            if row is not previous_row and row != previous_row:
+                for j, cell in enumerate(row):
+                    if cell != previous_row[j]:
+                        write_varint(cells, i * matrix_width + j)
+                        cells.append(cell)
+                        count += 1
+
+        if count > 0:
+            flags |= STATE_CELLS
+            write_varint(body, count)
+            body += cells
+
+    if current.piece != previous.piece:
+        flags |= STATE_PIECE
+        if current.piece == None:
+            body.append(NO_PIECE)
+        else:
+            piece_type, x, y, rotation = current.piece
+            body.append(piece_type)
+            write_varint(body, zigzag(x))
+            write_varint(body, zigzag(y))
+            body.append(rotation)
+
+    # Dealing a piece takes one off the front of the queue and adds one to the back, so only the new one is sent.
+    if current.queue != previous.queue:
+        flags |= STATE_QUEUE
+        kept = len(previous.queue)
+        while current.queue[:kept] != previous.queue[len(previous.queue) - kept:]:
+            kept -= 1
+        write_varint(body, len(previous.queue) - kept)
+        write_varint(body, len(current.queue) - kept)
+        body += bytes(current.queue[kept:])
+
+    if current.hold != previous.hold:
+        flags |= STATE_HOLD
+        piece_held, hold_used = current.hold
+        body.append(NO_PIECE if piece_held == None else piece_held)
+        body.append(int(hold_used))
+
+    if current.stats != previous.stats:
+        flags |= STATE_STATS
+        score, level, lines, game_active = current.stats
+        write_varint(body, score)
+        write_varint(body, level)
+        write_varint(body, lines)
+        body.append(int(game_active))
+
+    if ack != None:
+        flags |= STATE_ACK
+        body += U64.pack(ack[0])
+        write_varint(body, ack[1])
+
+    if flags == 0:
+        return(None)
+
+    header = bytearray()
+    write_varint(header, tick)
+    write_varint(header, flags)
+    return(bytes(header + body))
+
+class Match:
+    '''A game hosted by the server, with the inputs its player has sent and the connections playing or watching it.'''
+
+    def __init__(self, match_id, seed = None, matrix_width = Tetris.MATRIX_WIDTH, matrix_height = Tetris.MATRIX_HEIGHT):
+        '''Starts a game created with Tetris(seed = seed) on a matrix of the given size.'''
+
+        self.match_id = match_id
+        self.game = Tetris("bitboard", seed=seed, matrix_width=matrix_width, matrix_height=matrix_height)
+        self.tick = 0
+        self.connections = set()
+        self.player = None
+
+        # (tick, inputs, client timestamp) of every input not applied yet, in tick order
+        self.pending_inputs = deque()
+        self.held_inputs = 0
+        self.late_inputs = 0
+
+        # Line clears and the last input applied since the last state update
+        self.clears = []
+        self.ack = None
+
+        # The state connections have been sent so far, and the game's field hash then
+        self.sent_state = capture_state(self.game)
+        self.sent_field_hash = self.game.field_hash
+        self.keyframe = None
+
+    def add_input(self, tick, inputs, timestamp):
+        '''Queues the player's inputs to be held from tick "tick" on.'''
+
+        if len(self.pending_inputs) >= MAX_PENDING_INPUTS:
+            raise ValueError("too many inputs waiting")
+
+        # Inputs are applied in the order they're sent, so one stamped before the last queued one waits for its tick.
+        if self.pending_inputs:
+            tick = max(tick, self.pending_inputs[-1][0])
+        self.pending_inputs.append((tick, inputs, timestamp))
+
+    def step(self):
+        '''Runs one tick of the game with the inputs due by it.
+
+        Like InputTimeline, keys pressed since the last tick count as held for this one even if they've been released since.'''
+
+        pressed_inputs = 0
+        while self.pending_inputs and self.pending_inputs[0][0] <= self.tick:
+            tick, inputs, timestamp = self.pending_inputs.popleft()
+            if tick < self.tick:
+                self.late_inputs += 1
+            pressed_inputs |= inputs & ~self.held_inputs
+            self.held_inputs = inputs
+            self.ack = (timestamp, self.tick)
+
+        line_clear = self.game.step(self.held_inputs | pressed_inputs)
+        if line_clear != None and line_clear[1] > 0:
+            self.clears.append(line_clear[0])
+        self.tick += 1
+
+    def state_update(self):
+        '''Returns the body of the MSG_STATE taking connections from the last state sent to the game as it is now, or None if
+        nothing they can see has changed.'''
+
+        game = self.game
+
+        # The rows are only looked at if the matrix has changed.
+        if game.field_hash == self.sent_field_hash and not self.clears:
+            state = capture_state(game, self.sent_state.rows)
+        else:
+            state = capture_state(game)
+
+        body = encode_state(self.tick, self.sent_state, state, game.matrix_width, self.clears, self.ack)
+        self.sent_state = state
+        self.sent_field_hash = game.field_hash
+        self.clears = []
+        self.ack = None
+        if body != None:
+            self.keyframe = None
+
+        return(body)
+
+    def keyframe_message(self):
+        '''Returns a MSG_STATE keyframe of the last state sent, for a connection that's joining or catching up.'''
+
+        if self.keyframe == None:
+            self.keyframe = frame_message(MSG_STATE, encode_state(self.tick, None, self.sent_state, self.game.matrix_width))
+
+        return(self.keyframe)
+
+class Connection:
+    '''A client connected to the server, and the match it's playing or watching.'''
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.match = None
+        self.role = None
+        self.lagging = False
+
+    def send(self, message):
+        '''Queues "message" to be sent.'''
+
+        self.writer.write(message)
+
+    def send_state(self, message):
+        '''Sends a MSG_STATE, unless the connection isn't keeping up. A connection that falls behind skips updates until
+        its buffer drains, then gets a keyframe in place of the update it would have missed.'''
+
+        if self.writer.transport.get_write_buffer_size() > MAX_BUFFERED_BYTES:
+            self.lagging = True
+            return(False)
+
+        if self.lagging:
+            self.lagging = False
+            message = self.match.keyframe_message()
+
+        self.send(message)
+        return(True)
+
+class TetrisServer:
+    '''Hosts matches for the clients connected to it, and runs them all on one tick clock.'''
+
+    def __init__(self, tick_rate = FPS):
+        self.tick_rate = tick_rate
+
+        # Matches by id, oldest first
+        self.matches = {}
+        self.match_ids = itertools.count(1)
+        self.connections = set()
+
+        self.server = None
+        self.tick_task = None
+
+        # Counters since the last stats report
+        self.stats_start_time = time.perf_counter()
+        self.ticks_run = 0
+        self.tick_times = []
+        self.states_sent = 0
+        self.bytes_sent = 0
+        self.skipped_states = 0
+
+    async def start(self, host = "127.0.0.1", port = DEFAULT_PORT):
+        '''Starts listening on "host" and "port" (any free port if 0) and running ticks. Returns the port listened on.'''
+
+        self.server = await asyncio.start_server(self.handle_connection, host, port)
+        self.scheduler = TickScheduler(self.tick_rate)
+        self.tick_task = asyncio.create_task(self.run_ticks())
+
+        return(self.server.sockets[0].getsockname()[1])
+
+    async def close(self):
+        '''Stops running ticks and accepting connections. Connections already open are left to the clients to close.'''
+
+        self.tick_task.cancel()
+        self.server.close()
+        try:
+            await self.tick_task
+        except asyncio.CancelledError:
+            pass
+
+    async def run_ticks(self):
+        '''Runs every match on the tick clock, and sends each one's state update to its connections after every batch of ticks.'''
+
+        while True:
+            tick_times = self.scheduler.due_ticks()
+            if tick_times:
+                start_time = time.perf_counter()
+                for match in list(self.matches.values()):
+                    for i in range(len(tick_times)):
+                        match.step()
+                    self.broadcast(match)
+                self.ticks_run += len(tick_times)
+                self.tick_times.append(time.perf_counter() - start_time)
+
+            await asyncio.sleep(max(0, self.scheduler.next_tick_time() - self.scheduler.clock()))
+
+    def broadcast(self, match):
+        '''Sends "match"'s state update, if anything changed, to every connection playing or watching it.
+
+        The update is encoded once, and the same bytes go to every connection.'''
+
+        body = match.state_update()
+        if body == None:
+            return
+
+        message = frame_message(MSG_STATE, body)
+        for connection in match.connections:
+            if connection.send_state(message):
+                self.states_sent += 1
+                self.bytes_sent += len(message)
+            else:
+                self.skipped_states += 1
+
+    async def handle_connection(self, reader, writer):
+        '''Reads and handles a client's messages until it disconnects or sends something invalid.'''
+
+        connection = Connection(writer)
+        self.connections.add(connection)
+        buffer = bytearray()
+        try:
+            while True:
+                data = await reader.read(READ_SIZE)
+                if not data:
+                    break
+                buffer += data
+                for message_type, body in read_messages(buffer, MAX_MESSAGE_SIZE):
+                    self.handle_message(connection, message_type, body)
+
+        except (ValueError, IndexError, struct.error) as error:
+            connection.send(frame_message(MSG_ERROR, str(error).encode() or b"malformed message"))
+
+        except ConnectionError:
+            pass
+
+        finally:
+            self.leave(connection)
+            self.connections.discard(connection)
+            writer.close()
+
+    def handle_message(self, connection, message_type, body):
+        '''Handles one message from a client. Raises ValueError if it's invalid.'''
+
+        if message_type == MSG_INPUT:
+            if connection.role != ROLE_PLAYER:
+                raise ValueError("not playing a match")
+            tick, position = read_varint(body, 0)
+            inputs = body[position]
+            timestamp, = U64.unpack_from(body, position + 1)
+            connection.match.add_input(tick, inputs, timestamp)
+
+        elif message_type == MSG_CREATE:
+            if connection.match != None:
+                raise ValueError("already in a match")
+            seed, = U64.unpack_from(body, 0)
+            matrix_width, position = read_varint(body, U64.size)
+            matrix_height, position = read_varint(body, position)
+            if matrix_width * matrix_height > MAX_MATRIX_CELLS:
+                raise ValueError(f"matrix too big: {matrix_width}x{matrix_height}")
+
+            match = Match(next(self.match_ids), seed if seed != 0 else None, matrix_width, matrix_height)
+            self.matches[match.match_id] = match
+            self.join(connection, match, ROLE_PLAYER)
+
+        elif message_type == MSG_SPECTATE:
+            if connection.match != None:
+                raise ValueError("already in a match")
+            match_id, position = read_varint(body, 0)
+            if match_id == 0 and self.matches:
+                match_id = next(iter(self.matches))
+            if match_id not in self.matches:
+                raise ValueError(f"no such match: {match_id}")
+            self.join(connection, self.matches[match_id], ROLE_SPECTATOR)
+
+        elif message_type == MSG_LIST:
+            reply = bytearray()
+            write_varint(reply, len(self.matches))
+            for match_id in self.matches:
+                write_varint(reply, match_id)
+            connection.send(frame_message(MSG_MATCHES, reply))
+
+        else:
+            raise ValueError(f"unknown message type: {message_type}")
+
+    def join(self, connection, match, role):
+        '''Adds "connection" to "match" and sends it the match's details and a keyframe.'''
+
+        connection.match = match
+        connection.role = role
+        match.connections.add(connection)
+        if role == ROLE_PLAYER:
+            match.player = connection
+
+        reply = bytearray()
+        write_varint(reply, match.match_id)
+        reply.append(role)
+        reply += U64.pack(match.game.randomizer.seed)
+        write_varint(reply, match.game.matrix_width)
+        write_varint(reply, match.game.matrix_height)
+        connection.send(frame_message(MSG_JOINED, reply))
+        connection.send(match.keyframe_message())
+
+    def leave(self, connection):
+        '''Takes "connection" out of its match. A match nobody is playing or watching any more is ended.'''
+
+        match = connection.match
+        if match == None:
+            return
+
+        match.connections.discard(connection)
+        if match.player is connection:
+            match.player = None
+        if not match.connections:
+            del self.matches[match.match_id]
+
+        connection.match = None
+        connection.role = None
+
+    def report_stats(self):
+        '''Returns the server's load since the last report as a dict, and starts counting again.'''
+
+        elapsed = time.perf_counter() - self.stats_start_time
+        tick_times_ms = sorted(tick_time * 1000 for tick_time in self.tick_times)
+        stats = {
+            "matches": len(self.matches),
+            "connections": len(self.connections),
+            "ticks_per_s": self.ticks_run / elapsed if elapsed > 0 else 0.0,
+            "dropped_ticks": self.scheduler.dropped_ticks,
+            "tick_ms_p50": percentile(tick_times_ms, 50),
+            "tick_ms_p99": percentile(tick_times_ms, 99),
+            "tick_ms_max": tick_times_ms[-1] if tick_times_ms else 0.0,
+            "tick_budget_used": sum(tick_times_ms) / 1000 / elapsed if elapsed > 0 else 0.0,
+            "states_per_s": self.states_sent / elapsed if elapsed > 0 else 0.0,
+            "bytes_per_s": self.bytes_sent / elapsed if elapsed > 0 else 0.0,
+            "skipped_states": self.skipped_states,
+            "late_inputs": sum(match.late_inputs for match in self.matches.values()),
+        }
+
+        self.stats_start_time = time.perf_counter()
+        self.ticks_run = 0
+        self.tick_times = []
+        self.states_sent = 0
+        self.bytes_sent = 0
+        self.skipped_states = 0
+
+        return(stats)
+
+async def serve(host, port, stats_interval = 0):
+    '''Runs a server until cancelled, printing its stats as JSON every "stats_interval" seconds if that's more than 0.'''
+
+    server = TetrisServer()
+    port = await server.start(host, port)
+    print(f"Listening on {host}:{port}")
+
+    try:
+        while True:
+            await asyncio.sleep(stats_interval if stats_interval > 0 else 3600)
+            if stats_interval > 0:
+                print(json.dumps(server.report_stats()), flush=True)
+    finally:
+        await server.close()
+
+def main():
+    '''Command-line entry point.'''
+
+    parser = argparse.ArgumentParser(description="Hosts headless Tetris matches and streams them to clients.")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help=f"port to listen on (default: {DEFAULT_PORT})")
+    parser.add_argument("--stats-interval", type=float, default=0, help="print the server's load as JSON every this many seconds (default: never)")
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(serve(args.host, args.port, args.stats_interval))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
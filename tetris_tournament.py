@@ -0,0 +1,213 @@
+# Plays many seeded games of a placement-choosing policy on a process pool and summarizes the results.
+#
+# Usage: python tetris_tournament.py --games 10000 --policy heuristic --line-cap 500
+
+import argparse
+import importlib
+import json
+import multiprocessing
+import os
+import random as rand
+import statistics
+import time
+
+from tetris import Tetris, register_table_rebuilder
+from tetris_placements import TranspositionTable, apply_placement, generate_placements, placement_hash
+
+# Weights for the built-in heuristic policy, applied to the board left behind by a placement.
+HEURISTIC_WEIGHTS = {
+    "lines": 0.76,
+    "aggregate_height": -0.51,
+    "holes": -0.36,
+    "bumpiness": -0.18,
+}
+
+def evaluate_placement(game, placement):
+    '''Scores the board "placement" would leave behind using HEURISTIC_WEIGHTS. Higher is better. "game" must use the bitboard field backend.'''
+
+    width = game.matrix_width
+    height = game.matrix_height
+    full_row = (1 << width) - 1
+
+    rows = list(game.row_bits)
+    for row, column in placement.cells():
+        rows[row] |= 1 << column
+
+    # Cleared rows are removed before measuring the rest of the board.
+    remaining_rows = [row for row in rows if row != full_row]
+    lines = height - len(remaining_rows)
+
+    # Scans from the top: a column's height is set by the first row it's filled in, and every empty cell below that is a hole.
+    column_heights = [0 for j in range(width)]
+    covered = 0
+    holes = 0
+    for i, row in enumerate(remaining_rows):
+        new_columns = row & ~covered
+        while new_columns:
+            column = (new_columns & -new_columns).bit_length() - 1
+            column_heights[column] = len(remaining_rows) - i
+            new_columns &= new_columns - 1
+        holes += bin(covered & ~row).count("1")
+        covered |= row
+
+    bumpiness = sum(abs(column_heights[j] - column_heights[j + 1]) for j in range(width - 1))
+
+    return(HEURISTIC_WEIGHTS["lines"] * lines
+           + HEURISTIC_WEIGHTS["aggregate_height"] * sum(column_heights)
+           + HEURISTIC_WEIGHTS["holes"] * holes
+           + HEURISTIC_WEIGHTS["bumpiness"] * bumpiness)
+
+# evaluate_placement() scores, keyed by the Zobrist hash of the board a placement leaves behind.
+EVALUATION_TABLE = TranspositionTable(65536)
+register_table_rebuilder(EVALUATION_TABLE.clear)
+
+def cached_evaluation(game, placement):
+    '''Returns evaluate_placement(game, placement), looking it up in EVALUATION_TABLE first.
+
+    Placements that leave the same board behind, like one reached with and without holding, share an entry.'''
+
+    key = placement_hash(game, placement)
+    score = EVALUATION_TABLE.get(key)
+    if score == None:
+        score = evaluate_placement(game, placement)
+        EVALUATION_TABLE.put(key, score)
+
+    return(score)
+
+def heuristic_policy(game, placements, rng):
+    '''Picks the placement with the best evaluate_placement() score.'''
+
+    return(max(placements, key=lambda placement: cached_evaluation(game, placement)))
+
+def random_policy(game, placements, rng):
+    '''Picks any reachable placement.'''
+
+    return(rng.choice(placements))
+
+BUILT_IN_POLICIES = {
+    "heuristic": heuristic_policy,
+    "random": random_policy,
+}
+
+def load_policy(name):
+    '''Returns the policy called "name": a built-in one, or a "module:function" callback taking (game, placements, rng).'''
+
+    if name in BUILT_IN_POLICIES:
+        return(BUILT_IN_POLICIES[name])
+
+    module_name, _, function_name = name.partition(":")
+    if function_name == "":
+        raise ValueError(f"unknown policy: {name} (expected one of {sorted(BUILT_IN_POLICIES)} or module:function)")
+
+    return(getattr(importlib.import_module(module_name), function_name))
+
+def play_game(seed, policy, line_cap = None, on_placement = None):
+    '''Plays one headless game with the given seed until it's lost or reaches "line_cap" lines. Returns its stats.
+
+    "on_placement" is called with the game and the placement after every piece is placed, if given.'''
+
+    game = Tetris("bitboard", seed=seed)
+    policy_rng = rand.Random(seed)
+    pieces_placed = 0
+    start_time = time.perf_counter()
+
+    while game.game_active and (line_cap == None or game.total_lines_cleared < line_cap):
+        game.step()
+        if game.active_piece == None or not game.game_active:
+            continue
+
+        placements = generate_placements(game)
+        if len(placements) == 0:
+            break
+
+        placement = policy(game, list(placements), policy_rng)
+        apply_placement(game, placement)
+        pieces_placed += 1
+        if on_placement != None:
+            on_placement(game, placement)
+
+    elapsed = time.perf_counter() - start_time
+
+    return({
+        "seed": seed,
+        "score": game.score,
+        "level": game.level,
+        "total_lines_cleared": game.total_lines_cleared,
+        "pieces_placed": pieces_placed,
+        "pieces_per_second": pieces_placed / elapsed if elapsed > 0 else 0.0,
+        "topped_out": not game.game_active,
+    })
+
+def play_game_task(task):
+    '''Pool worker entry point. "task" is a (seed, policy name, line cap) tuple.'''
+
+    seed, policy_name, line_cap = task
+    return(play_game(seed, load_policy(policy_name), line_cap))
+
+def summarize(results):
+    '''Merges per-game results into count, mean, standard deviation, minimum and maximum for each stat.'''
+
+    summary = {"games": len(results)}
+    for stat in ["score", "level", "total_lines_cleared", "pieces_placed", "pieces_per_second"]:
+        values = [result[stat] for result in results]
+        summary[stat] = {
+            "mean": statistics.fmean(values) if values else 0.0,
+            "stdev": statistics.pstdev(values) if values else 0.0,
+            "min": min(values, default=0),
+            "max": max(values, default=0),
+        }
+
+    return(summary)
+
+def run_tournament(games, policy_name, first_seed = 0, line_cap = None, workers = None, on_result = None):
+    '''Plays "games" games with seeds first_seed, first_seed + 1, ... across a process pool of "workers" processes (one per core by default).
+
+    Results stream back as games finish and are passed to "on_result" if given. Returns the list of all results.'''
+
+    if workers == None:
+        workers = os.cpu_count()
+
+    tasks = [(first_seed + i, policy_name, line_cap) for i in range(games)]
+    results = []
+    with multiprocessing.Pool(workers) as pool:
+        for result in pool.imap_unordered(play_game_task, tasks, chunksize=max(1, games // (64 * workers))):
+            results.append(result)
+            if on_result != None:
+                on_result(result)
+
+    return(results)
+
+def main():
+    '''Command-line entry point.'''
+
+    parser = argparse.ArgumentParser(description="Plays seeded headless Tetris games with a placement policy on every core.")
+    parser.add_argument("--games", type=int, default=100, help="number of games to play")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the first game; game i uses seed + i")
+    parser.add_argument("--policy", default="heuristic", help=f"one of {sorted(BUILT_IN_POLICIES)}, or module:function")
+    parser.add_argument("--line-cap", type=int, default=None, help="stop a game once it has cleared this many lines")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: one per core)")
+    parser.add_argument("--results", default=None, help="also write every game's stats to this JSON Lines file")
+    args = parser.parse_args()
+
+    load_policy(args.policy)
+
+    results_file = open(args.results, "w") if args.results else None
+    def on_result(result):
+        if results_file != None:
+            results_file.write(json.dumps(result) + "\n")
+
+    try:
+        start_time = time.perf_counter()
+        results = run_tournament(args.games, args.policy, args.seed, args.line_cap, args.workers, on_result)
+        elapsed = time.perf_counter() - start_time
+    finally:
+        if results_file != None:
+            results_file.close()
+
+    summary = summarize(results)
+    summary["wall_time"] = elapsed
+    summary["games_per_second"] = len(results) / elapsed if elapsed > 0 else 0.0
+    print(json.dumps(summary, indent=2))
+
+if __name__ == "__main__":
+    main()
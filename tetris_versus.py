@@ -0,0 +1,332 @@
+# Versus mode: two or more players on the same pieces, sending garbage lines to each other by clearing lines.
+# VersusMatch plays one match on Tetris games. BatchVersus plays many matches at once on one BatchTetris, tick for tick
+# the same as a VersusMatch with the same seed, for running lots of matches on one host.
+#
+# Every tick, in order:
+#   1. Every player's game steps.
+#   2. A player whose piece cleared lines cancels that many ATTACK_LINES against their own garbage queue, oldest first.
+#   3. A player whose piece locked without clearing takes up to GARBAGE_CAP lines from their garbage queue.
+#   4. What's left of each attack is sent, in player order, to a random opponent who is still playing.
+#
+# The command line plays BatchVersus matches with random inputs. With --check, the first matches are played by
+# tetris_bot.py bots instead, so garbage is sent, and are also played on VersusMatch to compare the two.
+#
+# Usage: python tetris_versus.py [--matches 1000] [--players 2] [--ticks 3600] [--seed 0] [--check 10]
+
+import argparse
+import json
+import random as rand
+import time
+from collections import deque
+
+import numpy as np
+
+from tetris import SevenBagRandomizer, Tetris
+from tetris_batch import BatchTetris
+
+# Garbage lines sent for clearing 0, 1, 2, 3 and 4 lines at once
+ATTACK_LINES = (0, 0, 1, 2, 4)
+# Most garbage lines a player takes from their queue for one piece. The rest wait for the next piece.
+GARBAGE_CAP = 8
+
+# Search time per piece of the bots that play the matches checked with --check
+CHECK_BUDGET_MS = 20
+
+# Salts for the keys of each player's hole column and target streams, taken from the match seed
+HOLE_SALT = 0x686F6C65
+TARGET_SALT = 0x74617267
+
+def player_keys(seed, player):
+    '''Returns the (hole key, target key) of "player" in a match with "seed".'''
+
+    splitmix64 = SevenBagRandomizer.splitmix64
+    player_key = splitmix64((seed & SevenBagRandomizer.MASK_64) ^ player)
+    return(splitmix64(player_key ^ HOLE_SALT), splitmix64(player_key ^ TARGET_SALT))
+
+def cancel_garbage(garbage_queue, lines):
+    '''Takes "lines" lines off the front of "garbage_queue", a deque of [lines, hole column] attacks. Returns the number of lines cancelled.'''
+
+    cancelled = 0
+    while lines > 0 and garbage_queue:
+        attack = garbage_queue[0]
+        taken = min(lines, attack[0])
+        attack[0] -= taken
+        lines -= taken
+        cancelled += taken
+        if attack[0] == 0:
+            garbage_queue.popleft()
+
+    return(cancelled)
+
+def take_garbage(garbage_queue):
+    '''Takes up to GARBAGE_CAP lines off the front of "garbage_queue". Returns the hole column of each line, top to bottom.'''
+
+    hole_columns = []
+    while garbage_queue and len(hole_columns) < GARBAGE_CAP:
+        attack = garbage_queue[0]
+        taken = min(GARBAGE_CAP - len(hole_columns), attack[0])
+        hole_columns += [attack[1]] * taken
+        attack[0] -= taken
+        if attack[0] == 0:
+            garbage_queue.popleft()
+
+    return(hole_columns)
+
+class VersusPlayers:
+    '''The garbage rules shared by VersusMatch and BatchVersus, for "player_count" players in each of "match_count" matches.
+
+    Players are numbered match * player_count + player. Every player has a garbage queue, a deque of [lines, hole column]
+    attacks waiting to be inserted, and counts of lines sent, received and cancelled.'''
+
+    def __init__(self, match_count, player_count, seeds, matrix_width):
+        self.match_count = match_count
+        self.player_count = player_count
+        self.matrix_width = matrix_width
+
+        count = match_count * player_count
+        self.garbage_queues = [deque() for i in range(count)]
+        keys = [player_keys(seeds[i // player_count], i % player_count) for i in range(count)]
+        self.hole_keys = [hole_key for hole_key, target_key in keys]
+        self.target_keys = [target_key for hole_key, target_key in keys]
+        self.attacks_sent = [0 for i in range(count)]
+        self.attacks_received = [0 for i in range(count)]
+
+        self.lines_sent = [0 for i in range(count)]
+        self.lines_received = [0 for i in range(count)]
+        self.lines_cancelled = [0 for i in range(count)]
+
+    def pending_lines(self, player):
+        '''Returns the number of garbage lines waiting in the queue of "player".'''
+
+        return(sum(attack[0] for attack in self.garbage_queues[player]))
+
+    def clear_attack(self, player, lines_cleared):
+        '''Cancels the attack of a piece that cleared "lines_cleared" lines against the garbage queue of "player".
+        Returns the number of lines left to send.'''
+
+        lines = ATTACK_LINES[min(lines_cleared, len(ATTACK_LINES) - 1)]
+        cancelled = cancel_garbage(self.garbage_queues[player], lines)
+        self.lines_cancelled[player] += cancelled
+        return(lines - cancelled)
+
+    def send_attack(self, player, lines, alive):
+        '''Sends "lines" garbage lines from "player" to a random opponent for whom alive(opponent) is true.
+        Nothing is sent if every opponent has topped out.'''
+
+        match_start = player - player % self.player_count
+        opponents = [opponent for opponent in range(match_start, match_start + self.player_count) if opponent != player and alive(opponent)]
+        if len(opponents) == 0:
+            return
+
+        target = opponents[SevenBagRandomizer.splitmix64(self.target_keys[player] ^ self.attacks_sent[player]) % len(opponents)]
+        self.attacks_sent[player] += 1
+
+        # Every line of an attack has the same hole, picked by the player who receives it.
+        hole_column = SevenBagRandomizer.splitmix64(self.hole_keys[target] ^ self.attacks_received[target]) % self.matrix_width
+        self.attacks_received[target] += 1
+        self.garbage_queues[target].append([lines, hole_column])
+        self.lines_sent[player] += lines
+        self.lines_received[target] += lines
+
+    def player_stats(self, player):
+        '''Returns the garbage stats of "player".'''
+
+        return({
+            "lines_sent": self.lines_sent[player],
+            "lines_received": self.lines_received[player],
+            "lines_cancelled": self.lines_cancelled[player],
+            "lines_pending": self.pending_lines(player),
+        })
+
+class VersusMatch:
+    '''One versus match between "player_count" Tetris games dealt the same pieces from "seed".
+
+    The match is won by the last player still playing. winner is None until then, and stays None after a draw, when
+    the last players top out on the same tick. The games keep being stepped after the match ends.'''
+
+    def __init__(self, player_count = 2, seed = None, matrix_width = Tetris.MATRIX_WIDTH, matrix_height = Tetris.MATRIX_HEIGHT,
+                 field_backend = "bitboard"):
+        if seed == None:
+            seed = rand.getrandbits(64)
+
+        self.seed = seed
+        self.player_count = player_count
+        self.games = [Tetris(field_backend, seed, matrix_width, matrix_height) for i in range(player_count)]
+        self.players = VersusPlayers(1, player_count, [seed], matrix_width)
+        self.finished = False
+        self.winner = None
+        self.ticks = 0
+
+    def step(self, inputs):
+        '''Advances every game by one tick. "inputs" holds each player's INPUT_* bitmask.'''
+
+        line_clears = [game.step(player_inputs) for game, player_inputs in zip(self.games, inputs)]
+
+        attacks = []
+        for player, line_clear in enumerate(line_clears):
+            if line_clear == None:
+                continue
+
+            cleared_rows, lines_cleared = line_clear
+            if lines_cleared > 0:
+                lines = self.players.clear_attack(player, lines_cleared)
+                if lines > 0:
+                    attacks.append((player, lines))
+            elif self.games[player].game_active:
+                self.games[player].insert_garbage(take_garbage(self.players.garbage_queues[player]))
+
+        for player, lines in attacks:
+            self.players.send_attack(player, lines, lambda opponent: self.games[opponent].game_active)
+
+        self.ticks += 1
+        if not self.finished:
+            alive = [player for player, game in enumerate(self.games) if game.game_active]
+            if len(alive) <= 1:
+                self.finished = True
+                self.winner = alive[0] if alive else None
+
+    def stats(self):
+        '''Returns the match's result and each player's stats.'''
+
+        return({
+            "seed": self.seed,
+            "ticks": self.ticks,
+            "finished": self.finished,
+            "winner": self.winner,
+            "players": [dict(self.players.player_stats(player), score=game.score, total_lines_cleared=game.total_lines_cleared,
+                             game_active=game.game_active) for player, game in enumerate(self.games)],
+        })
+
+class BatchVersus:
+    '''"match_count" versus matches of "player_count" players, all on one BatchTetris of 10x20 boards.
+    Board match * player_count + player is that player's game.
+
+    Match i deals its pieces from seeds[i] and plays the same as VersusMatch(player_count, seeds[i]). The few boards
+    that lock a piece on a tick have their garbage handled one by one, then the garbage is inserted on every board
+    that takes the same number of lines with one call to BatchTetris.insert_garbage().'''
+
+    def __init__(self, match_count, player_count = 2, seeds = None):
+        if seeds == None:
+            seeds = [rand.getrandbits(64) for i in range(match_count)]
+
+        self.seeds = list(seeds)
+        self.match_count = match_count
+        self.player_count = player_count
+        self.boards = BatchTetris(match_count * player_count, [seed for seed in self.seeds for i in range(player_count)])
+        self.players = VersusPlayers(match_count, player_count, self.seeds, Tetris.MATRIX_WIDTH)
+        self.finished = np.zeros(match_count, dtype=bool)
+        self.winner = np.full(match_count, -1, dtype=np.int64)
+        self.ticks = 0
+
+    def step(self, inputs = 0):
+        '''Advances every match by one tick. "inputs" is a single INPUT_* bitmask, one per board, or a
+        (match_count, player_count) array.'''
+
+        boards = self.boards
+        lines_cleared = boards.step(np.reshape(inputs, -1) if np.ndim(inputs) > 1 else inputs)
+
+        attacks = []
+        garbage = {}
+        for board in np.nonzero(boards.pieces_locked)[0].tolist():
+            if lines_cleared[board] > 0:
+                lines = self.players.clear_attack(board, int(lines_cleared[board]))
+                if lines > 0:
+                    attacks.append((board, lines))
+            elif boards.game_active[board] and self.players.garbage_queues[board]:
+                hole_columns = take_garbage(self.players.garbage_queues[board])
+                garbage.setdefault(len(hole_columns), []).append((board, hole_columns))
+
+        for lines, insertions in garbage.items():
+            boards.insert_garbage(np.array([board for board, hole_columns in insertions], dtype=np.int64),
+                                  np.array([hole_columns for board, hole_columns in insertions], dtype=np.int64))
+
+        for board, lines in attacks:
+            self.players.send_attack(board, lines, lambda opponent: boards.game_active[opponent])
+
+        self.ticks += 1
+        alive = boards.game_active.reshape(self.match_count, self.player_count)
+        alive_count = alive.sum(axis=1)
+        ending = ~self.finished & (alive_count <= 1)
+        self.winner[ending] = np.where(alive_count[ending] == 1, alive[ending].argmax(axis=1), -1)
+        self.finished |= ending
+
+    def match_stats(self, match):
+        '''Returns the result and each player's stats of match number "match", in the same form as VersusMatch.stats().'''
+
+        first_board = match * self.player_count
+        boards = range(first_board, first_board + self.player_count)
+        return({
+            "seed": self.seeds[match],
+            "ticks": self.ticks,
+            "finished": bool(self.finished[match]),
+            "winner": int(self.winner[match]) if self.winner[match] >= 0 else None,
+            "players": [dict(self.players.player_stats(board), score=int(self.boards.score[board]),
+                             total_lines_cleared=int(self.boards.total_lines_cleared[board]),
+                             game_active=bool(self.boards.game_active[board])) for board in boards],
+        })
+
+def random_inputs(rng, held_inputs, input_rate):
+    '''Presses or releases each key of every board in "held_inputs" with probability "input_rate". Returns the new inputs.'''
+
+    toggles = rng.random((len(held_inputs), 8)) < input_rate
+    return(held_inputs ^ (toggles << np.arange(8)).sum(axis=1))
+
+def main():
+    '''Command-line entry point.'''
+
+    parser = argparse.ArgumentParser(description="Plays many versus matches at once with random inputs and summarizes them. "
+                                                 "Matches checked against VersusMatch are played by bots instead.")
+    parser.add_argument("--matches", type=int, default=1000, help="matches to play at once (default: 1000)")
+    parser.add_argument("--players", type=int, default=2, help="players in each match (default: 2)")
+    parser.add_argument("--ticks", type=int, default=3600, help="ticks to play for (default: 3600)")
+    parser.add_argument("--input-rate", type=float, default=0.05, help="chance each key is pressed or released every tick (default: 0.05)")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the inputs; match i uses seed + i (default: 0)")
+    parser.add_argument("--check", type=int, default=0, help="have bots play this many of the matches, also on VersusMatch, and compare them")
+    args = parser.parse_args()
+
+    versus = BatchVersus(args.matches, args.players, [args.seed + i for i in range(args.matches)])
+    checked = [VersusMatch(args.players, args.seed + i) for i in range(min(args.check, args.matches))]
+    rng = np.random.default_rng(args.seed)
+    held_inputs = np.zeros(args.matches * args.players, dtype=np.int64)
+
+    # Random inputs hardly ever clear lines, so the checked matches are played by bots, which send garbage.
+    autoplayers = []
+    if checked:
+        from tetris_bot import Autoplayer, BeamSearch
+        search = BeamSearch(1, 1)
+        autoplayers = [[Autoplayer(search, CHECK_BUDGET_MS) for i in range(args.players)] for match in checked]
+
+    elapsed = 0.0
+    for tick in range(args.ticks):
+        held_inputs = random_inputs(rng, held_inputs, args.input_rate)
+        for i, match in enumerate(checked):
+            held_inputs[i * args.players:(i + 1) * args.players] = [autoplayer.inputs(game) for autoplayer, game in zip(autoplayers[i], match.games)]
+        start_time = time.perf_counter()
+        versus.step(held_inputs)
+        elapsed += time.perf_counter() - start_time
+
+        for i, match in enumerate(checked):
+            match.step(held_inputs[i * args.players:(i + 1) * args.players].tolist())
+
+    results = [versus.match_stats(i) for i in range(args.matches)]
+    summary = {
+        "matches": args.matches,
+        "players": args.players,
+        "ticks": args.ticks,
+        "ticks_per_second": args.ticks / elapsed if elapsed > 0 else 0.0,
+        "match_ticks_per_second": args.ticks * args.matches / elapsed if elapsed > 0 else 0.0,
+        "finished": sum(result["finished"] for result in results),
+        "draws": sum(result["finished"] and result["winner"] == None for result in results),
+        "lines_sent": sum(player["lines_sent"] for result in results for player in result["players"]),
+        "lines_cancelled": sum(player["lines_cancelled"] for result in results for player in result["players"]),
+    }
+    if checked:
+        checked_players = [player for match in checked for player in match.stats()["players"]]
+        summary["checked_lines_sent"] = sum(player["lines_sent"] for player in checked_players)
+        summary["checked_lines_cancelled"] = sum(player["lines_cancelled"] for player in checked_players)
+        summary["mismatched_matches"] = sum(match.stats() != results[i] for i, match in enumerate(checked))
+
+    print(json.dumps(summary, indent=2))
+
+if __name__ == "__main__":
+    main()